@@ -1,11 +1,13 @@
 from setup_app import app, db
 from models import *
 from security import security
+from search import fts_query
 
 from flask_admin import Admin, BaseView, expose
 from flask_admin.menu import MenuLink
 from flask_admin.contrib.peewee import ModelView
 from flask import request, jsonify
+from wtforms.validators import ValidationError
 
 import json
 from peewee import fn
@@ -129,6 +131,8 @@ class ClientModelView(ModelView):
     column_filters = ['postal_code', 'created', 'internal_notes', 'year_of_birth', 'email_consent']
     page_size = 80
     column_default_sort = [('archived', False), ('id', False)]
+    form_excluded_columns = list(Client.search_keys) + ['postal_fsa']
+    column_details_exclude_list = list(Client.search_keys) + ['postal_fsa']
     can_export = True
     can_view_details = True
     details_modal = True
@@ -138,14 +142,54 @@ class InventoryItemModelView(ModelView):
     column_filters = ['name', 'price', 'cost', 'type']
     column_list = ['id', 'archived', 'name', 'price', 'cost', 'category', 'subcategory', 'sku_code']
     column_default_sort = [('archived', False), ('id', False)]
+    form_excluded_columns = list(InventoryItem.search_keys)
+    column_details_exclude_list = list(InventoryItem.search_keys)
     page_size = 80
     can_export = True
     can_view_details = True
     details_modal = True
 
+    def get_list(self, page, sort_column, sort_desc, search, filters,
+                 execute=True, page_size=None):
+        """Search with the full-text index (ranked by relevance) instead
+        of a chain of LIKE on all the searchable columns"""
+
+        match = fts_query([], search.split()) if search else None
+
+        if match is None:
+            return super().get_list(page, sort_column, sort_desc, search, filters,
+                                    execute=execute, page_size=page_size)
+
+        # Filters and explicit sorting are still handled by Flask-Admin
+        count, query = super().get_list(page, sort_column, sort_desc, None, filters,
+                                        execute=False, page_size=False)
+
+        query = query.join(InventoryItemIndex, on=(InventoryItemIndex.rowid == InventoryItem.id)) \
+                     .where(InventoryItemIndex.match(match))
+
+        count = query.count()
+
+        if sort_column is None:
+            query = query.order_by(InventoryItemIndex.bm25(*InventoryItemIndex.weights), InventoryItem.id)
+
+        if page_size is None:
+            page_size = self.page_size
+
+        if page_size:
+            query = query.limit(page_size)
+
+        if page and page_size:
+            query = query.offset(page * page_size)
+
+        if execute:
+            query = list(query.execute())
+
+        return count, query
+
 class WorkorderModelView(ModelView):
     inline_models = (WorkorderItem,)
     column_list = ['client', 'paid', 'status', 'bike_description', 'invoice_notes', 'internal_notes']
+    form_excluded_columns = list(Workorder.derived_fields)
     can_export = True
     can_view_details = True
     details_modal = True
@@ -160,11 +204,43 @@ class WorkorderStatusModelView(ModelView):
     can_view_details = True
     details_modal = True
 
+class TaxClassModelView(ModelView):
+    column_list = ['id', 'name', 'tax1_rate', 'tax2_rate']
+    column_descriptions = {
+        'tax1_rate': 'Empty for the standard rate. Locked once the class has paid items',
+        'tax2_rate': 'Empty for the standard rate. Locked once the class has paid items',
+    }
+    can_view_details = True
+    details_modal = True
+
+    def on_model_change(self, form, model, is_created):
+        # Also refused by a trigger, with a less helpful message
+        if not is_created:
+            old = TaxClass.get_by_id(model.id)
+            rates = lambda tax_class: [None if rate is None else Decimal(rate)
+                                       for rate in (tax_class.tax1_rate, tax_class.tax2_rate)]
+
+            if rates(old) != rates(model) and old.has_paid_items():
+                raise ValidationError('Items of paid workorders are in this class, its rates can not '
+                                      'change anymore. Create a new class for the new rates.')
+
+    def on_model_delete(self, model):
+        # Called by the single and the bulk deletes. Their
+        # delete_instance(recursive=True) would move the items of the
+        # class to the standard class
+        if model.id in (TaxClass.STANDARD, TaxClass.EXEMPT):
+            raise ValidationError(f'The {model.name} class is used by the items without a class, '
+                                  'it can not be deleted.')
+
+        if model.is_used():
+            raise ValidationError(f'Items are in the {model.name} class, it can not be deleted.')
+
 
 admin.add_view(ClientModelView(Client, menu_icon_type='fa', menu_icon_value='fa-user', category='Raw data'))
 admin.add_view(InventoryItemModelView(InventoryItem, menu_icon_type='fa', menu_icon_value='fa-cog', category='Raw data'))
 admin.add_view(WorkorderModelView(Workorder, menu_icon_type='fa', menu_icon_value='fa-list-alt', category='Raw data'))
 admin.add_view(WorkorderStatusModelView(WorkorderStatus, menu_icon_type='fa', menu_icon_value='fa-check-square', category='Raw data'))
+admin.add_view(TaxClassModelView(TaxClass, menu_icon_type='fa', menu_icon_value='fa-percent', category='Raw data'))
 admin.add_view(ModelView(WorkorderItem, menu_icon_type='fa', menu_icon_value='fa-list', category='Raw data'))
 
 from flask_admin import helpers as admin_helpers
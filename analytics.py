@@ -0,0 +1,238 @@
+"""Columnar in-memory snapshot of the paid sales lines
+
+For ad-hoc questions (top sellers by category, labor vs article mix,
+average discount per month, ...) without a query per question : the
+lines of the paid workorders are loaded once in columns, then kept up
+to date with `refresh()`, which only loads the workorders paid since
+the last refresh.
+
+numpy isn't a dependency of MiniPOS : the columns are `array.array` of
+machine integers ('q' is int64), amounts are integers (see `money.py`)
+and text columns are dictionary-encoded (`Codes`). Rows are appended
+in paid_date order, so a date range is a slice found by bisection and
+the group-bys are single passes over the zipped columns of the slice.
+
+    snapshot = SalesSnapshot()
+    snapshot.refresh()
+
+    # Sales per category, labor vs articles, discounts per month
+    snapshot.sum_by('category', 'subtotal', date_start, date_end)
+    snapshot.sum_by('type', 'subtotal', date_start, date_end)
+    snapshot.sum_by('month', 'discount')
+"""
+import array
+import bisect
+import threading
+
+import peewee
+
+import money
+from models import Workorder, WorkorderItem, InventoryItem
+
+# Code 0 is for the lines without an inventory item
+TYPES = ('', 'labor', 'article', 'other')
+
+# Day number of datetime.date.toordinal() in SQL
+JULIAN_DAY_OFFSET = 1721424.5
+
+def sql_day(column):
+    return peewee.Cast(peewee.fn.julianday(peewee.fn.DATE(column)) - JULIAN_DAY_OFFSET, 'INTEGER')
+
+class Codes:
+    """Dictionary encoding of a text column"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        if value not in self.codes:
+            self.codes[value] = len(self.values)
+            self.values.append(value)
+
+        return self.codes[value]
+
+class SalesSnapshot:
+    """Lines of the paid workorders, in columns
+
+    Lines (one entry per WorkorderItem) :
+
+    - workorder, inventory_item (0 if none) : ids
+    - day : date.toordinal() of the payment, month : year * 12 + month - 1
+    - nb : quantity in hundredths
+    - subtotal, discount : nb * price and nb * (orig_price - price) when
+      it's a discount, exact in units of 10**-LINE_PLACES
+    - type : index in TYPES, category : code in `self.categories`
+
+    Workorders (one entry per paid workorder) : id, day and the
+    archived subtotal, taxes1, taxes2, and the discounts rounded per
+    workorder, in cents"""
+
+    LINE_COLUMNS = {'workorder': 'q', 'inventory_item': 'q', 'day': 'l', 'month': 'l',
+                    'nb': 'q', 'subtotal': 'q', 'discount': 'q', 'type': 'b', 'category': 'l'}
+
+    WORKORDER_COLUMNS = {'id': 'q', 'day': 'l', 'subtotal': 'q', 'taxes1': 'q',
+                         'taxes2': 'q', 'discounts': 'q'}
+
+    def __init__(self):
+        self.lines = {name: array.array(typecode) for name, typecode in self.LINE_COLUMNS.items()}
+        self.workorders = {name: array.array(typecode) for name, typecode in self.WORKORDER_COLUMNS.items()}
+        self.categories = Codes()
+        # Inventory item id -> name
+        self.names = {}
+
+        # Workorders paid at the last paid_date loaded : the next
+        # refresh starts from there (paid_date is indexed)
+        self.last_paid_date = None
+        self.last_ids = set()
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.lines['workorder'])
+
+    def refresh(self):
+        """Loads the workorders paid since the last refresh, with their
+        lines. Paid workorders can't be modified, nothing else changes"""
+
+        with self.lock:
+            paid = Workorder.paid
+
+            if self.last_paid_date is not None:
+                paid &= Workorder.paid_date >= self.last_paid_date
+
+            workorders = Workorder.select(
+                Workorder.id, Workorder.paid_date, sql_day(Workorder.paid_date),
+                money.sql_cents(Workorder.paid_subtotal),
+                money.sql_cents(Workorder.paid_taxes1),
+                money.sql_cents(Workorder.paid_taxes2),
+            ).where(paid).order_by(Workorder.paid_date, Workorder.id).tuples()
+
+            workorders = [row for row in workorders if row[0] not in self.last_ids]
+
+            if not workorders:
+                return
+
+            self._load(workorders)
+
+            last_paid_date = workorders[-1][1]
+            last_ids = {row[0] for row in workorders if row[1] == last_paid_date}
+
+            if last_paid_date == self.last_paid_date:
+                last_ids |= self.last_ids
+
+            self.last_paid_date, self.last_ids = last_paid_date, last_ids
+
+    def _load(self, workorders):
+        ids = [row[0] for row in workorders]
+
+        nb = money.sql_units(WorkorderItem.nb, money.NB_PLACES)
+        price = money.sql_units(WorkorderItem.price, money.PRICE_PLACES)
+        orig_price = money.sql_units(WorkorderItem.orig_price, money.PRICE_PLACES)
+
+        # Grouped by workorder, in the order of `workorders`
+        lines = {workorder_id: [] for workorder_id in ids}
+
+        for batch in peewee.chunked(ids, 500):
+            query = WorkorderItem.select(
+                WorkorderItem.workorder, WorkorderItem.inventory_item,
+                nb, nb * price,
+                peewee.Case(None, [(WorkorderItem.price < WorkorderItem.orig_price, nb * (orig_price - price))], 0),
+                InventoryItem.type, InventoryItem.category, InventoryItem.name,
+            ).join(InventoryItem, peewee.JOIN.LEFT_OUTER) \
+             .where(WorkorderItem.workorder.in_(batch)) \
+             .order_by(WorkorderItem.id).tuples()
+
+            for row in query.iterator():
+                lines[row[0]].append(row)
+
+        for workorder_id, paid_date, day, subtotal, taxes1, taxes2 in workorders:
+            month = paid_date.year * 12 + paid_date.month - 1
+            discounts = 0
+
+            for _, inventory_item, nb, subtotal_units, discount, type, category, name in lines[workorder_id]:
+                discounts += discount
+
+                for column, value in [('workorder', workorder_id), ('inventory_item', inventory_item or 0),
+                                      ('day', day), ('month', month), ('nb', nb),
+                                      ('subtotal', subtotal_units), ('discount', discount),
+                                      ('type', TYPES.index(type or '')),
+                                      ('category', self.categories.code(category or ''))]:
+                    self.lines[column].append(value)
+
+                if inventory_item:
+                    self.names[inventory_item] = name
+
+            for column, value in [('id', workorder_id), ('day', day), ('subtotal', subtotal),
+                                  ('taxes1', taxes1), ('taxes2', taxes2),
+                                  ('discounts', money.rescale(discounts, money.LINE_PLACES))]:
+                self.workorders[column].append(value)
+
+    @staticmethod
+    def _slice(days, date_start, date_end):
+        """Range of the rows paid between two dates (included)"""
+        start = 0 if date_start is None else bisect.bisect_left(days, date_start.toordinal())
+        end = len(days) if date_end is None else bisect.bisect_right(days, date_end.toordinal())
+        return start, end
+
+    def sum_by(self, key, value, date_start=None, date_end=None, where=None):
+        """{key: sum of value} of the lines paid between two dates
+
+        `key` and `value` are line columns, `where` an optional
+        (column, code) filter. Keys are decoded (category and type
+        names, 'YYYY-MM' months), amounts are Decimals rounded to the
+        cent"""
+        start, end = self._slice(self.lines['day'], date_start, date_end)
+        keys = self.lines[key][start:end]
+        values = self.lines[value][start:end]
+        sums = {}
+
+        if where is None:
+            for k, v in zip(keys, values):
+                sums[k] = sums.get(k, 0) + v
+        else:
+            column, code = where
+
+            for k, v, c in zip(keys, values, self.lines[column][start:end]):
+                if c == code:
+                    sums[k] = sums.get(k, 0) + v
+
+        if value == 'nb':
+            sums = {k: money.to_decimal(v, money.NB_PLACES) for k, v in sums.items()}
+        elif value in ('subtotal', 'discount'):
+            sums = {k: money.to_decimal(money.rescale(v, money.LINE_PLACES)) for k, v in sums.items()}
+
+        return {self.decode(key, k): v for k, v in sums.items()}
+
+    def decode(self, key, code):
+        if key == 'category':
+            return self.categories.values[code]
+        elif key == 'type':
+            return TYPES[code]
+        elif key == 'month':
+            return f'{code // 12:04}-{code % 12 + 1:02}'
+
+        return code
+
+    # ---------- Report queries, see jobs.compute_report() ----------
+
+    def items_sold(self, date_start, date_end):
+        """Quantity sold of each inventory article, as a list of
+        {'name', 'total_sold'} in decreasing order, like
+        `InventoryItem.items_sold()`"""
+        totals = self.sum_by('inventory_item', 'nb', date_start, date_end, where=('type', TYPES.index('article')))
+
+        return [{'name': self.names[item_id], 'total_sold': total}
+                for item_id, total in sorted(totals.items(), key=lambda item: (-item[1], item[0]))]
+
+    def paid_stats(self, date_start, date_end):
+        """Same result as `Workorder.paid_stats()`"""
+        start, end = self._slice(self.workorders['day'], date_start, date_end)
+
+        stats = {name: money.to_decimal(sum(self.workorders[column][start:end]))
+                 for name, column in [('subtotal', 'subtotal'), ('taxes1', 'taxes1'),
+                                      ('taxes2', 'taxes2'), ('total_discounts', 'discounts')]}
+
+        stats['taxes'] = stats['taxes1'] + stats['taxes2']
+        stats['total'] = stats['subtotal'] + stats['taxes']
+
+        return stats
@@ -7,8 +7,14 @@ from admin import admin
 from models import *
 from views import *
 
+import jobs
 import click
 
+# No thread of this process runs the jobs left by the previous one. The
+# table doesn't exist yet before `create-db` or `migrate-db`
+if ReportJob.table_exists():
+    jobs.recover_jobs()
+
 @app.cli.command("create-db")
 @click.option('--import-data/--no-import-data', default=False)
 def click_create_db(import_data):
@@ -30,6 +36,52 @@ def click_validate_db():
 
     print('DB validated')
 
+@app.cli.command("migrate-db")
+def click_migrate_db():
+    from migrate_db import migrate_db
+
+    for name in migrate_db():
+        print('Applied', name)
+
+    print('DB up to date')
+
+@app.cli.command("rebuild-sales-ledger")
+def click_rebuild_sales_ledger():
+    from create_db import rebuild_sales_ledger
+
+    rebuild_sales_ledger()
+
+    print('Sales ledger rebuilt')
+
+@app.cli.command("export-sales")
+@click.option('--format', 'format_', type=click.Choice(['csv', 'jsonl']), default='csv')
+@click.option('--date-start', type=click.DateTime(['%Y-%m-%d']), default=None)
+@click.option('--date-end', type=click.DateTime(['%Y-%m-%d']), default=None)
+@click.option('--since', default=None, help='Only the workorders paid after this cursor')
+@click.option('--output', type=click.File('w'), default='-')
+def click_export_sales(format_, date_start, date_end, since, output):
+    """Prints the cursor of the last exported workorder on stderr, to
+    pass as --since to the next export"""
+    import export
+
+    date_start, date_end = date_start and date_start.date(), date_end and date_end.date()
+
+    try:
+        since = since and export.parse_cursor(since)
+    except ValueError:
+        raise click.BadParameter('expected <paid_date>,<id>', param_hint='--since')
+
+    lines, _ = export.FORMATS[format_]
+    until = export.last_cursor(date_start, date_end)
+
+    for line in lines(export.export_records(date_start, date_end, since, until)):
+        output.write(line)
+
+    cursor = max(filter(None, [since, until]), default=None)
+
+    if cursor:
+        click.echo(f'Cursor : {export.cursor_token(cursor)}', err=True)
+
 @app.cli.command("anonymize-db")
 def click_create_db():
     from create_db import anonymize
@@ -0,0 +1,56 @@
+"""Barcode normalization for scanned codes
+
+Scanners don't all send the same thing for a given product : a UPC-A
+can come as 12 digits, as an EAN-13 with a leading 0, or without its
+check digit, depending on how the scanner is configured. Inventory
+imports have the same problem. `variants()` lists every form a scanned
+GTIN can be stored under, so that it can be looked up with the indexes
+of the code columns instead of normalizing each row.
+"""
+
+# EAN-8, UPC-A, EAN-13, GTIN-14
+GTIN_LENGTHS = (8, 12, 13, 14)
+
+def is_number(code):
+    return code.isascii() and code.isdigit()
+
+def check_digit(digits):
+    """GS1 check digit of `digits` (a GTIN without its last digit)"""
+    total = sum(int(d) * (3 if i % 2 == 0 else 1) for i, d in enumerate(reversed(digits)))
+
+    return str(-total % 10)
+
+def is_valid_gtin(code):
+    return is_number(code) and len(code) in GTIN_LENGTHS and check_digit(code[:-1]) == code[-1]
+
+def normalize_gtin(code):
+    """GTIN-14 of a scanned code, None if it's not an EAN/UPC"""
+    code = code.strip()
+
+    if not is_number(code):
+        return None
+
+    if is_valid_gtin(code):
+        return code.zfill(14)
+
+    # Scanner configured to drop the check digit
+    if len(code) + 1 in GTIN_LENGTHS:
+        return (code + check_digit(code)).zfill(14)
+
+    return None
+
+def variants(code):
+    """The forms of a scanned `code` that could be stored as an EAN or
+    UPC : ex.: 012345678905 -> 0012345678905, 012345678905, ..."""
+    code = code.strip()
+    forms = {code}
+
+    gtin = normalize_gtin(code)
+
+    if gtin is not None:
+        for length in GTIN_LENGTHS:
+            # Only drop leading zeros
+            if not gtin[:-length].strip('0'):
+                forms.add(gtin[-length:])
+
+    return sorted(forms)
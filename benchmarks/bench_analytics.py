@@ -0,0 +1,167 @@
+"""Compares the report queries in SQL with the in-memory SalesSnapshot
+
+Run from the project root :
+
+    python -m benchmarks.bench_analytics
+
+The synthetic database (20k paid workorders over 3 years by default) is
+generated once in benchmarks/data/ and reused by the next runs. The
+results of both versions are checked to be the same.
+"""
+import os
+import sys
+import time
+import decimal
+import argparse
+import datetime
+
+import config
+from benchmarks.datasets import inventory_items, paid_workorders
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Last day of the synthetic sales
+END = datetime.datetime(2022, 6, 30, 18)
+
+# Date ranges of the reports page
+RANGES = [
+    ('7 days', 7),
+    ('30 days', 30),
+    ('1 year', 365),
+    ('all time', 100 * 365),
+]
+
+def create_database(nb_workorders, nb_items, seed):
+    """Fills the (empty) configured database with the synthetic data"""
+    from create_db import create_db, rebuild_sales_ledger
+    from models import db
+
+    create_db()
+
+    # Not SqliteQueueDatabase : transactions are fine here
+    with db.database.atomic():
+        insert_sales(nb_workorders, nb_items, seed)
+
+    # The workorders are inserted already paid, the trigger doesn't see them
+    rebuild_sales_ledger()
+
+    db.database.execute_sql('ANALYZE')
+
+def insert_sales(nb_workorders, nb_items, seed, end=END, days=3 * 365):
+    from models import InventoryItem, Workorder, WorkorderItem
+
+    if not InventoryItem.select().exists():
+        for row in inventory_items(nb_items, seed):
+            InventoryItem.insert(row).execute()
+
+    items = list(InventoryItem.select().dicts())
+    tax_rates = [rate for _, rate in config.taxes]
+    lines = []
+
+    for workorder, workorder_lines in paid_workorders(nb_workorders, items, tax_rates, end, days, seed):
+        workorder_id = Workorder.insert(workorder).execute()
+        lines += [dict(line, workorder=workorder_id) for line in workorder_lines]
+
+        if len(lines) >= 1000:
+            WorkorderItem.insert_many(lines).execute()
+            lines = []
+
+    if lines:
+        WorkorderItem.insert_many(lines).execute()
+
+def timed(func, repeat=1):
+    """(result, seconds per call)"""
+    start = time.perf_counter()
+
+    for _ in range(repeat):
+        result = func()
+
+    return result, (time.perf_counter() - start) / repeat
+
+def sql_items_sold(date_start, date_end):
+    from models import InventoryItem
+
+    # SUM() of the REAL column
+    return [{'name': item['name'], 'total_sold': decimal.Decimal(repr(item['total_sold'])).quantize(decimal.Decimal('0.01'))}
+            for item in InventoryItem.items_sold(date_start, date_end)]
+
+def same_items_sold(a, b):
+    # Ties are in no particular order in SQL
+    return sorted((item['total_sold'], item['name']) for item in a) == \
+           sorted((item['total_sold'], item['name']) for item in b)
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workorders', type=int, default=20000, help='number of paid workorders')
+    parser.add_argument('--items', type=int, default=2000, help='number of inventory items')
+    parser.add_argument('--new', type=int, default=50, help='workorders paid between two refreshes')
+    parser.add_argument('--repeat', type=int, default=5, help='runs of each query')
+    parser.add_argument('--seed', type=int, default=1337)
+    args = parser.parse_args()
+
+    run_name = f'analytics-{args.workorders}-workorders-{args.items}-items-{args.seed}'
+    db_path = os.path.join(BENCHMARKS_DIR, 'data', run_name + '.db')
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+
+    new_database = not os.path.exists(db_path)
+
+    # Same setup as the tests
+    config.DATABASE['name'] = db_path
+    config.DATABASE['engine'] = 'peewee.SqliteDatabase'
+
+    from app import app
+    from models import db, Workorder
+    from analytics import SalesSnapshot
+
+    with app.app_context():
+        if new_database:
+            print(f'Generating {db_path}...', file=sys.stderr)
+            start = time.perf_counter()
+            create_database(args.workorders, args.items, args.seed)
+            print(f'Done in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+        snapshot = SalesSnapshot()
+        _, load = timed(snapshot.refresh)
+        _, noop = timed(snapshot.refresh, args.repeat)
+        nb_lines = len(snapshot)
+
+        # The next day's payments, rolled back to keep the database as is
+        with db.database.atomic() as transaction:
+            insert_sales(args.new, args.items, args.seed + 1, END + datetime.timedelta(days=1), days=1)
+            _, incremental = timed(snapshot.refresh)
+            nb_new_lines = len(snapshot) - nb_lines
+            transaction.rollback()
+
+        snapshot = SalesSnapshot()
+        snapshot.refresh()
+
+        print(f'{len(snapshot)} lines of {Workorder.select().where(Workorder.paid).count()} paid workorders')
+        print(f'Full load : {load * 1000:8.1f} ms')
+        print(f'Refresh, {args.new} new workorders ({nb_new_lines} lines) : {incremental * 1000:8.1f} ms')
+        print(f'Refresh, nothing new : {noop * 1000:8.1f} ms')
+        print()
+        print(f'{"range":<10} {"query":<12} {"SQL ms":>10} {"snapshot ms":>12} {"speedup":>8}')
+
+        date_end = END.date()
+
+        for label, days in RANGES:
+            date_start = date_end - datetime.timedelta(days=days - 1)
+
+            for name, sql, memory, same in [
+                    ('paid_stats', Workorder.paid_stats, snapshot.paid_stats, lambda a, b: a == b),
+                    ('items_sold', sql_items_sold, snapshot.items_sold, same_items_sold)]:
+
+                # Loads the SQLite pages
+                sql(date_start, date_end)
+
+                sql_result, sql_time = timed(lambda: sql(date_start, date_end), args.repeat)
+                memory_result, memory_time = timed(lambda: memory(date_start, date_end), args.repeat)
+
+                assert same(sql_result, memory_result), f'{name} differs on {label}'
+
+                print(f'{label:<10} {name:<12} {sql_time * 1000:>10.2f} {memory_time * 1000:>12.2f} '
+                      f'{sql_time / memory_time:>7.1f}x')
+
+if __name__ == '__main__':
+    main()
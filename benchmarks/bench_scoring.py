@@ -0,0 +1,76 @@
+"""Compares does_match() with the compiled Matcher on a realistic catalog
+
+Run from the project root :
+
+    python -m benchmarks.bench_scoring
+"""
+import time
+import argparse
+
+from scoring import does_match, Matcher, extract_terms
+from benchmarks.datasets import inventory_items, INVENTORY_QUERIES, keystrokes
+
+# Number of rows scored per request by the typeahead
+PAGE_SIZE = 20
+
+def score_old(query, terms, rows):
+    scores = []
+
+    for item in rows:
+        score = does_match(query, item['name']) * 2 + does_match(query, item['keywords'])
+
+        for t in terms:
+            score += does_match(t, item['name']) + 0.5 * does_match(t, item['keywords'])
+
+        scores.append(score)
+
+    return scores
+
+def score_new(query, terms, rows):
+    query_matcher = Matcher(query)
+    term_matchers = [Matcher(t) for t in terms]
+    scores = []
+
+    for item in rows:
+        score = query_matcher.score(item['name']) * 2 + query_matcher.score(item['keywords'])
+
+        for matcher in term_matchers:
+            score += matcher.score(item['name']) + 0.5 * matcher.score(item['keywords'])
+
+        scores.append(score)
+
+    return scores
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=PAGE_SIZE, help='rows scored per request')
+    parser.add_argument('--catalog', type=int, default=40000, help='size of the catalog')
+    args = parser.parse_args()
+
+    catalog = list(inventory_items(args.catalog))
+
+    requests = []
+    for i, query in enumerate(INVENTORY_QUERIES):
+        for prefix in keystrokes(query):
+            # Each request scores a different slice of the catalog
+            start = (len(requests) * args.rows) % (len(catalog) - args.rows)
+            requests.append((prefix, list(extract_terms(prefix))[:3], catalog[start:start + args.rows]))
+
+    timings = {}
+
+    for name, func in [('difflib', score_old), ('Matcher', score_new)]:
+        start = time.perf_counter()
+        results = [func(query, terms, rows) for query, terms, rows in requests]
+        timings[name] = (time.perf_counter() - start, results)
+
+    assert timings['difflib'][1] == timings['Matcher'][1], 'Scores differ'
+
+    print(f'{len(requests)} requests, {args.rows} rows per request')
+
+    for name, (elapsed, results) in timings.items():
+        print(f'{name:>8} : {elapsed * 1000:8.1f} ms total, {elapsed / len(requests) * 1000:6.2f} ms/request')
+
+    print(f'Speedup : {timings["difflib"][0] / timings["Matcher"][0]:.1f}x')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,202 @@
+"""Replays typeahead keystrokes against the search endpoints
+
+Run from the project root :
+
+    python -m benchmarks.bench_search
+
+The synthetic database (100k inventory items and 250k clients by
+default) is generated once in benchmarks/data/ and reused by the next
+runs. Results are written as JSON with sorted keys, one file per run
+configuration, to be diffed with the previous run.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import sqlite3
+import statistics
+import contextlib
+
+import config
+from benchmarks.datasets import inventory_items, clients, INVENTORY_QUERIES, CLIENT_QUERIES, keystrokes
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+ENDPOINTS = [
+    ('api_get_inventory_items', '/api/search/inventory_items/?query={}', INVENTORY_QUERIES),
+    ('api_get_clients', '/api/search/clients/?query={}', CLIENT_QUERIES),
+    ('list_clients', '/clients/?query={}', CLIENT_QUERIES),
+]
+
+BENCH_USER = 'bench@bench.com'
+
+class QueryCounter(logging.Handler):
+    """Counts the SQL queries logged by peewee"""
+
+    def __init__(self):
+        super().__init__(logging.DEBUG)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+def create_database(nb_items, nb_clients, seed):
+    """Fills the (empty) configured database with the synthetic data"""
+    from create_db import create_db
+    from security import user_datastore
+    from flask_security import hash_password
+    from models import db, InventoryItem, Client
+
+    create_db()
+    user_datastore.create_user(email=BENCH_USER, password=hash_password('bench'))
+
+    # Not SqliteQueueDatabase : transactions are fine here
+    with db.database.atomic():
+        for model, rows in [(InventoryItem, inventory_items(nb_items, seed)),
+                            (Client, clients(nb_clients, seed))]:
+            batch = []
+
+            for row in rows:
+                batch.append(row)
+
+                if len(batch) == 1000:
+                    model.insert_many(batch).execute()
+                    batch = []
+
+            if batch:
+                model.insert_many(batch).execute()
+
+    db.database.execute_sql('ANALYZE')
+
+def percentile(quantiles, p):
+    return round(quantiles[p - 1] * 1000, 2)
+
+def replay(client, path, queries, cold):
+    """Sends every keystroke of every query, returns the latencies (in
+    seconds) and the number of SQL queries of each request"""
+    from search import inventory_cache, client_cache
+
+    counter = QueryCounter()
+    logger = logging.getLogger('peewee')
+    logger.addHandler(counter)
+    logger.setLevel(logging.DEBUG)
+    logger.propagate = False
+
+    latencies = []
+    nb_queries = []
+
+    try:
+        for query in queries:
+            for prefix in keystrokes(query):
+                if cold:
+                    inventory_cache.clear()
+                    client_cache.clear()
+
+                counter.count = 0
+                start = time.perf_counter()
+
+                # Silences @timefunc
+                with contextlib.redirect_stdout(None):
+                    rv = client.get(path.format(prefix))
+
+                latencies.append(time.perf_counter() - start)
+                nb_queries.append(counter.count)
+
+                assert rv.status_code == 200, (path, prefix, rv.status_code)
+    finally:
+        logger.removeHandler(counter)
+        logger.propagate = True
+
+    return latencies, nb_queries
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--items', type=int, default=100000, help='number of inventory items')
+    parser.add_argument('--clients', type=int, default=250000, help='number of clients')
+    parser.add_argument('--seed', type=int, default=1337)
+    parser.add_argument('--cache', action='store_true',
+                        help="keep the typeahead caches between requests (cleared before each one by default)")
+    parser.add_argument('--output', help='results file (default : benchmarks/results/<configuration>.json)')
+    args = parser.parse_args()
+
+    run_name = f'search-{args.items}-items-{args.clients}-clients-{args.seed}'
+    db_path = os.path.join(BENCHMARKS_DIR, 'data', run_name + '.db')
+    output = args.output or os.path.join(BENCHMARKS_DIR, 'results',
+                                         run_name + ('-cache' if args.cache else '') + '.json')
+
+    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    os.makedirs(os.path.dirname(output), exist_ok=True)
+
+    new_database = not os.path.exists(db_path)
+
+    # Same setup as the tests
+    config.DATABASE['name'] = db_path
+    config.DATABASE['engine'] = 'peewee.SqliteDatabase'
+    config.WTF_CSRF_ENABLED = False
+
+    from app import app
+
+    if new_database:
+        print(f'Generating {db_path}...', file=sys.stderr)
+        start = time.perf_counter()
+
+        with app.app_context():
+            create_database(args.items, args.clients, args.seed)
+
+        print(f'Done in {time.perf_counter() - start:.1f}s', file=sys.stderr)
+
+    results = {
+        'configuration': {
+            'items': args.items,
+            'clients': args.clients,
+            'seed': args.seed,
+            'cache': args.cache,
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+        },
+        'endpoints': {},
+    }
+
+    from search import inventory_index, client_index
+
+    with app.test_client() as client:
+        client.post('/login', data={'email': BENCH_USER, 'password': 'bench'})
+
+        # Built on the first typo otherwise
+        inventory_index.ensure_built()
+        client_index.ensure_built()
+
+        for name, path, queries in ENDPOINTS:
+            # Loads the SQLite pages
+            replay(client, path, queries[:1], cold=True)
+
+            latencies, nb_queries = replay(client, path, queries, cold=not args.cache)
+            quantiles = statistics.quantiles(latencies, n=100, method='inclusive')
+
+            results['endpoints'][name] = {
+                'requests': len(latencies),
+                'p50_ms': percentile(quantiles, 50),
+                'p95_ms': percentile(quantiles, 95),
+                'p99_ms': percentile(quantiles, 99),
+                'max_ms': round(max(latencies) * 1000, 2),
+                'queries_per_request': round(statistics.mean(nb_queries), 2),
+                'max_queries': max(nb_queries),
+            }
+
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+        f.write('\n')
+
+    print(f'{"endpoint":<25} {"requests":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}')
+
+    for name, stats in results['endpoints'].items():
+        print(f'{name:<25} {stats["requests"]:>8} {stats["p50_ms"]:>8} {stats["p95_ms"]:>8} '
+              f'{stats["p99_ms"]:>8} {stats["queries_per_request"]:>8}')
+
+    print(f'Results saved in {output}', file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,238 @@
+"""Realistic synthetic data for the benchmarks
+
+Everything is generated from a seeded random generator, so the same
+arguments always give the same dataset.
+"""
+import random
+import datetime
+from decimal import Decimal
+
+import money
+
+PARTS = [
+    'Pneu', 'Chambre à air', 'Câble de frein', 'Câble de dérailleur',
+    'Gaine', 'Patins de freins', 'Plaquettes de frein', 'Chaîne',
+    'Cassette', 'Roue libre', 'Plateau', 'Pédalier', 'Pédales',
+    'Boîtier de pédalier', 'Jeu de direction', 'Guidon', 'Potence',
+    'Selle', 'Tige de selle', 'Collier de selle', 'Dérailleur arrière',
+    'Dérailleur avant', 'Manette de vitesse', 'Levier de frein',
+    'Jante', 'Rayon', 'Moyeu avant', 'Moyeu arrière', 'Roue avant',
+    'Roue arrière', 'Garde-boue', 'Porte-bagages', 'Béquille',
+    'Sonnette', 'Lumière avant', 'Lumière arrière', 'Cadenas',
+    'Poignées', 'Ruban de guidon', 'Fond de jante', 'Valve',
+    'Étrier de frein', 'Disque de frein', 'Fourche', 'Panier',
+]
+
+QUALIFIERS = [
+    'usagé', 'neuf', 'hiver', 'route', 'hybride', 'montagne', 'BMX',
+    'enfant', 'renforcé', 'anti-crevaison', 'presta', 'schrader',
+    'aluminium', 'acier', 'carbone', 'noir', 'argent', 'rouge',
+    'Shimano', 'SRAM', 'Tektro', 'KMC', 'Schwalbe', 'Continental',
+    'Kenda', 'Park Tool', 'Origin8', 'Sunrace',
+]
+
+SIZES = [
+    "700x23c", "700x25c", "700x28c", "700x32c", "700x35c", "700x38c",
+    "26x1.95", "26x2.125", "26x1 3/8", "27x1 1/4", "27.5x2.25",
+    "29x2.2", "20x1.75", "16x1.75", "12 1/2x2 1/4",
+    "8 vitesses", "9 vitesses", "10 vitesses", "11 vitesses",
+    "11-28T", "11-32T", "11-34T", "42T", "34T", "175mm", "170mm",
+    "31.8mm", "25.4mm", "27.2mm", "1 1/8''",
+]
+
+KEYWORDS = [
+    'flat crevaison', 'tire', 'tube', 'brake', 'cable', 'chain',
+    'gear', 'shifter', 'wheel', 'hub', 'spoke', 'saddle', 'seatpost',
+    'bell', 'light', 'lock', 'rack', 'fender', 'winter', 'used', 'new',
+    'kid', 'road', 'mtb', 'city',
+]
+
+CATEGORIES = {
+    'Pneus et chambres': ['Pneus', 'Chambres à air', 'Fonds de jante'],
+    'Freins': ['Patins', 'Câbles', 'Leviers', 'Disques'],
+    'Transmission': ['Chaînes', 'Cassettes', 'Dérailleurs', 'Pédaliers'],
+    'Roues': ['Jantes', 'Rayons', 'Moyeux', 'Roues complètes'],
+    'Accessoires': ['Éclairage', 'Cadenas', 'Sacoches', 'Sonnettes'],
+    'Atelier': ['Main d\'oeuvre', 'Mises au point'],
+}
+
+def inventory_items(nb, seed=1337):
+    """`nb` inventory items as dicts, with the InventoryItem columns"""
+    rand = random.Random(seed)
+    categories = list(CATEGORIES.items())
+    skus = set()
+
+    for i in range(nb):
+        words = [rand.choice(PARTS)]
+        words += rand.sample(QUALIFIERS, rand.randint(0, 2))
+
+        if rand.random() < 0.7:
+            words.append(rand.choice(SIZES))
+
+        category, subcategories = rand.choice(categories)
+
+        # Supplier SKU patterns, ex.: TR-700-2531, 9324-11, KMC1234.
+        # Codes are unique among the active items
+        sku = None
+
+        while sku is None or sku in skus:
+            sku = rand.choice([
+                lambda: f'{rand.choice("ABCDEFGHKMPRSTVW")}{rand.choice("ABCDEFGHKMPRSTVW")}-{rand.randint(100, 999)}-{rand.randint(1000, 9999)}',
+                lambda: f'{rand.randint(1000, 9999)}-{rand.randint(10, 99)}',
+                lambda: f'{rand.choice(["KMC", "SHI", "SRA", "SCH", "CON"])}{rand.randint(100, 99999)}',
+            ])()
+
+        skus.add(sku)
+
+        yield {
+            'name': ' '.join(words),
+            'keywords': ' '.join(rand.sample(KEYWORDS, rand.randint(0, 3))),
+            'category': category,
+            'subcategory': rand.choice(subcategories),
+            'sku_code': sku,
+            'ean_code': str(rand.randint(10**12, 10**13 - 1)) if rand.random() < 0.5 else '',
+            'upc_code': str(rand.randint(10**11, 10**12 - 1)) if rand.random() < 0.3 else '',
+            'price': round(rand.uniform(1, 300), 2),
+            'cost': round(rand.uniform(0.5, 150), 2),
+            'msrp': 0,
+            'type': 'labor' if category == 'Atelier' else 'article',
+        }
+
+# Queries as typed in the typeahead : every prefix of the final query
+# is sent, one per keystroke
+INVENTORY_QUERIES = [
+    'pneu 700x25', 'chambre a air 26', 'chambre à air', 'cable frein',
+    'patins', 'chaine kmc', 'cassette 11-32', 'derailleur shimano',
+    'pneu hiver', 'guidon', 'lumiere', 'KMC1', 'cadenas', 'selle',
+    'moyeu arriere', 'pedalier 170', 'chanbre', 'plaquettes',
+]
+
+def keystrokes(query, min_length=2):
+    return [query[:i] for i in range(min_length, len(query) + 1)]
+
+FIRST_NAMES = [
+    'Marie', 'Jean', 'Pierre', 'Louis', 'Julie', 'Sophie', 'Nathalie',
+    'Mathieu', 'Olivier', 'Gabriel', 'Léa', 'Chloé', 'Émile', 'Félix',
+    'Zoé', 'Camille', 'Élodie', 'François', 'Geneviève', 'Hélène',
+    'Jérôme', 'Stéphane', 'Sébastien', 'Amélie', 'Mélanie', 'Benoît',
+    'Josée', 'Réjean', 'Ginette', 'Noémie', 'Raphaël', 'Loïc',
+    'Alice', 'James', 'Robert', 'Michael', 'Sarah', 'Emily', 'David',
+    'Jennifer', 'Mohamed', 'Fatima', 'Ahmed', 'Yasmine', 'Wei', 'Mei',
+    'Nguyen', 'Priya', 'Arjun', 'Carlos', 'Sofia', 'Diego', 'Ana',
+    'Dmitri', 'Olga', 'Kenji', 'Aiko', 'Jimmy', 'Theresa', 'Carolyn',
+]
+
+LAST_NAMES = [
+    'Tremblay', 'Gagnon', 'Roy', 'Côté', 'Bouchard', 'Gauthier', 'Morin',
+    'Lavoie', 'Fortin', 'Gagné', 'Ouellet', 'Pelletier', 'Bélanger',
+    'Lévesque', 'Bergeron', 'Leblanc', 'Paquette', 'Girard', 'Simard',
+    'Boucher', 'Caron', 'Beaulieu', 'Cloutier', 'Dubé', 'Poirier',
+    'Fournier', 'Lapointe', 'Leclerc', 'Lefebvre', 'Poulin', 'Thibault',
+    'St-Pierre', 'Nadeau', 'Martin', 'Landry', 'Martel', 'Bédard',
+    'Grenier', 'Lessard', 'Bernier', 'Richard', 'Michaud', 'Hébert',
+    'Desjardins', 'Couture', 'Turcotte', 'Lachance', 'Parent', 'Blais',
+    'Gosselin', 'Savard', 'Proulx', 'Beaudoin', 'Demers', 'Perreault',
+    'Smith', 'Johnson', 'Williams', 'Brown', 'Wilson', 'Taylor', 'Lee',
+    'Nguyen', 'Tran', 'Wong', 'Chen', 'Patel', 'Singh', 'Garcia',
+    'Rodriguez', 'Cohen', 'Kowalski', 'Ivanov', 'Haddad', 'Khoury',
+    'Ben Ali', 'Diallo', 'Joseph', 'Pierre-Louis', 'Whooper', 'Horton',
+    'Degraffenreid', 'Tackitt', 'Anderson',
+]
+
+EMAIL_DOMAINS = ['gmail.com', 'hotmail.com', 'yahoo.ca', 'videotron.ca', 'outlook.com']
+
+def clients(nb, seed=1337):
+    """`nb` clients as dicts, with the Client columns"""
+    rand = random.Random(seed)
+    letters = 'ABCEGHJKLMNPRSTVXY'
+
+    for i in range(nb):
+        first_name = rand.choice(FIRST_NAMES)
+        last_name = rand.choice(LAST_NAMES)
+
+        if rand.random() < 0.05:
+            last_name += '-' + rand.choice(LAST_NAMES)
+
+        # Phones and emails are typed in all sorts of ways
+        area = rand.choice(['514', '438', '450', '581'])
+        number = f'{rand.randint(200, 999)}{rand.randint(0, 9999):04d}'
+        phone = rand.choice([
+            lambda: f'{area} {number[:3]} {number[3:]}',
+            lambda: f'({area}) {number[:3]}-{number[3:]}',
+            lambda: f'1-{area}-{number[:3]}-{number[3:]}',
+            lambda: f'{area}{number}',
+            lambda: '',
+        ])()
+
+        email = ''
+        if rand.random() < 0.7:
+            email = f'{first_name}.{last_name}{rand.randint(1, 999)}@{rand.choice(EMAIL_DOMAINS)}'.lower()
+
+        yield {
+            'first_name': first_name,
+            'last_name': last_name,
+            'address': f'{rand.randint(1, 9999)} rue {rand.choice(LAST_NAMES)}',
+            'postal_code': f'{rand.choice("HJ")}{rand.randint(0, 9)}{rand.choice(letters)} '
+                           f'{rand.randint(0, 9)}{rand.choice(letters)}{rand.randint(0, 9)}',
+            'phone': phone,
+            'email': email,
+            'email_consent': rand.random() < 0.4,
+            'year_of_birth': rand.randint(1940, 2015) if rand.random() < 0.5 else None,
+        }
+
+CLIENT_QUERIES = [
+    'tremblay', 'marie tremblay', 'jean roy', 'gagnon', 'cote',
+    'st-pierre', 'nguyen', 'helene lev', 'sebastien', 'whooper',
+    'degrafenreid', 'jimmy', 'bouchard julie', 'tremblya',
+]
+
+def paid_workorders(nb, items, tax_rates, end, days=3 * 365, seed=1337):
+    """`nb` workorders paid during the `days` before `end`, as
+    (Workorder columns, [WorkorderItem columns]) tuples in payment order
+
+    `items` are the InventoryItem columns with their id, `tax_rates`
+    the two rates as strings"""
+    rand = random.Random(seed)
+    start = end - datetime.timedelta(days=days)
+    seconds = sorted(rand.randrange(days * 24 * 3600) for _ in range(nb))
+
+    for i, second in enumerate(seconds):
+        # The busy days, a few workorders are paid on the same second
+        if i and rand.random() < 0.01:
+            second = seconds[i - 1]
+
+        paid_date = start + datetime.timedelta(seconds=second)
+        lines = []
+        subtotal = 0
+
+        for item in rand.sample(items, rand.randint(1, 6)):
+            nb_items = rand.choice(['1', '1', '1', '2', '4', '0.5'])
+            price = money.to_decimal(money.to_units(item['price']))
+
+            # Discounts and donations
+            if rand.random() < 0.1:
+                price = money.to_decimal(money.to_units(price * Decimal(rand.choice(['0.5', '0.8', '0.9', '1.1']))))
+
+            subtotal += money.line_subtotal(nb_items, price)
+
+            lines.append({
+                'inventory_item': item['id'],
+                'name': item['name'],
+                'nb': nb_items,
+                'price': price,
+                'orig_price': money.to_decimal(money.to_units(item['price'])),
+            })
+
+        taxes1, taxes2 = [money.taxes(subtotal, rate) for rate in tax_rates]
+        subtotal = money.rescale(subtotal, money.LINE_PLACES)
+
+        yield {
+            'created': paid_date - datetime.timedelta(days=rand.randint(0, 10)),
+            'paid_date': paid_date,
+            'paid_subtotal': money.to_decimal(subtotal),
+            'paid_tax1_rate': tax_rates[0],
+            'paid_tax2_rate': tax_rates[1],
+            'paid_taxes1': money.to_decimal(taxes1),
+            'paid_taxes2': money.to_decimal(taxes2),
+            'paid_total': money.to_decimal(subtotal + taxes1 + taxes2),
+        }, lines
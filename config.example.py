@@ -48,7 +48,3 @@ DATABASE = {
 }
 
 DEBUG = False
-
-# To get fuzzy strings search, ex.: Josca -> Joska, add the
-# `spellfix.so` extension to the project root and set this to True
-use_spellfix = False
@@ -12,6 +12,12 @@ def create_db(import_data=False):
     Client.add_index(peewee.SQL('CREATE INDEX client_idx_last_name ON client(last_name COLLATE NOCASE)'))
 
     Client.create_table()
+    create_fts_index(Client, ClientIndex)
+    create_search_keys(Client)
+    create_postal_fsa()
+
+    ClientKey.create_table()
+    create_client_keys()
 
     if import_data:
         import_clients()
@@ -37,9 +43,13 @@ def create_db(import_data=False):
                    Client.internal_notes,
                    Client.membership_paid_until)).execute()
 
+    create_tax_classes()
+
     InventoryItem.add_index(peewee.SQL('CREATE INDEX inventoryitem_idx_name ON inventoryitem(name COLLATE NOCASE)'))
 
     InventoryItem.create_table()
+    create_fts_index(InventoryItem, InventoryItemIndex)
+    create_search_keys(InventoryItem)
 
     if import_data:
         import_inventory_items()
@@ -124,6 +134,17 @@ def create_db(import_data=False):
                    WorkorderItem.name, WorkorderItem.price,
                    WorkorderItem.orig_price)).execute()
 
+    create_refund_state()
+    create_workorder_version()
+    create_tax_rates_lock()
+
+    SalesLedger.create_table()
+    create_sales_ledger()
+    SalesLedgerVersion.create_table()
+    create_sales_ledger_version()
+
+    ReportJob.create_table()
+
     CashRegisterState.create_table()
     CashRegisterState.insert(
         expected_cash=Decimal('0.00'),
@@ -135,6 +156,358 @@ def create_db(import_data=False):
         comment='Database created',
     ).execute()
 
+    # A new database already has everything the migrations would add
+    from migrate_db import MIGRATIONS, set_schema_version
+    set_schema_version(len(MIGRATIONS))
+
+def run_sql(sql, params=None):
+    """Executes a statement and waits for its result. SqliteQueueDatabase
+    only queues the writes, errors would go unnoticed otherwise"""
+    return db.database.execute_sql(sql, params).fetchall()
+
+def create_tax_classes():
+    """Creates the TaxClass table with the classes used by items
+    without a class"""
+    TaxClass.create_table()
+    TaxClass.insert_many([
+        (TaxClass.STANDARD, 'Standard', None, None),
+        (TaxClass.EXEMPT, 'Exempt', 0, 0),
+    ], fields=(TaxClass.id, TaxClass.name, TaxClass.tax1_rate, TaxClass.tax2_rate)).execute()
+
+def create_search_keys(model):
+    """Creates the triggers that fill the normalized search columns of
+    `model` (see `model.search_keys`), then fills them for the existing
+    rows
+
+    The triggers call search_key(), a Python function : the writes to
+    `model` fail on the connections that didn't register it (see
+    `setup_app.SQL_FUNCTIONS`)"""
+
+    table = model._meta.table_name
+    pk = model._meta.primary_key.column_name
+
+    sources = ', '.join(model.search_keys.values())
+    new_values = ', '.join(f'{key} = search_key(new.{source})' for key, source in model.search_keys.items())
+    values = ', '.join(f'{key} = search_key({source})' for key, source in model.search_keys.items())
+
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_search_keys_after_insert AFTER INSERT ON {table} BEGIN
+        UPDATE {table} SET {new_values} WHERE {pk} = new.{pk};
+    END''')
+
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_search_keys_after_update AFTER UPDATE OF {sources} ON {table} BEGIN
+        UPDATE {table} SET {new_values} WHERE {pk} = new.{pk};
+    END''')
+
+    run_sql(f'UPDATE {table} SET {values}')
+
+def create_postal_fsa():
+    """Creates the triggers that fill `Client.postal_fsa`, then fills
+    it for the existing clients"""
+
+    table = Client._meta.table_name
+    fsa = 'UPPER(SUBSTR(TRIM({}postal_code), 1, 3))'
+
+    for event in ('INSERT', 'UPDATE OF postal_code'):
+        run_sql(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_postal_fsa_after_{event.split()[0].lower()} AFTER {event} ON {table} BEGIN
+            UPDATE {table} SET postal_fsa = {fsa.format('new.')} WHERE id = new.id;
+        END''')
+
+    run_sql(f"UPDATE {table} SET postal_fsa = {fsa.format('')}")
+
+def create_client_keys():
+    """Creates the triggers that maintain the ClientKey table, then
+    computes the keys of the existing clients
+
+    The triggers call phone_key(), email_key() and name_key(), Python
+    functions : the writes to the clients fail on the connections that
+    didn't register them (see `setup_app.SQL_FUNCTIONS`)"""
+
+    table = Client._meta.table_name
+    keys = ClientKey._meta.table_name
+
+    def select_keys(row, kinds, source=''):
+        """Non-empty keys of the client `row` (new, old or the table)"""
+        selects = ' UNION ALL '.join(
+            f"SELECT {row}.id AS client_id, '{kind}' AS kind, "
+            f"{func}({', '.join(row + '.' + col for col in cols)}) AS key {source}"
+            for kind, (func, cols) in kinds.items())
+
+        return f"SELECT client_id, kind, key, 0 FROM ({selects}) WHERE key != ''"
+
+    # A key is a duplicate when other clients have it too. The COUNT
+    # doesn't depend on the updated row, it's only computed once, and
+    # only the rows where the flag changes are written
+    for event, row in (('INSERT', 'new'), ('DELETE', 'old')):
+        run_sql(f'''
+        CREATE TRIGGER IF NOT EXISTS {keys}_after_{event.lower()} AFTER {event} ON {keys} BEGIN
+            UPDATE {keys} SET duplicate = NOT duplicate
+            WHERE kind = {row}.kind AND key = {row}.key
+              AND duplicate != (SELECT COUNT(*) > 1 FROM {keys} WHERE kind = {row}.kind AND key = {row}.key);
+        END''')
+
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_keys_after_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {keys}(client_id, kind, key, duplicate) {select_keys('new', ClientKey.kinds)};
+    END''')
+
+    for kind, (func, cols) in ClientKey.kinds.items():
+        run_sql(f'''
+        CREATE TRIGGER IF NOT EXISTS {table}_{kind}_key_after_update AFTER UPDATE OF {', '.join(cols)} ON {table} BEGIN
+            DELETE FROM {keys} WHERE client_id = old.id AND kind = '{kind}';
+            INSERT INTO {keys}(client_id, kind, key, duplicate) {select_keys('new', {kind: (func, cols)})};
+        END''')
+
+    # Deleted clients : ON DELETE CASCADE
+
+    run_sql(f'DELETE FROM {keys}')
+    run_sql(f'INSERT INTO {keys}(client_id, kind, key, duplicate) '
+            f'{select_keys(table, ClientKey.kinds, source="FROM " + table)}')
+
+def insert_sales_ledger(where):
+    """Adds the paid workorders matching the SQL condition `where` (on
+    the workorder `w`) to the SalesLedger"""
+
+    ledger = SalesLedger._meta.table_name
+    key = 'day, payment_method, taxable, item_type'
+
+    # SUM(x) OVER wo - x is the sum of the other rows of the workorder
+    def remainder(paid, share):
+        return f'CASE WHEN rank = 1 THEN ROUND({paid} - SUM({share}) OVER wo + {share}, 2) ELSE {share} END'
+
+    def tax_share(paid):
+        return (f'CASE WHEN taxable THEN COALESCE(ROUND({paid} * subtotal / '
+                f'NULLIF(SUM(taxable * subtotal) OVER wo, 0), 2), 0) ELSE 0 END')
+
+    def units(column, places):
+        return f'CAST(ROUND({column} * {10 ** places}) AS INTEGER)'
+
+    # money.div_round() of units of 10**-LINE_PLACES to cents
+    def cents(line_units):
+        denominator = 10 ** (money.LINE_PLACES - money.CENTS)
+        return (f'(CASE WHEN {line_units} >= 0 THEN ({line_units} + {denominator // 2}) / {denominator} '
+                f'ELSE ({line_units} - {denominator // 2}) / {denominator} END)')
+
+    # Exact, in units of 10**-LINE_PLACES (see `money.py`)
+    discount_units = (f'CASE WHEN i.price < i.orig_price THEN {units("i.nb", money.NB_PLACES)} * '
+                      f'({units("i.orig_price", money.PRICE_PLACES)} - {units("i.price", money.PRICE_PLACES)}) '
+                      f'ELSE 0 END')
+
+    # Workorders without items have a single empty row, to be counted
+    lines = f'''
+    SELECT w.id AS workorder_id, DATE(w.paid_date) AS day,
+           COALESCE((SELECT t.payment_method FROM "{Transaction._meta.table_name}" AS t
+                     WHERE t.workorder_id = w.id ORDER BY t.id LIMIT 1), '') AS payment_method,
+           COALESCE(i.taxable, 1) AS taxable, COALESCE(ii.type, '') AS item_type,
+           w.paid_subtotal AS paid_subtotal, w.paid_taxes1 AS paid_taxes1, w.paid_taxes2 AS paid_taxes2,
+           w.paid_total AS paid_total,
+           COALESCE(SUM(i.nb), 0) AS nb_items, COALESCE(SUM(i.nb * i.price), 0) AS subtotal,
+           COALESCE(SUM({discount_units}), 0) AS discount_units
+    FROM {Workorder._meta.table_name} AS w
+    LEFT JOIN {WorkorderItem._meta.table_name} AS i ON i.workorder_id = w.id
+    LEFT JOIN {InventoryItem._meta.table_name} AS ii ON ii.id = i.inventory_item_id
+    WHERE w.paid_date IS NOT NULL AND ({where})
+    GROUP BY w.id, i.taxable, item_type'''
+
+    # The rounding remainders go to the largest taxable row, which also
+    # counts the workorder
+    shares = f'''
+    SELECT *, ROUND(subtotal, 2) AS subtotal_share,
+           {tax_share('paid_taxes1')} AS taxes1_share,
+           {tax_share('paid_taxes2')} AS taxes2_share,
+           {cents('discount_units')} AS discounts_share,
+           ROW_NUMBER() OVER (wo ORDER BY taxable DESC, ABS(subtotal) DESC, item_type) AS rank
+    FROM ({lines}) WINDOW wo AS (PARTITION BY workorder_id)'''
+
+    # Discounts are rounded per workorder, like Workorder.total_discounts()
+    discounts = (f'CASE WHEN rank = 1 THEN {cents("SUM(discount_units) OVER wo")} - '
+                 f'SUM(discounts_share) OVER wo + discounts_share ELSE discounts_share END')
+
+    rows = f'''
+    SELECT {key}, CASE WHEN rank = 1 THEN 1 ELSE 0 END AS nb_workorders, nb_items,
+           ({discounts}) / {10 ** money.CENTS}.0 AS discounts,
+           {remainder('paid_subtotal', 'subtotal_share')} AS subtotal,
+           {remainder('paid_taxes1', 'taxes1_share')} AS taxes1,
+           {remainder('paid_taxes2', 'taxes2_share')} AS taxes2,
+           {remainder('paid_total', '(subtotal_share + taxes1_share + taxes2_share)')} AS total
+    FROM ({shares}) WINDOW wo AS (PARTITION BY workorder_id)'''
+
+    amounts = SalesLedger.amounts
+    sums = ', '.join(f'ROUND(SUM({col}), 2)' for col in amounts)
+    updates = ', '.join(f'{col} = ROUND({col} + excluded.{col}, 2)' for col in amounts)
+
+    # WHERE true : the ON CONFLICT would be parsed as a join constraint
+    return f'''
+    INSERT INTO {ledger}({key}, {', '.join(amounts)})
+    SELECT {key}, {sums} FROM ({rows}) WHERE true GROUP BY {key}
+    ON CONFLICT({key}) DO UPDATE SET {updates}'''
+
+def create_sales_ledger():
+    """Creates the trigger that adds the workorders to the SalesLedger
+    when they are paid, then fills it"""
+
+    table = Workorder._meta.table_name
+
+    # The workorder items and the transaction are created before the
+    # workorder is marked as paid (see `views.pay_workorder()`)
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_sales_ledger_after_paid AFTER UPDATE OF paid_date ON {table}
+    WHEN old.paid_date IS NULL AND new.paid_date IS NOT NULL BEGIN
+        {insert_sales_ledger('w.id = new.id')};
+    END''')
+
+    rebuild_sales_ledger()
+
+def rebuild_sales_ledger():
+    run_sql(f'DELETE FROM {SalesLedger._meta.table_name}')
+    run_sql(insert_sales_ledger('1'))
+
+def create_sales_ledger_version():
+    """Creates the triggers that bump the SalesLedgerVersion when the
+    ledger of a closed day changes. The days are local, like
+    `DATE(paid_date)`"""
+
+    ledger = SalesLedger._meta.table_name
+    bump = f'UPDATE {SalesLedgerVersion._meta.table_name} SET version = version + 1'
+    closed = "{}.day < DATE('now', 'localtime')"
+
+    if not SalesLedgerVersion.select().exists():
+        SalesLedgerVersion.insert(version=0).execute()
+
+    for event, when in [('INSERT', closed.format('new')),
+                        ('UPDATE', f"{closed.format('old')} OR {closed.format('new')}"),
+                        ('DELETE', closed.format('old'))]:
+        run_sql(f'''
+        CREATE TRIGGER IF NOT EXISTS {ledger}_version_after_{event.lower()} AFTER {event} ON {ledger}
+        WHEN {when} BEGIN
+            {bump};
+        END''')
+
+def create_refund_state():
+    """Creates the triggers that maintain `Workorder.refunded_items` and
+    `Workorder.refunded`, then computes them for the existing
+    workorders"""
+
+    table = Workorder._meta.table_name
+    items = WorkorderItem._meta.table_name
+
+    # Items that are refunds or have been refunded. Uses the index on
+    # refund_item_id
+    refunded_items = f'''
+    (SELECT COUNT(*) FROM {items} AS i WHERE i.workorder_id = {table}.id AND
+        (i.refund_item_id IS NOT NULL OR EXISTS (SELECT 1 FROM {items} AS r WHERE r.refund_item_id = i.id)))'''
+
+    def update_refund_state(where):
+        return f'''
+        UPDATE {table} SET refunded_items = {refunded_items},
+                           refunded = {refunded_items} = (SELECT COUNT(*) FROM {items} AS i WHERE i.workorder_id = {table}.id)
+        WHERE {where}'''
+
+    # The workorder of the item and the workorder of the refunded item
+    for event, row in (('INSERT', 'new'), ('DELETE', 'old')):
+        run_sql(f'''
+        CREATE TRIGGER IF NOT EXISTS {items}_refund_state_after_{event.lower()} AFTER {event} ON {items} BEGIN
+            {update_refund_state(f"id = {row}.workorder_id OR "
+                                 f"id IN (SELECT workorder_id FROM {items} WHERE id = {row}.refund_item_id)")};
+        END''')
+
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {items}_refund_state_after_update AFTER UPDATE OF workorder_id, refund_item_id ON {items} BEGIN
+        {update_refund_state(f"id IN (old.workorder_id, new.workorder_id) OR "
+                             f"id IN (SELECT workorder_id FROM {items} WHERE id IN (old.refund_item_id, new.refund_item_id))")};
+    END''')
+
+    run_sql(update_refund_state('1'))
+
+def create_workorder_version():
+    """Creates the triggers that bump `Workorder.version` when the
+    workorder, its items or a tax rate it uses change"""
+
+    table = Workorder._meta.table_name
+    items = WorkorderItem._meta.table_name
+    tax_classes = TaxClass._meta.table_name
+
+    def bump(where):
+        return f'UPDATE {table} SET version = version + 1 WHERE {where}'
+
+    # Not when the version itself was just bumped by another trigger
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {table}_version_after_update AFTER UPDATE ON {table}
+    WHEN new.version = old.version BEGIN
+        {bump('id = new.id')};
+    END''')
+
+    for event, rows in (('INSERT', ['new']), ('DELETE', ['old']), ('UPDATE', ['old', 'new'])):
+        workorders = ', '.join(f'{row}.workorder_id' for row in rows)
+        run_sql(f'''
+        CREATE TRIGGER IF NOT EXISTS {items}_version_after_{event.lower()} AFTER {event} ON {items} BEGIN
+            {bump(f"id IN ({workorders})")};
+        END''')
+
+    # Paid workorders use their archived rates
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {tax_classes}_version_after_update AFTER UPDATE ON {tax_classes} BEGIN
+        {bump('paid_date IS NULL')};
+    END''')
+
+def create_tax_rates_lock():
+    """Creates the trigger that refuses to change the rates of a tax
+    class used by items of paid workorders : the reports recompute
+    their taxes per class with the current rates of the classes (see
+    `TaxClass.breakdown()`)"""
+
+    table = Workorder._meta.table_name
+    items = WorkorderItem._meta.table_name
+    tax_classes = TaxClass._meta.table_name
+
+    # Same as TaxClass.id_of_sql()
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {tax_classes}_rates_before_update BEFORE UPDATE OF tax1_rate, tax2_rate ON {tax_classes}
+    WHEN (new.tax1_rate IS NOT old.tax1_rate OR new.tax2_rate IS NOT old.tax2_rate) AND EXISTS (
+        SELECT 1 FROM {items} JOIN {table} ON {table}.id = {items}.workorder_id
+        WHERE {table}.paid_date IS NOT NULL AND
+              CASE WHEN NOT {items}.taxable THEN {TaxClass.EXEMPT}
+                   ELSE COALESCE({items}.tax_class_id, {TaxClass.STANDARD}) END = old.id
+    ) BEGIN
+        SELECT RAISE(ABORT, 'The rates of a tax class with paid items can not change');
+    END''')
+
+def create_fts_index(model, index):
+    """Creates the full-text `index` of `model` with the triggers that
+    keep it in sync, then indexes the existing rows"""
+
+    table = model._meta.table_name
+    fts = index._meta.table_name
+    pk = model._meta.primary_key.column_name
+    columns = [field.column_name for field in index._meta.sorted_fields if field.name != 'rowid']
+
+    cols = ', '.join(columns)
+    new_values = ', '.join('new.' + col for col in columns)
+    old_values = ', '.join('old.' + col for col in columns)
+
+    index.create_table()
+
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {fts}_after_insert AFTER INSERT ON {table} BEGIN
+        INSERT INTO {fts}(rowid, {cols}) VALUES (new.{pk}, {new_values});
+    END''')
+
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {fts}_after_delete AFTER DELETE ON {table} BEGIN
+        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{pk}, {old_values});
+    END''')
+
+    # Only when an indexed column changes
+    run_sql(f'''
+    CREATE TRIGGER IF NOT EXISTS {fts}_after_update AFTER UPDATE OF {cols} ON {table} BEGIN
+        INSERT INTO {fts}({fts}, rowid, {cols}) VALUES ('delete', old.{pk}, {old_values});
+        INSERT INTO {fts}(rowid, {cols}) VALUES (new.{pk}, {new_values});
+    END''')
+
+    run_sql(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
+
 
 
 
@@ -0,0 +1,81 @@
+-- Database created by create_db() before the first migration (schema
+-- version 0), with its test data. Upgraded by test_migrate_db
+BEGIN TRANSACTION;
+CREATE TABLE "cashregisterstate" ("id" INTEGER NOT NULL PRIMARY KEY, "expected_cash" DECIMAL(15, 2) NOT NULL, "expected_visa" DECIMAL(15, 2) NOT NULL, "expected_interac" DECIMAL(15, 2) NOT NULL, "confirmed_cash" DECIMAL(15, 2) NOT NULL, "confirmed_visa" DECIMAL(15, 2) NOT NULL, "confirmed_interac" DECIMAL(15, 2) NOT NULL, "comment" TEXT, "state_time" DATETIME NOT NULL);
+INSERT INTO "cashregisterstate" VALUES(1,0,0,0,0,0,0,'Database created','2026-10-18 17:01:24.648385');
+CREATE TABLE "client" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "first_name" TEXT NOT NULL, "last_name" TEXT NOT NULL, "address" TEXT NOT NULL, "postal_code" TEXT NOT NULL, "phone" TEXT NOT NULL, "email" TEXT NOT NULL, "email_consent" INTEGER NOT NULL, "year_of_birth" INTEGER, "internal_notes" TEXT NOT NULL, "membership_paid_until" DATETIME, "created" DATETIME NOT NULL, "updated" DATETIME NOT NULL, "archived" INTEGER NOT NULL);
+INSERT INTO "client" VALUES(1,'Jimmy','Whooper','123 rue Jarry','H2R 1M8','514 222 3333','jimmy@example.com',1,NULL,'',NULL,'2026-10-18 17:01:24.613058','2026-10-18 17:01:24.613100',0);
+INSERT INTO "client" VALUES(2,'Alice','Whooper','123 rue Jarry','H2R 1M8','514 222 3333','alice@example.com',0,NULL,'','2021-12-25 00:00:00','2026-10-18 17:01:24.613347','2026-10-18 17:01:24.613356',0);
+INSERT INTO "client" VALUES(3,'Theresa','Horton','123 rue Jarry','H2R 1M8','514 222 3333','theresa@example.com',0,NULL,'','2020-01-01 00:00:00','2026-10-18 17:01:24.613376','2026-10-18 17:01:24.613379',0);
+INSERT INTO "client" VALUES(4,'Robert','Tackitt','123 rue Jarry','H2R 1M8','514 222 3333','robert@example.com',0,NULL,'','2022-12-25 00:00:00','2026-10-18 17:01:24.613394','2026-10-18 17:01:24.613397',0);
+INSERT INTO "client" VALUES(5,'Helen','Nathan','123 rue Jarry','H2R 1M8','514 222 3333','helen@example.com',0,NULL,'','2021-09-25 00:00:00','2026-10-18 17:01:24.613411','2026-10-18 17:01:24.613414',0);
+INSERT INTO "client" VALUES(6,'Robin','Graves','123 rue Jarry','H2R 1M8','514 222 3333','robin@example.com',0,NULL,'','2021-12-25 00:00:00','2026-10-18 17:01:24.613428','2026-10-18 17:01:24.613431',0);
+INSERT INTO "client" VALUES(7,'Carolyn','Degraffenreid','123 rue Jarry','H2R 1M8','514 222 3333','carolyn@example.com',0,NULL,'','2021-12-25 00:00:00','2026-10-18 17:01:24.613447','2026-10-18 17:01:24.613451',0);
+INSERT INTO "client" VALUES(8,'Katelyn','Anderson','123 rue Jarry','H2R 1M8','514 222 3333','katelyn@example.com',0,NULL,'','2021-12-25 00:00:00','2026-10-18 17:01:24.613466','2026-10-18 17:01:24.613469',0);
+INSERT INTO "client" VALUES(9,'Louise','Howard','123 rue Jarry','H2R 1M8','514 222 3333','louise@example.com',0,NULL,'','2021-12-25 00:00:00','2026-10-18 17:01:24.613485','2026-10-18 17:01:24.613489',0);
+CREATE TABLE "inventoryitem" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "name" TEXT NOT NULL, "keywords" TEXT NOT NULL, "category" TEXT NOT NULL, "subcategory" TEXT NOT NULL, "ean_code" TEXT NOT NULL, "upc_code" TEXT NOT NULL, "sku_code" TEXT NOT NULL, "price" DECIMAL(15, 2) NOT NULL, "cost" DECIMAL(15, 2) NOT NULL, "msrp" DECIMAL(15, 2) NOT NULL, "taxable" INTEGER NOT NULL, "discountable" INTEGER NOT NULL, "avg_time_spent" INTEGER NOT NULL, "quick_add" INTEGER NOT NULL, "special_meaning" TEXT NOT NULL, "type" TEXT NOT NULL CHECK("type" IN ('labor', 'article', 'other')), "inventory_count" INTEGER NOT NULL, "archived" INTEGER NOT NULL);
+INSERT INTO "inventoryitem" VALUES(1,'Abonnement DIY','membership abonnement annuel membre diy atelier','','','','','',24,0,0,1,1,0,1,'membership','article',0,0);
+INSERT INTO "inventoryitem" VALUES(2,'Mise au point standard','mapbb checkup','','','','','',45,0,0,1,1,45,1,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(3,'Mise au point avancée','checkup complet','','','','','',75,0,0,1,1,90,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(4,'Mise au point hiver standard','checkup','','','','','',95,0,0,1,1,80,1,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(5,'Mise au point hiver avancée','checkup complet','','','','','',145,0,0,1,1,120,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(6,'Chambre à air + Installation','flat crevaison pneu crevé','','','','','',12,0,0,1,1,10,1,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(7,'Chambre à air','flat crevaison pneu crevé','','','','','',6,0,0,1,1,0,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(8,'Heure Atelier DIY','self-service','','','','','',1,0,0,1,1,0,1,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(9,'Pneu usagé','used tire','','','','','',24,0,0,1,1,0,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(10,'Pneu usagé (hiver)','used tire winter','','','','','',35,0,0,1,1,0,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(11,'Patins de freins usagé','','','','','','',8,0,0,1,1,0,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(12,'Patins de freins neufs','','','','','','',16,0,0,1,1,0,0,'','article',0,0);
+INSERT INTO "inventoryitem" VALUES(13,'Don','donate donation','','','','','',10,0,0,0,1,0,1,'donation','article',0,0);
+CREATE TABLE "role" ("id" INTEGER NOT NULL PRIMARY KEY, "name" VARCHAR(255) NOT NULL, "description" TEXT, "permissions" TEXT);
+CREATE TABLE "transaction" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "amount" DECIMAL(15, 2) NOT NULL, "payment_method" TEXT NOT NULL CHECK(payment_method IN ('cash', 'interac', 'visa', 'check', 'credit account')), "workorder_id" INTEGER, "comment" TEXT 
+                               CHECK((comment IS NULL) == (workorder_id IS NOT NULL))
+                               , "created" DATETIME NOT NULL, FOREIGN KEY ("workorder_id") REFERENCES "workorder" ("id"));
+INSERT INTO "transaction" VALUES(1,141.41,'interac',1,NULL,'2021-07-01 00:00:00');
+CREATE TABLE "user" ("id" INTEGER NOT NULL PRIMARY KEY, "email" TEXT NOT NULL, "password" TEXT NOT NULL, "active" INTEGER NOT NULL, "fs_uniquifier" TEXT NOT NULL, "confirmed_at" DATETIME);
+CREATE TABLE "userroles" ("id" INTEGER NOT NULL PRIMARY KEY, "user_id" INTEGER NOT NULL, "role_id" INTEGER NOT NULL, FOREIGN KEY ("user_id") REFERENCES "user" ("id"), FOREIGN KEY ("role_id") REFERENCES "role" ("id"));
+CREATE TABLE "workorder" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "client_id" INTEGER, "bike_description" TEXT NOT NULL, "bike_serial_number" TEXT NOT NULL, "calendar_date" DATETIME NOT NULL, "status_id" INTEGER NOT NULL, "invoice_notes" TEXT NOT NULL, "internal_notes" TEXT NOT NULL, "created" DATETIME NOT NULL, "updated" DATETIME NOT NULL, "archived" INTEGER NOT NULL, "paid_subtotal" DECIMAL(15, 2), "paid_tax1_rate" DECIMAL(15, 8), "paid_tax2_rate" DECIMAL(15, 8), "paid_taxes1" DECIMAL(15, 2), "paid_taxes2" DECIMAL(15, 2), "paid_total" DECIMAL(15, 2), "paid_date" DATETIME CHECK(
+        ("paid_date" IS NULL) == ("paid_subtotal" IS NULL) AND
+        ("paid_date" IS NULL) == ("paid_tax1_rate" IS NULL) AND
+        ("paid_date" IS NULL) == ("paid_tax2_rate" IS NULL) AND
+        ("paid_date" IS NULL) == ("paid_taxes1" IS NULL) AND
+        ("paid_date" IS NULL) == ("paid_taxes2" IS NULL) AND
+        ("paid_date" IS NULL) == ("paid_total" IS NULL)
+        ), FOREIGN KEY ("client_id") REFERENCES "client" ("id") ON DELETE RESTRICT, FOREIGN KEY ("status_id") REFERENCES "workorderstatus" ("id"));
+INSERT INTO "workorder" VALUES(1,1,'Nakamura red','','2026-10-18 17:01:24.641307',1,'Basic tuneup','Internal notes here','2021-07-01 00:00:00','2026-10-18 17:01:24.641316',0,123,0.05,0.09975,6.15,12.26,141.41,'2021-07-08 00:00:00');
+INSERT INTO "workorder" VALUES(2,1,'Big fatbike','','2026-10-18 17:01:24.642338',1,'Winter tuneup','Winter Tuneup
+I already checked the chain, all seems good
+Still waiting for bearings to ship','2026-10-18 17:01:24.642348','2026-10-18 17:01:24.642352',0,NULL,NULL,NULL,NULL,NULL,NULL,NULL);
+INSERT INTO "workorder" VALUES(3,2,'Red Spider-man kids bike','','2026-10-18 17:01:24.642368',1,'Remove training wheels','','2026-10-18 17:01:24.642375','2026-10-18 17:01:24.642378',0,NULL,NULL,NULL,NULL,NULL,NULL,NULL);
+CREATE TABLE "workorderitem" ("id" INTEGER NOT NULL PRIMARY KEY AUTOINCREMENT, "workorder_id" INTEGER NOT NULL, "inventory_item_id" INTEGER, "name" TEXT NOT NULL, "nb" DECIMAL(15, 2) NOT NULL, "price" DECIMAL(15, 3) NOT NULL, "orig_price" DECIMAL(15, 2) NOT NULL, "taxable" INTEGER NOT NULL, "refund_item_id" INTEGER, FOREIGN KEY ("workorder_id") REFERENCES "workorder" ("id") ON DELETE RESTRICT, FOREIGN KEY ("inventory_item_id") REFERENCES "inventoryitem" ("id") ON DELETE RESTRICT, FOREIGN KEY ("refund_item_id") REFERENCES "workorderitem" ("id") ON DELETE RESTRICT);
+INSERT INTO "workorderitem" VALUES(1,1,1,'Abonnement DIY',1,24,24,1,NULL);
+INSERT INTO "workorderitem" VALUES(2,1,3,'Mise au point avancée',1,75,75,1,NULL);
+INSERT INTO "workorderitem" VALUES(3,1,9,'Pneu usagé',1,24,24,1,NULL);
+CREATE TABLE "workorderstatus" ("id" INTEGER NOT NULL PRIMARY KEY, "name" TEXT NOT NULL, "color" TEXT NOT NULL, "display_order" INTEGER, "archived" INTEGER NOT NULL);
+INSERT INTO "workorderstatus" VALUES(1,'Open','#0D6EFD',0,0);
+INSERT INTO "workorderstatus" VALUES(2,'RDV MAP','#8DB6D7',1,0);
+INSERT INTO "workorderstatus" VALUES(3,'En cours','#0D6EFD',2,0);
+INSERT INTO "workorderstatus" VALUES(4,'À évaluer','#fc00c9',3,0);
+INSERT INTO "workorderstatus" VALUES(5,'Approuvé','#ae00ff',4,0);
+INSERT INTO "workorderstatus" VALUES(6,'RDV Pickup','#8DB6D7',5,0);
+INSERT INTO "workorderstatus" VALUES(7,'Done','#636363',6,0);
+INSERT INTO "workorderstatus" VALUES(8,'À vendre','#8DB6D7',7,0);
+CREATE UNIQUE INDEX "role_name" ON "role" ("name");
+CREATE INDEX "userroles_user_id" ON "userroles" ("user_id");
+CREATE INDEX "userroles_role_id" ON "userroles" ("role_id");
+CREATE INDEX client_idx_first_name ON client(first_name COLLATE NOCASE);
+CREATE INDEX client_idx_last_name ON client(last_name COLLATE NOCASE);
+CREATE INDEX inventoryitem_idx_name ON inventoryitem(name COLLATE NOCASE);
+CREATE INDEX "workorder_client_id" ON "workorder" ("client_id");
+CREATE INDEX "workorder_status_id" ON "workorder" ("status_id");
+CREATE INDEX "workorderitem_workorder_id" ON "workorderitem" ("workorder_id");
+CREATE INDEX "workorderitem_inventory_item_id" ON "workorderitem" ("inventory_item_id");
+CREATE INDEX "workorderitem_refund_item_id" ON "workorderitem" ("refund_item_id");
+CREATE INDEX "transaction_workorder_id" ON "transaction" ("workorder_id");
+DELETE FROM "sqlite_sequence";
+INSERT INTO "sqlite_sequence" VALUES('client',9);
+INSERT INTO "sqlite_sequence" VALUES('inventoryitem',13);
+INSERT INTO "sqlite_sequence" VALUES('workorder',3);
+INSERT INTO "sqlite_sequence" VALUES('transaction',1);
+INSERT INTO "sqlite_sequence" VALUES('workorderitem',3);
+COMMIT;
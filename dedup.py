@@ -0,0 +1,73 @@
+"""Blocking keys used to find duplicate clients
+
+Two clients with the same key are duplicate candidates. The keys are
+registered as SQL functions (see `setup_app.py`) and stored in the
+`ClientKey` table by triggers (see `create_db.create_client_keys()`),
+so that finding the duplicates is an indexed read instead of comparing
+every client with every other one.
+
+Each function returns '' when there is nothing to compare.
+"""
+import re
+
+from scoring import search_key
+
+MIN_PHONE_DIGITS = 7
+
+def phone_key(phone):
+    """Digits of the phone number, without the country code :
+    "(514) 222-3333" == "1-514-222-3333" == "514 222 3333" """
+    digits = re.sub(r'[^0-9]', '', phone or '')
+
+    if len(digits) == 11 and digits.startswith('1'):
+        digits = digits[1:]
+
+    if len(digits) < MIN_PHONE_DIGITS:
+        return ''
+
+    return digits
+
+def email_key(email):
+    email = (email or '').strip().lower()
+
+    if '@' not in email:
+        return ''
+
+    return email
+
+SOUNDEX_CODES = {c: str(code)
+                 for code, letters in enumerate(['aeiouyhw', 'bfpv', 'cgjkqsxz', 'dt', 'l', 'mn', 'r'])
+                 for c in letters}
+
+def soundex(word):
+    """American Soundex of a word : "Robert" == "Rupert" == "R163" """
+    word = re.sub(r'[^a-z]', '', search_key(word))
+
+    if not word:
+        return ''
+
+    key = word[0].upper()
+    last = SOUNDEX_CODES[word[0]]
+
+    for c in word[1:]:
+        code = SOUNDEX_CODES[c]
+
+        if code != '0' and code != last:
+            key += code
+
+        # H and W don't separate letters with the same code, vowels do
+        if c not in 'hw':
+            last = code
+
+    return (key + '000')[:4]
+
+def name_key(first_name, last_name):
+    """Phonetic key of the full name : "Caroline Degrafenreid" ==
+    "Carolyn Degraffenreid". Only for clients with a full name"""
+    first_name = soundex(first_name or '')
+    last_name = soundex(last_name or '')
+
+    if not first_name or not last_name:
+        return ''
+
+    return first_name + ' ' + last_name
@@ -0,0 +1,161 @@
+"""Streaming accounting export of the sales
+
+Walks the paid workorders in payment order, in chunks, with the items
+and the transactions of each chunk, and writes them as CSV or JSON
+Lines. Only one chunk is in memory at a time, whatever the size of the
+export.
+
+Each record has a `record` kind ('workorder', 'item' or 'transaction'),
+the items and transactions of a workorder directly follow it. The CSV
+has the union of the columns, empty when they don't apply to the kind.
+
+For incremental pulls, keep the cursor of the last exported workorder
+(see `cursor_token()`) and pass it as `since` the next time. The
+cursor is its (paid_date, id) : ids are assigned when a workorder is
+opened, one opened before an export and paid after it has a lower id
+than the last exported one.
+"""
+import csv
+import datetime
+import io
+import json
+from decimal import Decimal
+
+import peewee
+
+from models import Workorder, WorkorderItem, Transaction
+
+# Columns exported for each kind of record
+FIELDS = {
+    'workorder': [Workorder.id, Workorder.client, Workorder.paid_date, Workorder.paid_subtotal,
+                  Workorder.paid_tax1_rate, Workorder.paid_tax2_rate, Workorder.paid_taxes1,
+                  Workorder.paid_taxes2, Workorder.paid_total],
+    'item': [WorkorderItem.id, WorkorderItem.workorder, WorkorderItem.inventory_item, WorkorderItem.name,
+             WorkorderItem.nb, WorkorderItem.price, WorkorderItem.orig_price, WorkorderItem.taxable,
+             WorkorderItem.tax_class, WorkorderItem.refund_item],
+    'transaction': [Transaction.id, Transaction.workorder_id, Transaction.created, Transaction.payment_method,
+                    Transaction.amount, Transaction.comment],
+}
+
+def columns(kind):
+    return [field.column_name for field in FIELDS[kind]]
+
+# All the CSV columns, in order
+CSV_COLUMNS = ['record'] + list(dict.fromkeys(col for kind in FIELDS for col in columns(kind)))
+
+CHUNK_SIZE = 500
+
+def cursor_token(cursor):
+    """'<paid_date>,<id>' of a (paid_date, id) cursor"""
+    paid_date, workorder_id = cursor
+    return f'{paid_date.isoformat()},{workorder_id}'
+
+def parse_cursor(token):
+    """(paid_date, id) of a cursor token, raises ValueError if invalid"""
+    paid_date, workorder_id = token.rsplit(',', 1)
+    return datetime.datetime.fromisoformat(paid_date), int(workorder_id)
+
+def after(cursor):
+    """Condition of the workorders paid after a (paid_date, id) cursor"""
+    paid_date, workorder_id = cursor
+    return (Workorder.paid_date > paid_date) | ((Workorder.paid_date == paid_date) & (Workorder.id > workorder_id))
+
+def paid_between(date_start=None, date_end=None):
+    where = Workorder.paid
+
+    if date_start is not None:
+        where &= peewee.fn.DATE(Workorder.paid_date) >= date_start
+
+    if date_end is not None:
+        where &= peewee.fn.DATE(Workorder.paid_date) <= date_end
+
+    return where
+
+def last_cursor(date_start=None, date_end=None):
+    """(paid_date, id) of the last workorder paid between two dates, None
+    if there is none"""
+    return Workorder.select(Workorder.paid_date, Workorder.id) \
+                    .where(paid_between(date_start, date_end)) \
+                    .order_by(Workorder.paid_date.desc(), Workorder.id.desc()) \
+                    .tuples().first()
+
+def export_records(date_start=None, date_end=None, since=None, until=None, chunk_size=CHUNK_SIZE):
+    """Yields (kind, row dict) for the workorders paid between two dates
+    (included, both optional), after the `since` cursor and up to the
+    `until` cursor (included, both optional)"""
+
+    where = paid_between(date_start, date_end)
+
+    if until is not None:
+        where &= ~after(until)
+
+    while True:
+        query = Workorder.select(*FIELDS['workorder']).where(where)
+
+        if since is not None:
+            query = query.where(after(since))
+
+        workorders = list(query.order_by(Workorder.paid_date, Workorder.id).limit(chunk_size).dicts())
+
+        if not workorders:
+            return
+
+        ids = [workorder['id'] for workorder in workorders]
+        children = {workorder_id: [] for workorder_id in ids}
+
+        for kind, parent in (('item', WorkorderItem.workorder), ('transaction', Transaction.workorder_id)):
+            rows = parent.model.select(*FIELDS[kind]) \
+                               .where(parent.in_(ids)) \
+                               .order_by(parent, parent.model.id) \
+                               .dicts().iterator()
+
+            for row in rows:
+                children[row[parent.name]].append((kind, row))
+
+        for workorder in workorders:
+            yield 'workorder', workorder
+            yield from children[workorder['id']]
+
+        since = (workorders[-1]['paid_date'], ids[-1])
+
+def export_value(field, value):
+    """JSON/CSV representation of a column value, amounts keep all
+    their decimals (eg.: "24.00")"""
+    if isinstance(value, Decimal):
+        return str(value.quantize(Decimal(1).scaleb(-field.decimal_places)))
+
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+
+    return value
+
+def record_values(kind, row):
+    # Foreign keys are named after the field in .dicts(), not the column
+    return {field.column_name: export_value(field, row[field.name]) for field in FIELDS[kind]}
+
+def csv_lines(records):
+    """Yields the CSV lines of the records, header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, CSV_COLUMNS)
+
+    def flush():
+        line = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return line
+
+    writer.writeheader()
+    yield flush()
+
+    for kind, row in records:
+        writer.writerow({'record': kind, **record_values(kind, row)})
+        yield flush()
+
+def jsonl_lines(records):
+    for kind, row in records:
+        yield json.dumps({'record': kind, **record_values(kind, row)}) + '\n'
+
+FORMATS = {
+    'csv': (csv_lines, 'text/csv'),
+    'jsonl': (jsonl_lines, 'application/x-ndjson'),
+}
@@ -169,6 +169,12 @@ def import_inventory_items():
     with open('migration/dump-Item.pickle', 'rb') as f:
         all_rows = []
 
+        # The scan codes are unique among the active items (see
+        # InventoryItem.scan_codes), but the manufacturer SKUs are often
+        # shared : the first item keeps the code. {name: {code: item id}}
+        scan_codes = {name: {} for name in InventoryItem.scan_codes}
+        duplicates = {name: [] for name in InventoryItem.scan_codes}
+
         all_items = pickle.load(f)
 
         for item in all_items:
@@ -226,6 +232,14 @@ def import_inventory_items():
                 if type(it[key]) == str:
                     it[key] = it[key].strip()
 
+            for name in InventoryItem.scan_codes:
+                if it[name] and not it['archived']:
+                    if it[name] in scan_codes[name]:
+                        duplicates[name].append((it[name], it['id']))
+                        it[name] = ''
+                    else:
+                        scan_codes[name][it[name]] = it['id']
+
             #type
             it['type'] = {
                 0: 'other',
@@ -253,6 +267,11 @@ def import_inventory_items():
 
             all_rows.append(this_row)
 
+        for name, codes in duplicates.items():
+            if codes:
+                print(f'WARNING: Active inventory items share the same {name}, cleared on the items :',
+                      ', '.join(f'#{item_id} ({code}, kept on #{scan_codes[name][code]})' for code, item_id in codes))
+
         InventoryItem.insert_many(all_rows, fields=(
             InventoryItem.id,
             InventoryItem.name,
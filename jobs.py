@@ -0,0 +1,130 @@
+"""Background computation of the reports
+
+The reports of long date ranges take too long for a request : they are
+computed by a small pool of threads, in the same process, and stored in
+the ReportJob table. The reports page polls `/reports/jobs/<id>` until
+the job is done, then renders the stored result.
+
+A request for the same range as a job that is still pending or running
+gets that job instead of a new one. This is per process : with many
+worker processes, each one can compute the same range once.
+
+Finished jobs are deleted after JOB_TTL. The jobs left pending or
+running by a previous process (restart, crash) are marked as failed
+when the app starts (see `app.py`), no thread would ever finish them.
+"""
+import json
+import datetime
+import threading
+import traceback
+import concurrent.futures
+
+from setup_app import db
+from models import Client, InventoryItem, Workorder, TaxClass, ReportJob
+
+MAX_WORKERS = 2
+
+# Finished jobs are kept this long, to be polled and rendered
+JOB_TTL = datetime.timedelta(days=1)
+
+# The jobs created before are not handled by this process
+STARTED = datetime.datetime.now()
+
+executor = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='report-job')
+
+# (date_start, date_end) -> (job id, future) of the jobs not done yet
+in_flight = {}
+in_flight_lock = threading.Lock()
+
+def compute_report(date_start, date_end, progress):
+    """Content of the reports page, as JSON-serializable values (the
+    amounts are strings). Calls `progress(percent)` after each step"""
+
+    postal_codes_stats = Client.postal_code_stats(top=5)
+
+    postal_codes_keys = [line['fsa'] + (' (' + line['region'] + ')' if line['region'] else '')
+                         for line in postal_codes_stats['top']]
+    postal_codes_vals = [line['nb'] for line in postal_codes_stats['top']]
+    progress(10)
+
+    items_sold = [{'name': item['name'], 'total_sold': str(item['total_sold'])}
+                  for item in InventoryItem.items_sold(date_start, date_end)]
+    progress(40)
+
+    workorder_stats = {k: str(v) for k, v in Workorder.paid_stats(date_start, date_end).items()}
+    progress(70)
+
+    tax_breakdown = [
+        {'name': tax_class.name, **{k: str(v) for k, v in amounts.items()}}
+        for tax_class, amounts in TaxClass.paid_breakdown(date_start, date_end).items()
+    ]
+
+    return {
+        'postal_codes_keys': postal_codes_keys + ['Others', 'Unknown'],
+        'postal_codes_vals': postal_codes_vals + [postal_codes_stats['others'], postal_codes_stats['unknown']],
+        'items_sold': items_sold,
+        'workorder_stats': workorder_stats,
+        'tax_breakdown': tax_breakdown,
+    }
+
+def run_report(job_id):
+    """Computes the report of a job and stores it, in a worker thread"""
+
+    with db.database.connection_context():
+        job = ReportJob.get_by_id(job_id)
+
+        def progress(percent):
+            ReportJob.update(progress=percent).where(ReportJob.id == job_id).execute()
+
+        ReportJob.update(status='running').where(ReportJob.id == job_id).execute()
+
+        try:
+            result = compute_report(job.date_start, job.date_end, progress)
+        except Exception:
+            traceback.print_exc()
+            ReportJob.update(status='failed', error=traceback.format_exc(limit=1),
+                             finished=datetime.datetime.now()).where(ReportJob.id == job_id).execute()
+        else:
+            ReportJob.update(status='done', progress=100, result=json.dumps(result),
+                             finished=datetime.datetime.now()).where(ReportJob.id == job_id).execute()
+        finally:
+            with in_flight_lock:
+                in_flight.pop((job.date_start, job.date_end), None)
+
+def recover_jobs():
+    """Marks the jobs left pending or running by a previous process as
+    failed, so that their polling stops"""
+    ReportJob.update(status='failed', error='Interrupted by a restart, request the report again',
+                     finished=datetime.datetime.now()) \
+             .where(ReportJob.status.in_(['pending', 'running']) & (ReportJob.created < STARTED)).execute()
+
+def purge_jobs():
+    """Deletes the jobs finished for longer than JOB_TTL"""
+    ReportJob.delete().where(ReportJob.status.in_(['done', 'failed']) &
+                             (ReportJob.finished < datetime.datetime.now() - JOB_TTL)).execute()
+
+def submit_report(date_start, date_end):
+    """ReportJob of the range, a new one or the one already in flight"""
+
+    purge_jobs()
+
+    with in_flight_lock:
+        if (date_start, date_end) in in_flight:
+            job_id, _ = in_flight[date_start, date_end]
+            return ReportJob.get_by_id(job_id)
+
+        job = ReportJob.create(date_start=date_start, date_end=date_end)
+        in_flight[date_start, date_end] = (job.id, executor.submit(run_report, job.id))
+
+    return job
+
+def wait(job_id, timeout=None):
+    """Waits for a job of this process to be done or failed, returns
+    the ReportJob"""
+
+    with in_flight_lock:
+        futures = [future for in_flight_id, future in in_flight.values() if in_flight_id == job_id]
+
+    concurrent.futures.wait(futures, timeout=timeout)
+
+    return ReportJob.get_by_id(job_id)
@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""Schema migrations for existing databases
+
+The schema version is stored in SQLite's `PRAGMA user_version`. Each
+function decorated with @migration brings the database one version
+up. A new database is created with the latest schema by `create_db()`,
+which marks all the migrations as applied.
+
+Always add new migrations at the end of the file.
+
+Run the migrations with `flask migrate-db` : some triggers call Python
+functions that only the app registers (see `setup_app.SQL_FUNCTIONS`),
+the migrations that fill their columns fail on any other connection.
+"""
+from models import *
+from create_db import run_sql, create_fts_index, create_search_keys, create_client_keys, \
+    create_sales_ledger, create_refund_state, create_tax_classes, create_workorder_version, \
+    create_postal_fsa, create_tax_rates_lock, create_sales_ledger_version
+
+MIGRATIONS = []
+
+def migration(func):
+    MIGRATIONS.append(func)
+    return func
+
+def schema_version():
+    return db.database.execute_sql('PRAGMA user_version').fetchone()[0]
+
+def set_schema_version(version):
+    run_sql(f'PRAGMA user_version = {int(version)}')
+
+def add_column(model, name):
+    """Adds the column of a new field to an existing table"""
+    field = model._meta.fields[name]
+    ctx = db.database.get_sql_context()
+    column_sql, params = ctx.sql(field.ddl(ctx)).query()
+
+    run_sql(f'ALTER TABLE {model._meta.table_name} ADD COLUMN {column_sql}', params)
+
+    if field.index:
+        run_sql(f'CREATE INDEX IF NOT EXISTS {model._meta.table_name}_{field.column_name} '
+                f'ON {model._meta.table_name}({field.column_name})')
+
+def add_indexes(model, *names):
+    """Creates the indexes of `model` with these names, as declared on
+    the model. The names are listed by each migration : the model may
+    declare indexes on columns added by later migrations"""
+    indexes = {index._name: index for index in model._meta.fields_to_index()
+               # Raw SQL indexes (added by create_db()) have no IF NOT EXISTS
+               if not isinstance(index, peewee.SQL)}
+
+    for name in names:
+        run_sql(*model._schema._create_index(indexes[name]).query())
+
+def migrate_db():
+    """Applies the missing migrations, returns their names"""
+    version = schema_version()
+    applied = []
+
+    for number, func in enumerate(MIGRATIONS[version:], start=version + 1):
+        func()
+        set_schema_version(number)
+        applied.append(func.__name__)
+
+    return applied
+
+# ---------- Migrations ----------
+
+# Migrations name their columns and indexes instead of reading the
+# model's lists (`derived_fields`, `search_keys`, ...), which grow with
+# the later migrations
+
+@migration
+def inventory_item_fts():
+    create_fts_index(InventoryItem, InventoryItemIndex)
+
+@migration
+def client_fts():
+    create_fts_index(Client, ClientIndex)
+
+@migration
+def search_keys():
+    for model, names in [(Client, ('search_first_name', 'search_last_name')),
+                         (InventoryItem, ('search_name', 'search_keywords'))]:
+        for name in names:
+            add_column(model, name)
+
+        create_search_keys(model)
+
+@migration
+def scan_codes():
+    # The unique indexes can't be created over duplicate codes
+    scan_codes = ('ean_code', 'upc_code', 'sku_code')
+
+    for name in scan_codes:
+        field = getattr(InventoryItem, name)
+        duplicates = InventoryItem.select(field) \
+                                  .where(InventoryItem.scannable(field)) \
+                                  .group_by(field) \
+                                  .having(peewee.fn.COUNT(InventoryItem.id) > 1) \
+                                  .tuples()
+
+        if duplicates:
+            codes = ', '.join(code for code, in duplicates)
+            raise ValueError(f'Active inventory items share the same {name} : {codes}. '
+                             'Change or archive them, then migrate again')
+
+    add_indexes(InventoryItem, *(f'inventoryitem_{name}' for name in scan_codes))
+
+@migration
+def client_keys():
+    ClientKey.create_table()
+    create_client_keys()
+
+@migration
+def sales_ledger():
+    SalesLedger.create_table()
+    create_sales_ledger()
+
+@migration
+def refund_state():
+    add_column(Workorder, 'refunded_items')
+    add_column(Workorder, 'refunded')
+
+    add_indexes(WorkorderItem, 'workorderitem_refund_item_id')
+    create_refund_state()
+
+@migration
+def tax_classes():
+    create_tax_classes()
+
+    for model in (InventoryItem, WorkorderItem):
+        add_column(model, 'tax_class')
+
+@migration
+def workorder_version():
+    add_column(Workorder, 'version')
+    create_workorder_version()
+
+@migration
+def postal_fsa():
+    add_column(Client, 'postal_fsa')
+    create_postal_fsa()
+
+@migration
+def workorder_paid_date_index():
+    add_indexes(Workorder, 'workorder_paid_date_paid_total')
+
+@migration
+def report_jobs():
+    ReportJob.create_table()
+
+@migration
+def tax_rates_lock():
+    create_tax_rates_lock()
+
+@migration
+def sales_ledger_workorders():
+    # Derived data : rebuilt with the nb_workorders and total columns and the new trigger
+    run_sql(f'DROP TRIGGER IF EXISTS {Workorder._meta.table_name}_sales_ledger_after_paid')
+    SalesLedger.drop_table()
+    SalesLedger.create_table()
+    create_sales_ledger()
+
+@migration
+def sales_ledger_version():
+    SalesLedgerVersion.create_table()
+    create_sales_ledger_version()
@@ -1,11 +1,17 @@
 import os
+import collections
+import weakref
+import threading
 import peewee
 from config import taxes
 # from flask_peewee.db import Database
 import datetime
 from playhouse.hybrid import hybrid_property
+from playhouse.sqlite_ext import FTS5Model, SearchField, RowIDField
 from decimal import Decimal
 import config
+import barcodes
+import money
 
 from setup_app import db
 
@@ -47,6 +53,41 @@ class UserRoles(db.Model):
         return self.role.get_permissions()
 
 
+# ---------- Change hooks ----------
+
+# In-process caches and search indexes register a callback here to
+# know when a row is saved or deleted through the ORM.
+#
+# N.B. : bulk queries (Model.update(), Model.insert_many(), ...) don't
+# go through .save() and won't trigger the hooks
+change_hooks = collections.defaultdict(list)
+
+def on_change(model):
+    """Decorator, registers `hook(instance, deleted)` to be called after
+    an instance of `model` is saved or deleted"""
+    def decorator(hook):
+        change_hooks[model].append(hook)
+        return hook
+
+    return decorator
+
+def notify_change(instance, deleted=False):
+    for hook in change_hooks[type(instance)]:
+        hook(instance, deleted)
+
+class NotifyChangesMixin:
+    """Calls the hooks registered with @on_change(Model)"""
+
+    def save(self, *args, **kwargs):
+        rows = super().save(*args, **kwargs)
+        notify_change(self)
+        return rows
+
+    def delete_instance(self, *args, **kwargs):
+        rows = super().delete_instance(*args, **kwargs)
+        notify_change(self, deleted=True)
+        return rows
+
 # ---------- Models ----------
 
 current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -56,7 +97,7 @@ with open(current_dir + '/data/postal_codes.txt') as f:
     for line in f:
         postal_codes[line[:3]] = line[4:].strip()
 
-class Client(db.Model):
+class Client(NotifyChangesMixin, db.Model):
     # SQLite explicit AUTOINCREMENT == don't reuse a previously delete ID
     id = peewee.BigIntegerField(primary_key=True, constraints=[peewee.SQL('AUTOINCREMENT')])
     first_name = peewee.TextField()
@@ -74,6 +115,17 @@ class Client(db.Model):
     created = peewee.DateTimeField(default=datetime.datetime.now)
     updated = peewee.DateTimeField(default=datetime.datetime.now)
     archived = peewee.BooleanField(default=False)
+
+    # search_key() of the names, filled by triggers
+    search_first_name = peewee.TextField(default='', index=True, constraints=[peewee.SQL("DEFAULT ''")])
+    search_last_name = peewee.TextField(default='', index=True, constraints=[peewee.SQL("DEFAULT ''")])
+
+    # Normalized column -> source column
+    search_keys = {'search_first_name': 'first_name', 'search_last_name': 'last_name'}
+
+    # Forward sortation area (first 3 characters of the postal code),
+    # filled by triggers (see `create_db.create_postal_fsa()`)
+    postal_fsa = peewee.TextField(default='', index=True, constraints=[peewee.SQL("DEFAULT ''")])
     
     @classmethod
     def editable_cols(cls):
@@ -82,6 +134,59 @@ class Client(db.Model):
     def name(self):
         return self.first_name + ' ' + self.last_name
 
+    def possible_duplicates(self):
+        """Other clients that share a blocking key with this one, as
+        a list of (client, [kinds of the shared keys])"""
+        other = ClientKey.alias()
+
+        query = Client.select(Client, other.kind) \
+                      .join(other, on=(other.client == Client.id)) \
+                      .join(ClientKey, on=((ClientKey.kind == other.kind) & (ClientKey.key == other.key))) \
+                      .where((ClientKey.client == self.id) & (ClientKey.duplicate == True) & (Client.id != self.id)) \
+                      .order_by(Client.id, other.kind) \
+                      .objects()
+
+        duplicates = {}
+
+        for client in query:
+            duplicates.setdefault(client.id, (client, []))[1].append(client.kind)
+
+        return list(duplicates.values())
+
+    @classmethod
+    def postal_code_stats(cls, top=5):
+        """Number of clients of the `top` most frequent FSAs, of the
+        other FSAs and without a postal code, in a single query on the
+        postal_fsa index :
+
+            {'top': [{'fsa': 'H2R', 'region': '...', 'nb': 12}, ...],
+             'others': 34, 'unknown': 5}
+        """
+        counts = cls.select(cls.postal_fsa.alias('fsa'), peewee.fn.COUNT(cls.id).alias('nb')) \
+                    .group_by(cls.postal_fsa).alias('counts')
+
+        # Unknown last
+        rank = peewee.fn.ROW_NUMBER().over(order_by=[counts.c.fsa == '', counts.c.nb.desc(), counts.c.fsa])
+        ranked = cls.select(counts.c.fsa, counts.c.nb, rank.alias('rank')).from_(counts).alias('ranked')
+
+        # The FSA for the top ones, '' for unknown, NULL for the others
+        bucket = peewee.Case(None, [(ranked.c.fsa == '', ''), (ranked.c.rank <= top, ranked.c.fsa)], None)
+
+        query = cls.select(bucket.alias('fsa'), peewee.fn.SUM(ranked.c.nb).alias('nb')) \
+                   .from_(ranked).group_by(bucket).order_by(peewee.fn.MIN(ranked.c.rank)).tuples()
+
+        stats = {'top': [], 'others': 0, 'unknown': 0}
+
+        for fsa, nb in query:
+            if fsa is None:
+                stats['others'] = nb
+            elif fsa == '':
+                stats['unknown'] = nb
+            else:
+                stats['top'].append({'fsa': fsa, 'region': postal_codes.get(fsa, ''), 'nb': nb})
+
+        return stats
+
     def postal_code_region(self):
         start = self.postal_code.strip().upper()[:3]
         if start in postal_codes:
@@ -92,8 +197,180 @@ class Client(db.Model):
     def __str__(self):
         return self.first_name + ' ' + self.last_name
 
+class ClientIndex(FTS5Model):
+    """Full-text index of the client names, kept in sync by triggers
+    (see `create_db.create_fts_index()`)"""
+    rowid = RowIDField()
+    first_name = SearchField()
+    last_name = SearchField()
+
+    class Meta:
+        database = db.database
+        table_name = 'client_fts'
+        options = {
+            'content': Client,
+            'content_rowid': 'id',
+            'prefix': '2 3',
+            'tokenize': 'unicode61 remove_diacritics 2',
+        }
+
+class ClientKey(db.Model):
+    """Blocking keys of the clients (see `dedup.py`), used to find
+    duplicates. Filled by triggers (see `create_db.create_client_keys()`)
+
+    `duplicate` is maintained by the triggers too : it's set when
+    another client has the same key
+
+    The triggers call the Python functions of `kinds` : the writes to
+    the clients fail on the connections that didn't register them (see
+    `setup_app.SQL_FUNCTIONS`)"""
+    client = peewee.ForeignKeyField(Client, backref='keys', on_delete='CASCADE')
+    kind = peewee.TextField(choices=('phone', 'email', 'name'))
+    key = peewee.TextField()
+    duplicate = peewee.BooleanField(default=False)
+
+    # Kind -> SQL function computing the key, client columns it uses
+    kinds = {
+        'phone': ('phone_key', ['phone']),
+        'email': ('email_key', ['email']),
+        'name': ('name_key', ['first_name', 'last_name']),
+    }
+
+    class Meta:
+        indexes = (
+            (('kind', 'key'), False),
+            (('client', 'kind'), True),
+        )
+
+# The duplicates page only reads this (small) part of the table
+ClientKey.add_index(ClientKey.index(ClientKey.kind, ClientKey.key, name='clientkey_duplicates',
+                                    where=peewee.SQL('duplicate = 1')))
+
+class TaxClass(NotifyChangesMixin, db.Model):
+    """Tax rates of a kind of item (eg.: zero-rated books, or only the
+    federal tax for out-of-province clients)
+
+    A NULL rate is the standard rate : the archived rate of a paid
+    workorder, `config.taxes` otherwise. Items that are not taxable are
+    always in the EXEMPT class, taxable items without a class are in
+    the STANDARD class
+
+    The rates of a class can't change once it has items in paid
+    workorders (see `create_db.create_tax_rates_lock()`) : create a new
+    class for the new rates"""
+    STANDARD = 1
+    EXEMPT = 2
+
+    name = peewee.TextField(unique=True)
+    tax1_rate = peewee.DecimalField(max_digits=15, decimal_places=8, auto_round=True, null=True)
+    tax2_rate = peewee.DecimalField(max_digits=15, decimal_places=8, auto_round=True, null=True)
+
+    def rate(self, index):
+        """Rate of the tax `index` (0 or 1), as a Decimal"""
+        rate = (self.tax1_rate, self.tax2_rate)[index]
+        return TAX_RATES[index] if rate is None else Decimal(rate)
+
+    @classmethod
+    def id_of(cls, item):
+        """Tax class id of an InventoryItem or a WorkorderItem"""
+        if not item.taxable:
+            return cls.EXEMPT
 
-class InventoryItem(db.Model):
+        return item.tax_class_id or cls.STANDARD
+
+    @classmethod
+    def id_of_sql(cls, model):
+        """`id_of()` in SQL, for the rows of `model`"""
+        return peewee.Case(None, [(~model.taxable, cls.EXEMPT)],
+                           peewee.fn.COALESCE(model.tax_class, cls.STANDARD))
+
+    # {id: TaxClass} of all the classes, see `by_id()`
+    _by_id = None
+
+    @classmethod
+    def by_id(cls):
+        """{id: TaxClass} of all the classes, loaded once and reloaded
+        after a class is saved or deleted (see `invalidate_tax_classes()`)"""
+        classes = cls._by_id
+
+        if classes is None:
+            classes = cls._by_id = {tax_class.id: tax_class for tax_class in cls.select()}
+
+        return classes
+
+    def is_used(self):
+        """Whether inventory items or workorder items are in this class"""
+        return any(model.select().where(model.tax_class == self.id).exists()
+                   for model in (InventoryItem, WorkorderItem))
+
+    def has_paid_items(self):
+        """Whether items of paid workorders are in this class"""
+        return WorkorderItem.select().join(Workorder) \
+                            .where(Workorder.paid & (TaxClass.id_of_sql(WorkorderItem) == self.id)) \
+                            .exists()
+
+    @classmethod
+    def breakdown(cls, where):
+        """Subtotal and taxes of each tax class, for the items of all the
+        workorders matching `where`, in a single grouped query
+
+        The "Version 1" semantics of `Workorder._calc_taxes()` are kept
+        per class : the subtotal of a class is summed for each
+        workorder, multiplied by the rate, rounded once, then these
+        taxes are added. Paid workorders use their archived rates for
+        the standard rates, the rates of the other classes are locked
+        once they have paid items.
+
+        Returns {TaxClass: {'subtotal', 'taxes1', 'taxes2', 'nb_items'}}
+        in the order of the ids, the amounts are Decimals rounded to the
+        cent. Only the classes with at least one item are returned"""
+
+        tax_class = cls.id_of_sql(WorkorderItem)
+
+        # Exact subtotal per workorder and class, see money.line_subtotal()
+        per_workorder = WorkorderItem.select(
+            tax_class.alias('tax_class_id'),
+            peewee.fn.COUNT(WorkorderItem.id).alias('nb_items'),
+            peewee.fn.SUM(money.sql_units(WorkorderItem.nb, money.NB_PLACES) *
+                          money.sql_units(WorkorderItem.price, money.PRICE_PLACES)).alias('subtotal'),
+            Workorder.paid_tax1_rate, Workorder.paid_tax2_rate,
+        ).join(Workorder).where(where).group_by(WorkorderItem.workorder, tax_class)
+
+        def taxes(index, paid_rate):
+            rate = peewee.fn.COALESCE(money.sql_units((cls.tax1_rate, cls.tax2_rate)[index], money.RATE_PLACES),
+                                      money.sql_units(paid_rate, money.RATE_PLACES),
+                                      money.to_units(TAX_RATES[index], money.RATE_PLACES))
+
+            return peewee.fn.SUM(money.sql_taxes(per_workorder.c.subtotal, rate))
+
+        query = cls.select(
+            cls,
+            peewee.fn.SUM(per_workorder.c.nb_items).alias('nb_items'),
+            peewee.fn.SUM(per_workorder.c.subtotal).alias('subtotal_units'),
+            taxes(0, per_workorder.c.paid_tax1_rate).alias('taxes1_units'),
+            taxes(1, per_workorder.c.paid_tax2_rate).alias('taxes2_units'),
+        ).join(per_workorder, on=(per_workorder.c.tax_class_id == cls.id)) \
+         .group_by(cls.id).order_by(cls.id)
+
+        return {
+            tax_class: {
+                'nb_items': tax_class.nb_items,
+                'subtotal': money.to_decimal(money.rescale(tax_class.subtotal_units, money.LINE_PLACES)),
+                'taxes1': money.to_decimal(tax_class.taxes1_units),
+                'taxes2': money.to_decimal(tax_class.taxes2_units),
+            }
+            for tax_class in query
+        }
+
+    @classmethod
+    def paid_breakdown(cls, date_start, date_end):
+        """`breakdown()` of the workorders paid between two dates"""
+        return cls.breakdown(Workorder.paid & peewee.fn.DATE(Workorder.paid_date).between(date_start, date_end))
+
+    def __str__(self):
+        return self.name
+
+class InventoryItem(NotifyChangesMixin, db.Model):
     id = peewee.BigIntegerField(primary_key=True, constraints=[peewee.SQL('AUTOINCREMENT')])
     name = peewee.TextField()
     # TODO : À valider
@@ -107,6 +384,7 @@ class InventoryItem(db.Model):
     cost = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True)
     msrp = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True)
     taxable = peewee.BooleanField(default=True)
+    tax_class = peewee.ForeignKeyField(TaxClass, null=True, on_delete='RESTRICT')
     discountable = peewee.BooleanField(default=True)
     # price_with_discount INTEGER NULLABLE DEFAULT NULL,
     avg_time_spent = peewee.IntegerField(default=0) # Temps en minutes, approximatif pour des fins de stats
@@ -117,9 +395,102 @@ class InventoryItem(db.Model):
     inventory_count = peewee.IntegerField(default=0)
     archived = peewee.BooleanField(default=False)
 
+    # search_key() of the name and keywords, filled by triggers
+    search_name = peewee.TextField(default='', index=True, constraints=[peewee.SQL("DEFAULT ''")])
+    search_keywords = peewee.TextField(default='', constraints=[peewee.SQL("DEFAULT ''")])
+
+    # Normalized column -> source column
+    search_keys = {'search_name': 'name', 'search_keywords': 'keywords'}
+
+    # Codes that identify a single active item, in order of precedence
+    scan_codes = ('ean_code', 'upc_code', 'sku_code')
+
     def __str__(self):
         return self.name
 
+    @classmethod
+    def scannable(cls, field):
+        """Condition of the unique index of a scan code : each active item
+        has its own code, but any number of items can have no code.
+
+        Queries must repeat it for SQLite to use the partial index"""
+        return (field != '') & (cls.archived == False)
+
+    @classmethod
+    def get_by_scan_code(cls, code):
+        """Active item with this barcode or SKU, None if there is none"""
+        code = code.strip()
+
+        if not code:
+            return None
+
+        gtins = barcodes.variants(code)
+        condition = None
+
+        for name in cls.scan_codes:
+            field = getattr(cls, name)
+            values = [code] if name == 'sku_code' else gtins
+            match = field.in_(values) & cls.scannable(field)
+            condition = match if condition is None else condition | match
+
+        # The same code could be the EAN of an item and the SKU of another
+        items = list(cls.select().where(condition))
+
+        for name in cls.scan_codes:
+            for item in items:
+                if getattr(item, name) in gtins:
+                    return item
+
+        return None
+
+    @classmethod
+    def items_sold(cls, date_start, date_end):
+        """Quantity sold of each article in the workorders paid between
+        two dates, as {'name', 'total_sold'} dicts in decreasing order"""
+        return cls.select(cls.name, peewee.fn.SUM(WorkorderItem.nb).alias('total_sold')) \
+                  .join(WorkorderItem, on=(cls.id == WorkorderItem.inventory_item_id)) \
+                  .join(Workorder, on=(WorkorderItem.workorder_id == Workorder.id)) \
+                  .where((cls.type == 'article') & Workorder.paid &
+                         peewee.fn.DATE(Workorder.paid_date).between(date_start, date_end)) \
+                  .group_by(cls.id) \
+                  .order_by(peewee.fn.SUM(WorkorderItem.nb).desc()) \
+                  .dicts()
+
+# Same condition as InventoryItem.scannable(), parameters are not
+# allowed in CREATE INDEX
+for name in InventoryItem.scan_codes:
+    InventoryItem.add_index(InventoryItem.index(getattr(InventoryItem, name), unique=True,
+                                                where=peewee.SQL(f"{name} != '' AND archived = 0")))
+
+class InventoryItemIndex(FTS5Model):
+    """Full-text index of the InventoryItems, used for searches
+
+    This is an external content table : the text is only stored in
+    `inventoryitem`, triggers keep the index in sync (see
+    `create_db.create_fts_index()`)
+    """
+    rowid = RowIDField()
+    name = SearchField()
+    keywords = SearchField()
+    category = SearchField()
+    subcategory = SearchField()
+    ean_code = SearchField()
+    upc_code = SearchField()
+    sku_code = SearchField()
+
+    # bm25() weights, in the same order as the fields
+    weights = (4.0, 2.0, 1.0, 1.0, 4.0, 4.0, 4.0)
+
+    class Meta:
+        database = db.database
+        table_name = 'inventoryitem_fts'
+        options = {
+            'content': InventoryItem,
+            'content_rowid': 'id',
+            'prefix': '2 3',
+            'tokenize': 'unicode61 remove_diacritics 2',
+        }
+
 class WorkorderStatus(db.Model):
     name = peewee.TextField()
     color = peewee.TextField()
@@ -135,6 +506,55 @@ class WorkorderStatus(db.Model):
     def __str__(self):
         return self.name
 
+# Parsed once
+TAX_RATES = tuple(Decimal(tax[1]) for tax in taxes)
+
+@on_change(TaxClass)
+def invalidate_tax_classes(tax_class, deleted):
+    TaxClass._by_id = None
+
+class WorkorderTotals:
+    """Amounts of a workorder, computed from its items in one pass.
+    See `Workorder.totals()`
+
+    The sums are exact integers (see `money.py`), the attributes
+    without `_units` are the same values as Decimals"""
+
+    def __init__(self, items, tax_classes):
+        """`tax_classes` : {id: TaxClass} of the classes of the items"""
+        self.nb_items = 0
+        self.subtotal_units = 0
+        self.taxable_units = 0
+        # Tax class id -> subtotal
+        self.class_units = {}
+        self.tax_classes = tax_classes
+        discount_units = 0
+
+        for item in items:
+            subtotal = money.line_subtotal(item.nb, item.price)
+            tax_class = TaxClass.id_of(item)
+
+            self.nb_items += 1
+            self.subtotal_units += subtotal
+            self.class_units[tax_class] = self.class_units.get(tax_class, 0) + subtotal
+
+            if item.taxable:
+                self.taxable_units += subtotal
+
+            if item.price < item.orig_price:
+                discount_units += money.line_subtotal(item.nb, item.orig_price) - subtotal
+
+        # Not rounded, like the sum of the Decimal subtotals
+        self.subtotal = money.to_decimal(self.subtotal_units, money.LINE_PLACES)
+        self.taxable_subtotal = money.to_decimal(self.taxable_units, money.LINE_PLACES)
+        self.total_discounts = money.to_decimal(money.rescale(discount_units, money.LINE_PLACES))
+
+    def taxes(self, index):
+        """"Version 1" taxes of the tax `index` (0 or 1), rounded once per
+        tax class, as a Decimal"""
+        return money.to_decimal(sum(money.taxes(units, self.tax_classes[tax_class].rate(index))
+                                    for tax_class, units in self.class_units.items()))
+
 class Workorder(db.Model):
     """Workorders are used as a reference to compute profits, taxes,
     etc. They are both :
@@ -178,10 +598,36 @@ class Workorder(db.Model):
         ("paid_date" IS NULL) == ("paid_total" IS NULL)
         )''')])
 
+    # Refund state, maintained by triggers (see
+    # `create_db.create_refund_state()`) : number of items that are
+    # refunds or have been refunded, and whether that's all of them
+    refunded_items = peewee.IntegerField(default=0, constraints=[peewee.SQL('DEFAULT 0')])
+    refunded = peewee.BooleanField(default=True, constraints=[peewee.SQL('DEFAULT 1')])
+
+    # Bumped by triggers on any change of the workorder or its items
+    # (see `create_db.create_workorder_version()`), used as ETag
+    version = peewee.IntegerField(default=0, constraints=[peewee.SQL('DEFAULT 0')])
+
+    # Never written by .save(), the triggers own them
+    derived_fields = ('refunded_items', 'refunded', 'version')
+
     @classmethod
     def editable_cols(cls):
         return ['bike_description', 'bike_serial_number', 'calendar_date', 'status', 'invoice_notes', 'internal_notes']
 
+    def save(self, *args, **kwargs):
+        if 'only' not in kwargs:
+            kwargs['only'] = [field for field in self._meta.sorted_fields
+                              if field.name not in self.derived_fields]
+
+        return super().save(*args, **kwargs)
+
+    # Instances with memoized totals, by id(instance). Filled by the
+    # request threads, iterated by the change hooks
+    _with_totals = weakref.WeakValueDictionary()
+    _with_totals_lock = threading.Lock()
+    _totals = None
+
     @hybrid_property
     def paid(self):
         """Called from code"""
@@ -198,14 +644,23 @@ class Workorder(db.Model):
         if not force_calc and self.paid:
             return self.paid_subtotal
 
-        calc = Decimal('0.00')
+        return self.totals().subtotal
+
+    def totals(self):
+        """WorkorderTotals of the current items, loaded once"""
+
+        if self._totals is None:
+            self._totals = WorkorderTotals(self.items, TaxClass.by_id())
+
+            with Workorder._with_totals_lock:
+                Workorder._with_totals[id(self)] = self
 
-        for item in self.items:
-            calc += item.subtotal()
+        return self._totals
 
-        return calc
+    def invalidate_totals(self):
+        self._totals = None
 
-    def _calc_taxes(self, rate):
+    def _calc_taxes(self, index):
         """ABANDON ALL HOPE, YE WHO ENTERS HERE
 
         BE AWARE: Taxes are complex. Because of rounding, the same
@@ -305,30 +760,27 @@ class Workorder(db.Model):
         By specifying arbitrary logic with a `def calc_tax(item):` in
         `config.py`. Such a function could bypass everything here.
 
-        """
-
-        assert type(rate) == Decimal
+        Items with different rates are split by TaxClass : Version 1 is
+        applied to each class, the rounded taxes are then added (see
+        `TaxClass.breakdown()` for the same computation in SQL).
 
-        subtotal = Decimal('0.00')
-
-        for item in self.items.where(WorkorderItem.taxable):
-            subtotal += item.subtotal()
+        """
 
-        return round(subtotal * rate, 2)
+        return self.totals().taxes(index)
 
     def taxes1(self, force_calc=False):
 
         if not force_calc and self.paid:
             return self.paid_taxes1
 
-        return self._calc_taxes(Decimal(config.taxes[0][1]))
+        return self._calc_taxes(0)
 
     def taxes2(self, force_calc=False):
 
         if not force_calc and self.paid:
             return self.paid_taxes2
 
-        return self._calc_taxes(Decimal(config.taxes[1][1]))
+        return self._calc_taxes(1)
 
     def taxes(self, force_calc=False):
         return self.taxes1(force_calc=force_calc) + self.taxes2(force_calc=force_calc)
@@ -339,24 +791,42 @@ class Workorder(db.Model):
         if force_calc:
            raise NotImplementedError
 
-        discount = Decimal(0)
-
-        for item in self.items.where(WorkorderItem.price < WorkorderItem.orig_price):
-            discount += (item.orig_price - item.price) * item.nb
-
-        return round(discount, 2)
+        return self.totals().total_discounts
 
     def total(self, force_calc=False):
         return self.subtotal(force_calc=force_calc) + self.taxes(force_calc=force_calc)
 
+    @classmethod
+    def paid_stats(cls, date_start, date_end):
+        """Sums of subtotal(), taxes1(), taxes2(), taxes(), total() and
+        total_discounts() of the workorders paid between two dates, in
+        a single query on the SalesLedger
+
+        Paid workorders use their archived values. The discounts are
+        rounded per workorder like `total_discounts()` does
+        """
+        stats = SalesLedger.select(
+            peewee.fn.SUM(money.sql_cents(SalesLedger.subtotal)).alias('subtotal'),
+            peewee.fn.SUM(money.sql_cents(SalesLedger.taxes1)).alias('taxes1'),
+            peewee.fn.SUM(money.sql_cents(SalesLedger.taxes2)).alias('taxes2'),
+            peewee.fn.SUM(money.sql_cents(SalesLedger.discounts)).alias('total_discounts'),
+        ).where(SalesLedger.day.between(date_start, date_end)).dicts().get()
+
+        # The DecimalFields are stored as REAL, they are summed as cents
+        stats = {k: money.to_decimal(v or 0) for k, v in stats.items()}
+        stats['taxes'] = stats['taxes1'] + stats['taxes2']
+        stats['total'] = stats['subtotal'] + stats['taxes']
+
+        return stats
+
     def __str__(self):
         return self.bike_description or 'No description'
 
     def set_paid(self):
         """Save archived values"""
         self.paid_subtotal = self.subtotal()
-        self.paid_tax1_rate = Decimal(config.taxes[0][1])
-        self.paid_tax2_rate = Decimal(config.taxes[1][1])
+        self.paid_tax1_rate = TAX_RATES[0]
+        self.paid_tax2_rate = TAX_RATES[1]
         self.paid_taxes1 = self.taxes1()
         self.paid_taxes2 = self.taxes2()
         self.paid_total = self.total()
@@ -375,7 +845,11 @@ class Workorder(db.Model):
         assert round(self.taxes2(force_calc=True), 2) == self.taxes2(force_calc=False)
         assert round(self.taxes(force_calc=True), 2) == self.taxes(force_calc=False)
 
-class WorkorderItem(db.Model):
+# Range scans and ordering of the paid workorders by date (see
+# `export.py` and `analytics.SalesSnapshot.refresh()`)
+Workorder.add_index(Workorder.paid_date, Workorder.paid_total)
+
+class WorkorderItem(NotifyChangesMixin, db.Model):
     id = peewee.BigIntegerField(primary_key=True, constraints=[peewee.SQL('AUTOINCREMENT')])
     workorder = peewee.ForeignKeyField(Workorder, backref='items', on_delete='RESTRICT')
     inventory_item = peewee.ForeignKeyField(InventoryItem, backref='workorder_items', null=True, on_delete='RESTRICT')
@@ -385,48 +859,83 @@ class WorkorderItem(db.Model):
     # orig_price is duplicated here, it might change in the InventoryItem later
     orig_price = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True)
     taxable = peewee.BooleanField(default=True)
+    tax_class = peewee.ForeignKeyField(TaxClass, null=True, on_delete='RESTRICT')
     refund_item = peewee.ForeignKeyField('self', null=True, default=None, backref='refunded_by', on_delete='RESTRICT')
 
     @classmethod
     def editable_cols(cls):
-        return ['name', 'nb', 'price', 'taxable']
+        return ['name', 'nb', 'price', 'taxable', 'tax_class']
 
     def subtotal(self):
         return self.nb * self.price
 
-    def _calc_taxes(self, rate):
-        assert type(rate) == Decimal
-        return round(self.subtotal() * rate, 2)
+    def _calc_taxes(self, index):
+        tax_class = TaxClass.by_id()[TaxClass.id_of(self)]
+        return round(self.subtotal() * tax_class.rate(index), 2)
 
     def taxes1(self):
-        return self._calc_taxes(Decimal(config.taxes[0][1])) if self.taxable else Decimal(0)
+        return self._calc_taxes(0)
 
     def taxes2(self):
-        return self._calc_taxes(Decimal(config.taxes[1][1])) if self.taxable else Decimal(0)
+        return self._calc_taxes(1)
 
     def serialized(self):
         """Serialization to send via the json API"""
-        serialized_item = {k: getattr(self, k) for k in ['id', 'name', 'nb', 'taxable']}
-        serialized_item['price'] = str(round(self.price, 2))
-        serialized_item['orig_price'] = str(round(self.orig_price, 2))
-        serialized_item['type'] = self.inventory_item.type
+        return WorkorderItem.serialize_many(WorkorderItem.select().where(WorkorderItem.id == self.id))[0]
 
-        serialized_item['refund_workorder_id'] = False
-        if self.refund_item_id is not None:
-            serialized_item['refund_workorder_id'] = self.refund_item.workorder.id
+    @classmethod
+    def serialize_many(cls, items):
+        """serialized() of all the items selected by the `items` query,
+        with two queries whatever the number of items"""
+        Refunded = cls.alias()
 
-        serialized_item['refunded_in_workorder_id'] = False
+        if not items._order_by:
+            items = items.order_by(cls.id)
 
-        assert self.refunded_by.count() in [0, 1]
+        items = list(items.select_extend(InventoryItem.type.alias('inventory_item_type'),
+                                         Refunded.workorder.alias('refund_workorder_id'))
+                          .join_from(cls, InventoryItem, peewee.JOIN.LEFT_OUTER)
+                          .join_from(cls, Refunded, peewee.JOIN.LEFT_OUTER, on=(cls.refund_item == Refunded.id))
+                          .objects())
 
-        if self.refunded_by.count():
-            serialized_item['refunded_in_workorder_id'] = self.refunded_by.get().workorder.id
+        # Item id -> workorder of its refund
+        refunded_in = {}
 
-        return serialized_item
+        if items:
+            refunds = cls.select(cls.refund_item, cls.workorder) \
+                         .where(cls.refund_item.in_([item.id for item in items])) \
+                         .tuples()
+
+            for item_id, workorder_id in refunds:
+                assert item_id not in refunded_in
+                refunded_in[item_id] = workorder_id
+
+        serialized = []
+
+        for item in items:
+            serialized_item = {k: getattr(item, k) for k in ['id', 'name', 'nb', 'taxable']}
+            serialized_item['price'] = str(round(item.price, 2))
+            serialized_item['orig_price'] = str(round(item.orig_price, 2))
+            serialized_item['type'] = item.inventory_item_type
+            serialized_item['refund_workorder_id'] = item.refund_workorder_id or False
+            serialized_item['refunded_in_workorder_id'] = refunded_in.get(item.id, False)
+
+            serialized.append(serialized_item)
+
+        return serialized
 
     def __str__(self):
         return self.name
 
+@on_change(WorkorderItem)
+def invalidate_workorder_totals(item, deleted):
+    with Workorder._with_totals_lock:
+        workorders = list(Workorder._with_totals.values())
+
+    for workorder in workorders:
+        if workorder.id == item.workorder_id:
+            workorder.invalidate_totals()
+
 class Transaction(db.Model):
     """Transactions are mostly used to keep track of cash registery and
     credit card terminal amounts. They are either related to a sale or
@@ -459,6 +968,47 @@ class Transaction(db.Model):
                                ''')])
     created = peewee.DateTimeField(default=datetime.datetime.now)
 
+class SalesLedger(db.Model):
+    """Daily sales summary, one row per day x payment method x tax
+    bucket (taxable or not) x item type. Filled by a trigger when a
+    workorder is paid (see `create_db.create_sales_ledger()`), can be
+    rebuilt with `flask rebuild-sales-ledger`
+
+    The archived subtotal, taxes and total of a workorder are split
+    between its rows, with the rounding remainder on the largest one :
+    the sums of the ledger are the sums of the paid_* columns. That row
+    also counts the workorder and gets the remainder of its discounts,
+    which are rounded per workorder like `Workorder.total_discounts()`
+
+    Read by `Workorder.paid_stats()` and the sales series"""
+    day = peewee.DateField()
+    # '' for 0$ workorders, which have no transaction
+    payment_method = peewee.TextField()
+    taxable = peewee.BooleanField()
+    # '' for the items that are not from the inventory
+    item_type = peewee.TextField()
+    nb_workorders = peewee.IntegerField(default=0, constraints=[peewee.SQL('DEFAULT 0')])
+    nb_items = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True, default=0)
+    subtotal = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True, default=0)
+    taxes1 = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True, default=0)
+    taxes2 = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True, default=0)
+    discounts = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True, default=0)
+    total = peewee.DecimalField(max_digits=15, decimal_places=2, auto_round=True, default=0)
+
+    amounts = ['nb_workorders', 'nb_items', 'subtotal', 'taxes1', 'taxes2', 'discounts', 'total']
+
+    class Meta:
+        indexes = (
+            (('day', 'payment_method', 'taxable', 'item_type'), True),
+        )
+
+class SalesLedgerVersion(db.Model):
+    """Single row, bumped by triggers on each change of the SalesLedger
+    rows of a closed day (before today), eg. by `flask
+    rebuild-sales-ledger`. The closed buckets of the sales series are
+    cached until it changes (see `series.py`)"""
+    version = peewee.IntegerField(default=0)
+
 class CashRegisterState(db.Model):
     """Store the state of the cash register at a given point in time.
 
@@ -482,3 +1032,28 @@ class CashRegisterState(db.Model):
     comment = peewee.TextField(default=None, null=True)
 
     state_time = peewee.DateTimeField(default=datetime.datetime.now)
+
+class ReportJob(db.Model):
+    """Report of the sales between two dates, computed in the
+    background (see `jobs.py`). The result is kept as JSON"""
+    STATUSES = ('pending', 'running', 'done', 'failed')
+
+    date_start = peewee.DateField()
+    date_end = peewee.DateField()
+    status = peewee.TextField(default='pending', choices=STATUSES)
+    progress = peewee.IntegerField(default=0) # Percent
+    result = peewee.TextField(null=True)
+    error = peewee.TextField(null=True)
+    created = peewee.DateTimeField(default=datetime.datetime.now)
+    finished = peewee.DateTimeField(null=True)
+
+    def serialized(self):
+        """Serialization to send via the json API, without the result"""
+        return {
+            'id': self.id,
+            'date_start': self.date_start.isoformat(),
+            'date_end': self.date_end.isoformat(),
+            'status': self.status,
+            'progress': self.progress,
+            'error': self.error,
+        }
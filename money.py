@@ -0,0 +1,108 @@
+"""Exact money arithmetic on integers
+
+Amounts are integers in units of 10**-places : 12.34$ is 1234 cents
+(places=2). The Decimal fields of the models stay the API, the
+conversions happen at the edges (`to_units()`, `to_decimal()`,
+`sql_cents()`).
+
+Prices have 3 decimals and quantities 2, a line subtotal (nb * price)
+is exact with LINE_PLACES decimals. It's only rounded to cents once,
+on the sum, as required by the "Version 1" taxes described in
+`models.Workorder._calc_taxes()`.
+
+Rounding is always half away from zero, like the ROUND_HALF_UP
+context used by the models and like SQLite's ROUND().
+"""
+from decimal import Decimal, ROUND_HALF_UP
+
+import peewee
+
+CENTS = 2
+NB_PLACES = 2
+PRICE_PLACES = 3
+LINE_PLACES = NB_PLACES + PRICE_PLACES
+RATE_PLACES = 8
+
+def to_units(value, places=CENTS):
+    """`value` (Decimal, str, int or float) as an integer number of
+    10**-places, rounded half up
+
+    >>> to_units('12.345')
+    1235
+    >>> to_units(Decimal('0.09975'), RATE_PLACES)
+    9975000
+    """
+    if isinstance(value, float):
+        # Floats come from SQLite's REAL, their repr is the stored decimal
+        value = repr(value)
+
+    return int(Decimal(value).scaleb(places).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+def to_decimal(units, places=CENTS):
+    """
+    >>> to_decimal(1235)
+    Decimal('12.35')
+    >>> to_decimal(0)
+    Decimal('0.00')
+    """
+    return Decimal(units).scaleb(-places).quantize(Decimal(1).scaleb(-places))
+
+def div_round(numerator, denominator):
+    """numerator / denominator rounded half away from zero
+
+    >>> div_round(5, 10), div_round(-5, 10), div_round(4, 10)
+    (1, -1, 0)
+    """
+    assert denominator > 0
+
+    quotient, remainder = divmod(abs(numerator), denominator)
+
+    if 2 * remainder >= denominator:
+        quotient += 1
+
+    return quotient if numerator >= 0 else -quotient
+
+def rescale(units, places, new_places=CENTS):
+    """Converts units of 10**-places to units of 10**-new_places"""
+    if new_places >= places:
+        return units * 10 ** (new_places - places)
+
+    return div_round(units, 10 ** (places - new_places))
+
+def line_subtotal(nb, price):
+    """nb * price, in units of 10**-LINE_PLACES"""
+    return to_units(nb, NB_PLACES) * to_units(price, PRICE_PLACES)
+
+def taxes(subtotal, rate):
+    """Taxes in cents of a `subtotal` in units of 10**-LINE_PLACES :
+    the subtotal is multiplied by the rate, then rounded once
+
+    >>> # 1.15$ + 1.10$, see models.Workorder._calc_taxes()
+    >>> subtotal = line_subtotal(1, '1.15') + line_subtotal(1, '1.10')
+    >>> to_decimal(rescale(subtotal, LINE_PLACES) + taxes(subtotal, '0.15'))
+    Decimal('2.59')
+    """
+    return div_round(subtotal * to_units(rate, RATE_PLACES), 10 ** (LINE_PLACES + RATE_PLACES - CENTS))
+
+def sql_units(expr, places=CENTS):
+    """SQL expression of `expr` (a REAL or a DecimalField column) as an
+    integer number of 10**-places, to compute without floating point
+    errors"""
+    return peewee.Cast(peewee.fn.ROUND(expr * 10 ** places), 'INTEGER')
+
+def sql_cents(expr):
+    return sql_units(expr, CENTS)
+
+def sql_div_round(expr, denominator):
+    """SQL version of `div_round()`, `expr` must be an integer. SQLite's
+    integer division truncates towards zero"""
+    assert denominator > 0 and denominator % 2 == 0
+
+    half = denominator // 2
+
+    return peewee.Case(None, [(expr >= 0, (expr + half) / denominator)], (expr - half) / denominator)
+
+def sql_taxes(subtotal, rate):
+    """SQL version of `taxes()`, `subtotal` and `rate` are integers
+    (10**-LINE_PLACES and 10**-RATE_PLACES)"""
+    return sql_div_round(subtotal * rate, 10 ** (LINE_PLACES + RATE_PLACES - CENTS))
@@ -0,0 +1,127 @@
+"""Fuzzy scoring of search results
+
+`does_match()` is the reference implementation, `Matcher` gives the
+exact same scores but does the work related to the needle only once :
+
+- The needle is lowercased once, and difflib's SequenceMatcher indexes
+  it once (set_seq2) instead of once per word
+- Words that can't reach the threshold are rejected without running
+  the SequenceMatcher : the matching blocks can't contain more
+  characters than the word and the needle have in common
+- Scores are cached per word, since the same words come back on most
+  rows (ex.: "mise", "point", "pneu")
+"""
+import difflib
+import unicodedata
+
+FUZZY_THRESHOLD = 0.8
+
+def search_key(s):
+    """Normalized version of a string used for searches :
+
+    - No accents : "Chambre à air" -> "chambre a air"
+    - Case folded
+    - Inches : '' is stored instead of " in the actual data
+    - Decimals : , and . mean the same thing for numbers
+    """
+    if s is None:
+        return ''
+
+    s = unicodedata.normalize('NFKD', s)
+    s = ''.join(c for c in s if not unicodedata.combining(c))
+
+    return s.casefold().replace("''", '"').replace(',', '.')
+
+def extract_terms(s):
+    terms = [term.strip() for term in s.split()]
+    terms = set([search_key(t) for t in terms if t and len(t) > 1])
+    return set(terms)
+
+# ---------- Reference implementation ----------
+
+# https://stackoverflow.com/a/17741165/14639652
+def fuzzy_matches(large_string, query_string, threshold):
+    words = large_string.split()
+    for word in words:
+        s = difflib.SequenceMatcher(None, word, query_string)
+        match = ''.join(word[i:i+n] for i, j, n in s.get_matching_blocks() if n)
+
+        score = len(match) / float(len(query_string))
+
+        if score >= threshold:
+            yield match, len(match)
+
+def does_match(needle, haystack):
+    if len(needle) < 2:
+        return 0
+    if len(needle) <= 3:
+        return (needle.lower() in haystack.lower()) * 0.5
+    else:
+        all_matches = list(fuzzy_matches(haystack.lower(), needle.lower(), FUZZY_THRESHOLD))
+        nb = len(all_matches)
+
+        if not nb:
+            return 0
+
+        return sum([x[1] for x in all_matches])
+
+# ---------- Compiled matcher ----------
+
+class Matcher:
+    """Scores many haystacks against the same needle
+
+    `Matcher(needle).score(haystack) == does_match(needle, haystack)`
+    """
+
+    def __init__(self, needle):
+        # N.B. : lowercasing can change the length of some strings
+        self.raw_length = len(needle)
+        self.needle = needle.lower()
+        self.length = len(self.needle)
+
+        # Number of occurrences of each character of the needle
+        self.chars = {c: self.needle.count(c) for c in set(self.needle)}
+
+        self.sequence_matcher = difflib.SequenceMatcher(None)
+        self.sequence_matcher.set_seq2(self.needle)
+
+        self.cache = {}
+
+    def word_score(self, word):
+        """Number of matching characters between `word` and the needle,
+        0 when it's under the threshold"""
+
+        if word in self.cache:
+            return self.cache[word]
+
+        score = 0
+        common = 0
+
+        for c, nb in self.chars.items():
+            common += min(nb, word.count(c))
+
+        if common / self.length >= FUZZY_THRESHOLD:
+            self.sequence_matcher.set_seq1(word)
+            matched = sum(n for i, j, n in self.sequence_matcher.get_matching_blocks())
+
+            if matched / self.length >= FUZZY_THRESHOLD:
+                score = matched
+
+        self.cache[word] = score
+
+        return score
+
+    def score(self, haystack, folded=False):
+        """Same as does_match(needle, haystack). Set `folded` when the
+        haystack is already a search_key()"""
+
+        if self.raw_length < 2:
+            return 0
+
+        if not folded:
+            haystack = haystack.lower()
+
+        if self.raw_length <= 3:
+            return (self.needle in haystack) * 0.5
+
+        return sum(self.word_score(word) for word in haystack.split())
@@ -0,0 +1,403 @@
+"""Search helpers used by the typeahead APIs
+
+- FTS5 queries on the full-text indexes maintained by SQLite triggers
+- In-memory indexes for fuzzy (typo-tolerant) matches. They are
+  process-local : they are built from the database the first time they
+  are used, then kept up to date by the change hooks of the models (see
+  `models.on_change`)
+- Caches of the typeahead responses, cleared by the same hooks
+"""
+import re
+import time
+import bisect
+import heapq
+import threading
+from collections import defaultdict, Counter, OrderedDict
+
+from models import Client, InventoryItem, on_change
+from scoring import search_key
+
+
+def trigrams(token, padded=True):
+    """Trigrams of a token. Padding marks the start and the end of the
+    token, which gives more weight to the edges for fuzzy matches"""
+    if padded:
+        token = ' ' + token + ' '
+
+    return {token[i:i+3] for i in range(len(token) - 2)}
+
+
+class SearchIndex:
+    """Inverted index over a few text fields of a model
+
+    Each document is split in tokens (normalized by search_key()), each
+    token points to the documents that contain it. A second level maps every trigram to
+    the tokens that contain it, which allows substring and fuzzy
+    lookups without scanning the whole vocabulary.
+    """
+
+    # How much a token is worth depending on how it matched a term
+    EXACT = 1.0
+    PREFIX = 0.8
+    SUBSTRING = 0.6
+    FUZZY = 0.5
+
+    # Minimum Dice coefficient (on trigrams) for a fuzzy match
+    FUZZY_THRESHOLD = 0.5
+
+    def __init__(self, fields, loader):
+        """`fields` maps each indexed field to its weight, `loader()`
+        returns an iterable of dicts (with an 'id' key) to index"""
+        self.fields = fields
+        self.loader = loader
+        self.lock = threading.RLock()
+        self.built = False
+
+        self.docs = {} # doc_id -> {token: weight}
+        self.postings = defaultdict(dict) # token -> {doc_id: weight}
+        self.trigrams = defaultdict(set) # trigram -> {token}
+        self.vocabulary = [] # Sorted tokens, for prefix lookups
+
+    @staticmethod
+    def tokenize(text):
+        return search_key(text).split()
+
+    def ensure_built(self):
+        with self.lock:
+            if not self.built:
+                self.build()
+
+    def build(self):
+        with self.lock:
+            self.docs.clear()
+            self.postings.clear()
+            self.trigrams.clear()
+
+            for doc in self.loader():
+                self._index(doc['id'], doc)
+
+            for token in self.postings:
+                for trigram in trigrams(token):
+                    self.trigrams[trigram].add(token)
+
+            self.vocabulary = sorted(self.postings)
+            self.built = True
+
+    def _index(self, doc_id, doc):
+        """Adds a document to the postings, returns the new tokens"""
+        tokens = {}
+
+        for field, weight in self.fields.items():
+            for token in self.tokenize(doc[field] or ''):
+                tokens[token] = max(weight, tokens.get(token, 0))
+
+        self.docs[doc_id] = tokens
+
+        new_tokens = []
+
+        for token, weight in tokens.items():
+            if token not in self.postings:
+                new_tokens.append(token)
+
+            self.postings[token][doc_id] = weight
+
+        return new_tokens
+
+    def add(self, doc_id, doc):
+        with self.lock:
+            if not self.built:
+                return
+
+            self.remove(doc_id)
+
+            for token in self._index(doc_id, doc):
+                bisect.insort(self.vocabulary, token)
+
+                for trigram in trigrams(token):
+                    self.trigrams[trigram].add(token)
+
+    def remove(self, doc_id):
+        with self.lock:
+            if not self.built or doc_id not in self.docs:
+                return
+
+            for token in self.docs.pop(doc_id):
+                postings = self.postings[token]
+                del postings[doc_id]
+
+                if postings:
+                    continue
+
+                # Last document using this token
+                del self.postings[token]
+                del self.vocabulary[bisect.bisect_left(self.vocabulary, token)]
+
+                for trigram in trigrams(token):
+                    self.trigrams[trigram].discard(token)
+
+                    if not self.trigrams[trigram]:
+                        del self.trigrams[trigram]
+
+    def lookup(self, term, fuzzy=False):
+        """Finds the tokens that match `term`, returns {token: quality}"""
+        matches = {}
+
+        # Substrings (includes exact and prefix matches)
+        inner_trigrams = trigrams(term, padded=False)
+
+        if inner_trigrams:
+            sets = sorted((self.trigrams.get(t, set()) for t in inner_trigrams), key=len)
+            candidates = set.intersection(*sets)
+        else:
+            # Too short to use trigrams
+            candidates = self.vocabulary
+
+        for token in candidates:
+            if term in token:
+                matches[token] = self.SUBSTRING
+
+        start = bisect.bisect_left(self.vocabulary, term)
+
+        for token in self.vocabulary[start:]:
+            if not token.startswith(term):
+                break
+            matches[token] = self.PREFIX
+
+        if term in self.postings:
+            matches[term] = self.EXACT
+
+        if not fuzzy or len(term) < 4:
+            return matches
+
+        # Fuzzy matches : tokens sharing enough trigrams with the term
+        term_trigrams = trigrams(term)
+        shared = Counter()
+
+        for trigram in term_trigrams:
+            shared.update(self.trigrams.get(trigram, ()))
+
+        # Dice >= threshold needs at least this many shared trigrams
+        min_shared = self.FUZZY_THRESHOLD * (len(term_trigrams) + 1) / 2
+
+        for token, nb in shared.items():
+            if nb < min_shared or token in matches:
+                continue
+
+            dice = 2 * nb / (len(term_trigrams) + len(token))
+
+            if dice >= self.FUZZY_THRESHOLD:
+                matches[token] = self.FUZZY * dice
+
+        return matches
+
+    def _term_scores(self, term, fuzzy):
+        """Best score of each document for a single term"""
+        scores = {}
+
+        for token, quality in self.lookup(term, fuzzy).items():
+            for doc_id, weight in self.postings[token].items():
+                score = quality * weight
+
+                if score > scores.get(doc_id, 0):
+                    scores[doc_id] = score
+
+        return scores
+
+    def search(self, terms, required_terms=(), limit=None, after=None):
+        """Documents that match all `required_terms` and at least one of
+        `terms` (if any)
+
+        `terms` are matched fuzzily, `required_terms` are codes/numbers
+        and must appear as-is.
+
+        Returns the total number of matches and the `limit` best
+        matches, as a list of (doc_id, score) sorted by decreasing score
+        then by id. With `after` = (score, doc_id), the list starts
+        after that match
+        """
+        self.ensure_built()
+
+        with self.lock:
+            scores = None
+
+            for term in required_terms:
+                term_scores = self._term_scores(term, fuzzy=False)
+
+                if scores is None:
+                    scores = term_scores
+                else:
+                    scores = {doc_id: score + term_scores[doc_id]
+                              for doc_id, score in scores.items()
+                              if doc_id in term_scores}
+
+            if terms:
+                any_term = defaultdict(float)
+
+                for term in terms:
+                    for doc_id, score in self._term_scores(term, fuzzy=True).items():
+                        any_term[doc_id] += score
+
+                if scores is None:
+                    scores = any_term
+                else:
+                    scores = {doc_id: score + any_term[doc_id]
+                              for doc_id, score in scores.items()
+                              if doc_id in any_term}
+
+        scores = scores or {}
+        key = lambda x: (-x[1], x[0])
+        matches = scores.items()
+
+        if after is not None:
+            score, doc_id = after
+            matches = [match for match in matches if key(match) > (-score, doc_id)]
+
+        if limit is None:
+            return len(scores), sorted(matches, key=key)
+
+        return len(scores), heapq.nsmallest(limit, matches, key=key)
+
+
+class ResultsCache:
+    """LRU cache of search results, keyed on the normalized query
+
+    Entries expire after `ttl` seconds : the change hooks only see the
+    changes made by this process. Any change to the searched model
+    clears the whole cache, since it can affect the results of any
+    query.
+    """
+
+    def __init__(self, maxsize=512, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.entries = OrderedDict() # key -> (expiration time, value)
+
+        # Incremented on each clear, results computed before a clear
+        # must not be stored after it
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """Cached value for `key`, None if missing or expired"""
+        with self.lock:
+            entry = self.entries.get(key)
+
+            if entry is None or entry[0] < time.monotonic():
+                self.entries.pop(key, None)
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(key)
+            self.hits += 1
+
+            return entry[1]
+
+    def set(self, key, value, generation):
+        """Stores `value`, unless the cache was cleared since
+        `generation` was read (the value might be stale)"""
+        with self.lock:
+            if generation != self.generation:
+                return
+
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generation += 1
+            self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+
+            return {
+                'size': len(self.entries),
+                'maxsize': self.maxsize,
+                'ttl': self.ttl,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0,
+                'invalidations': self.invalidations,
+            }
+
+
+# ---------- Inventory ----------
+
+def load_inventory_items():
+    return InventoryItem.select(InventoryItem.id, InventoryItem.name, InventoryItem.keywords,
+                                InventoryItem.sku_code, InventoryItem.ean_code, InventoryItem.upc_code) \
+                        .where(InventoryItem.archived == False) \
+                        .dicts()
+
+inventory_index = SearchIndex({
+    'name': 1.0,
+    'keywords': 0.5,
+    'sku_code': 1.0,
+    'ean_code': 1.0,
+    'upc_code': 1.0,
+}, load_inventory_items)
+
+inventory_cache = ResultsCache()
+
+@on_change(InventoryItem)
+def update_inventory_index(item, deleted):
+    inventory_cache.clear()
+
+    if deleted or item.archived:
+        inventory_index.remove(item.id)
+    else:
+        inventory_index.add(item.id, {field: getattr(item, field) for field in inventory_index.fields})
+
+
+# ---------- Clients ----------
+
+def load_clients():
+    return Client.select(Client.id, Client.first_name, Client.last_name).dicts()
+
+client_index = SearchIndex({
+    'first_name': 1.0,
+    'last_name': 1.0,
+}, load_clients)
+
+client_cache = ResultsCache()
+
+@on_change(Client)
+def update_client_index(client, deleted):
+    client_cache.clear()
+
+    if deleted:
+        client_index.remove(client.id)
+    else:
+        client_index.add(client.id, {'first_name': client.first_name, 'last_name': client.last_name})
+
+
+# ---------- Full-text (FTS5) ----------
+
+def fts_term(term):
+    """Prefix query for a single term, quoted to escape the FTS5 syntax"""
+    return '"' + term.replace('"', '""') + '"*'
+
+def fts_query(terms, required_terms=()):
+    """FTS5 MATCH expression for all the `required_terms` and any of
+    `terms`, None if there is nothing to search"""
+
+    # Terms without letters or digits contain no FTS5 token
+    terms = [fts_term(t) for t in terms if re.search(r'\w', t)]
+    required_terms = [fts_term(t) for t in required_terms if re.search(r'\w', t)]
+
+    if terms:
+        required_terms.append('(' + ' OR '.join(terms) + ')')
+
+    if not required_terms:
+        return None
+
+    return ' AND '.join(required_terms)
@@ -0,0 +1,108 @@
+"""Time-bucketed sales series (day, week or month) for the charts of
+the reports page
+
+The series are computed in SQL from the daily SalesLedger, with a range
+scan on its (day, ...) index.
+Closed periods (buckets that ended before today) are cached in memory,
+only the current period and the buckets that were never requested are
+queried. The cache is cleared when the ledger of a closed day changes
+(a rebuild, a correction of an old payment), which bumps the
+SalesLedgerVersion, in any process.
+"""
+import datetime
+
+import peewee
+
+import money
+from models import SalesLedger, SalesLedgerVersion
+
+def next_month(day):
+    return (day.replace(day=1) + datetime.timedelta(days=32)).replace(day=1)
+
+# Granularity -> (SQL start of the bucket of a date, Python start of the
+# bucket of a date, start of the next bucket). Weeks start on monday
+GRANULARITIES = {
+    'day': (lambda col: peewee.fn.DATE(col),
+            lambda day: day,
+            lambda day: day + datetime.timedelta(days=1)),
+    'week': (lambda col: peewee.fn.DATE(col, 'weekday 0', '-6 days'),
+             lambda day: day - datetime.timedelta(days=day.weekday()),
+             lambda day: day + datetime.timedelta(days=7)),
+    'month': (lambda col: peewee.fn.STRFTIME('%Y-%m-01', col),
+              lambda day: day.replace(day=1),
+              next_month),
+}
+
+# Values of each bucket, in cents (nb_items in hundredths)
+SERIES = ['nb_workorders', 'nb_items', 'subtotal', 'taxes', 'total']
+
+# (granularity, bucket start) -> tuple of the SERIES of a closed bucket,
+# for the SalesLedgerVersion closed_version
+closed_buckets = {}
+closed_version = None
+
+def query_buckets(granularity, date_start, date_end):
+    """{bucket start: tuple of the SERIES} of the workorders paid in
+    [date_start, date_end[, in one query"""
+    # As text, not converted by the DateField
+    bucket = GRANULARITIES[granularity][0](SalesLedger.day).coerce(False)
+
+    query = SalesLedger.select(
+        bucket,
+        peewee.fn.SUM(SalesLedger.nb_workorders),
+        peewee.fn.SUM(money.sql_units(SalesLedger.nb_items, money.NB_PLACES)),
+        peewee.fn.SUM(money.sql_cents(SalesLedger.subtotal)),
+        peewee.fn.SUM(money.sql_cents(SalesLedger.taxes1) + money.sql_cents(SalesLedger.taxes2)),
+        peewee.fn.SUM(money.sql_cents(SalesLedger.total)),
+    ).where((SalesLedger.day >= date_start) & (SalesLedger.day < date_end)) \
+     .group_by(bucket).tuples()
+
+    return {datetime.date.fromisoformat(row[0]): tuple(value or 0 for value in row[1:]) for row in query}
+
+def sales_series(granularity, date_start, date_end, today=None):
+    """Series of the buckets that contain date_start to date_end, as
+    compact arrays :
+
+        {'granularity': 'week', 'bucket': ['2022-01-03', ...],
+         'nb_workorders': [3, ...], 'nb_items': [4.5, ...],
+         'subtotal': [120.0, ...], 'taxes': [...], 'total': [...]}
+
+    The first and last buckets are complete, even if they start before
+    date_start or end after date_end"""
+    _, bucket_of, next_bucket = GRANULARITIES[granularity]
+    today = today or datetime.date.today()
+
+    buckets = [bucket_of(date_start)]
+
+    while next_bucket(buckets[-1]) <= date_end:
+        buckets.append(next_bucket(buckets[-1]))
+
+    global closed_version
+    version = SalesLedgerVersion.select(SalesLedgerVersion.version).scalar()
+
+    if version != closed_version:
+        closed_buckets.clear()
+        closed_version = version
+
+    missing = [bucket for bucket in buckets if (granularity, bucket) not in closed_buckets]
+    values = {}
+
+    if missing:
+        values = query_buckets(granularity, missing[0], next_bucket(buckets[-1]))
+
+        for bucket in missing:
+            if next_bucket(bucket) <= today:
+                closed_buckets[granularity, bucket] = values.get(bucket, (0,) * len(SERIES))
+
+    empty = (0,) * len(SERIES)
+    rows = [closed_buckets.get((granularity, bucket)) or values.get(bucket, empty) for bucket in buckets]
+
+    series = {'granularity': granularity, 'bucket': [bucket.isoformat() for bucket in buckets]}
+
+    for i, name in enumerate(SERIES):
+        if name == 'nb_workorders':
+            series[name] = [row[i] for row in rows]
+        else:
+            series[name] = [float(money.to_decimal(row[i])) for row in rows]
+
+    return series
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
+import contextlib
+
 from flask import Flask
 from flask_peewee.db import Database
 from flask_mail import Mail
+from playhouse.sqliteq import SqliteQueueDatabase
 
 import config
+from scoring import search_key
+from dedup import phone_key, email_key, name_key
 
 app = Flask(__name__)
 app.config.from_object(config)
@@ -13,12 +18,49 @@ mail = Mail(app)
 # instantiate the db wrapper
 db = Database(app)
 
-# For editdist3()
-if config.use_spellfix:
-    db.database.load_extension('spellfix')
+# Python functions called by the triggers that fill the normalized
+# search columns and the client keys : name -> (function, number of
+# arguments)
+#
+# They only exist on the connections that registered them. Writes to
+# the clients or the inventory items from any other connection (the
+# sqlite3 shell, a backup or repair script, ...) fail with "no such
+# function" : go through the app (`flask shell`), or call
+# `register_sql_functions()` on the connection first
+SQL_FUNCTIONS = {
+    'search_key': (search_key, 1),
+    'phone_key': (phone_key, 1),
+    'email_key': (email_key, 1),
+    'name_key': (name_key, 2),
+}
+
+# Before the first connection is opened (SqliteQueueDatabase's writer
+# thread keeps its connection forever)
+for name, (function, nb_args) in SQL_FUNCTIONS.items():
+    db.database.register_function(function, name, nb_args)
+
+def register_sql_functions(conn):
+    """Registers the SQL_FUNCTIONS on a sqlite3 connection opened
+    outside of the app, to write to the tables with triggers :
+
+        conn = sqlite3.connect('database.db')
+        register_sql_functions(conn)
+    """
+    for name, (function, nb_args) in SQL_FUNCTIONS.items():
+        conn.create_function(name, nb_args, function)
 
 assert list(db.database.execute_sql('pragma foreign_keys'))[0][0] == 1
 
+def atomic():
+    """Transaction around a group of writes, when the database supports
+    them. SqliteQueueDatabase doesn't (see config.py) : its writes are
+    applied one by one, the callers validate everything before their
+    first write"""
+    if isinstance(db.database, SqliteQueueDatabase):
+        return contextlib.nullcontext()
+
+    return db.database.atomic()
+
 # Uncomment this to dump all SQL queries
 # import logging
 # logger = logging.getLogger('peewee')
@@ -0,0 +1,74 @@
+// Edits of the page, sent together to /api/edit/
+//
+// The last value of each field wins. The queue is sent 500ms after the
+// last edit and when the page is left. One request at a time : the
+// edits queued meanwhile are sent once it's done, in order
+let pending_edits = {};
+let edits_timer;
+let edits_in_flight = false;
+
+function queue_edit(model, id, column, value, success) {
+    pending_edits[model + '/' + id + '/' + column] = {
+        change: {model: model, id: id, column: column, value: value},
+        success: success,
+    };
+
+    if(typeof(edits_timer) !== 'undefined')
+        clearTimeout(edits_timer);
+
+    edits_timer = setTimeout(flush_edits, 500);
+}
+
+function flush_edits(leaving) {
+    if(typeof(edits_timer) !== 'undefined')
+        clearTimeout(edits_timer);
+
+    edits_timer = undefined;
+
+    let edits = Object.values(pending_edits);
+
+    if(edits.length == 0 || (edits_in_flight && !leaving))
+        return;
+
+    pending_edits = {};
+
+    let data = JSON.stringify({changes: edits.map(edit => edit.change)});
+
+    if(leaving) {
+        // Still sent once the page is closed
+        fetch('/api/edit/', {
+            method: 'POST',
+            body: data,
+            headers: {'Content-Type': 'application/json'},
+            keepalive: true,
+        });
+        return;
+    }
+
+    edits_in_flight = true;
+
+    $.ajax('/api/edit/', {
+        data: data,
+        contentType : 'application/json',
+        type: 'POST',
+        success: function() {
+            edits.forEach(edit => edit.success && edit.success());
+            $(document).trigger('edits-saved');
+        },
+        complete: function() {
+            edits_in_flight = false;
+
+            if(Object.keys(pending_edits).length)
+                flush_edits();
+        },
+    });
+}
+
+window.addEventListener('pagehide', function() {
+    flush_edits(true);
+});
+
+document.addEventListener('visibilitychange', function() {
+    if(document.visibilityState == 'hidden')
+        flush_edits(true);
+});
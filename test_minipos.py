@@ -1,5 +1,7 @@
 import json
 import pytest
+import logging
+import contextlib
 import tempfile
 import os
 from decimal import Decimal
@@ -110,6 +112,24 @@ def test_no_500_errors(client, login):
         assert rv.status_code == 200
 
 
+@contextlib.contextmanager
+def count_queries():
+    """List of the SQL queries logged by peewee in the block"""
+    queries = []
+    handler = logging.Handler()
+    handler.emit = queries.append
+
+    logger = logging.getLogger('peewee')
+    level = logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.DEBUG)
+
+    try:
+        yield queries
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
 def most_recent_workorder():
     from models import Workorder
 
@@ -279,6 +299,42 @@ def test_refund_cornercases(client, login):
         serialized_item = item.serialized()
         assert serialized_item['refunded_in_workorder_id'] and rv.status_code == 302
 
+def test_refund_state(client, login):
+    from models import Workorder
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/1', follow_redirects=True)
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+    workorder = Workorder.get(workorder.id)
+    assert (workorder.refunded_items, workorder.refunded) == (0, False)
+
+    first, second = workorder.items
+
+    for item, refunded_items, refunded in [(first, 1, False), (second, 2, True)]:
+        data = {'refunded_items_id': [item.id], 'workorder_id': workorder.id}
+        rv = client.post('/api/refund/', data=dict(items=json.dumps(data)), follow_redirects=True)
+        refund = most_recent_workorder()
+
+        assert (refund.refunded_items, refund.refunded) == (1, True)
+
+        updated = Workorder.get(workorder.id)
+        assert (updated.refunded_items, updated.refunded) == (refunded_items, refunded)
+
+        # A stale instance doesn't overwrite the refund state
+        workorder.save()
+        assert Workorder.get(workorder.id).refunded_items == refunded_items
+
+    rv = client.get(f'/workorder/refund/{workorder.id}', follow_redirects=False)
+    assert rv.status_code == 302
+
+    # Not editable in the admin either
+    rv = client.get(f'/admin/workorder/edit/?id={workorder.id}')
+    assert rv.status_code == 200 and b'name="bike_description"' in rv.data
+    assert not any(f'name="{field}"'.encode() in rv.data for field in Workorder.derived_fields)
+
 def test_payment(client, login):
     from models import Workorder, Transaction, InventoryItem
     import config
@@ -310,6 +366,35 @@ def test_payment(client, login):
     # TODO : Payment for workorders with weird taxes (eg.: two taxable
     # items, one non-taxable)
 
+def test_payment_save_fails(client, login, monkeypatch):
+    from models import Workorder, Transaction, InventoryItem, SalesLedger
+    import peewee
+    import views
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder_id = most_recent_workorder().id
+
+    inventory_item = InventoryItem.select().order_by(InventoryItem.id.asc()).where(InventoryItem.taxable).get()
+    rv = client.get(f'/api/add-item/{workorder_id}/{inventory_item.id}', follow_redirects=True)
+
+    nb_ledger = SalesLedger.select().count()
+
+    def failing_save(self, *args, **kwargs):
+        raise peewee.OperationalError('database is locked')
+
+    # Like SqliteQueueDatabase : no transaction to roll back
+    monkeypatch.setattr(views, 'atomic', contextlib.nullcontext)
+    monkeypatch.setattr(Workorder, 'save', failing_save)
+
+    rv = client.post(f'/workorder/pay/{workorder_id}', data=dict(payment_method='cash'))
+    assert rv.status_code == 500
+
+    monkeypatch.undo()
+
+    assert Transaction.select().where(Transaction.workorder_id == workorder_id).count() == 0
+    assert not Workorder.get(workorder_id).paid
+    assert SalesLedger.select().count() == nb_ledger
+
 def test_payment_zero_dollar(client, login):
     from models import Workorder, Transaction, InventoryItem
 
@@ -352,6 +437,1109 @@ def test_payment_zero_dollar(client, login):
     rv = client.get(f'/api/add-item/{workorder.id}/{inventory_item.id}', follow_redirects=True)
     assert rv.status_code != 200
 
+def test_workorder_totals(client, login):
+    from models import Workorder
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+
+    # Memoized : no query for the other amounts
+    subtotal = workorder.subtotal()
+
+    with count_queries() as queries:
+        workorder.taxes1(), workorder.taxes(), workorder.total(), workorder.total_discounts()
+
+    assert queries == []
+
+    # Refreshed when the items change
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    assert workorder.subtotal() == 2 * subtotal
+
+    item = workorder.items.get()
+    rv = client.post(f'/api/edit/workorderitem/{item.id}', json=dict(column='taxable', value=False))
+    assert workorder.totals().taxable_subtotal == subtotal
+    assert workorder.taxes() == Workorder.get(workorder.id).taxes()
+
+    rv = client.get(f'/api/delete-workorderitem/{item.id}')
+    assert workorder.subtotal() == subtotal
+
+    rv = client.get(f'/api/total/{workorder.id}')
+    assert rv.json['nb_items'] == 1
+    assert Decimal(rv.json['total']) == workorder.total()
+
+def test_workorder_etag(client, login):
+    from models import Workorder, WorkorderItem
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+
+    for path in [f'/api/total/{workorder.id}', f'/api/items/{workorder.id}']:
+        rv = client.get(path)
+        etag = rv.headers['ETag']
+        assert rv.status_code == 200
+
+        # Not modified : the items are not loaded
+        with count_queries() as queries:
+            rv = client.get(path, headers={'If-None-Match': etag})
+
+        assert rv.status_code == 304 and rv.data == b''
+        assert not any(WorkorderItem._meta.table_name in str(query.msg).lower() for query in queries)
+
+    def etag_after(url, **kwargs):
+        rv = client.post(url, **kwargs) if kwargs else client.get(url, follow_redirects=True)
+        rv = client.get(f'/api/total/{workorder.id}', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        return rv.headers['ETag']
+
+    # Any change of the workorder or its items is a new version
+    etags = {etag}
+    item = workorder.items.get()
+    etags.add(etag := etag_after(f'/api/add-item/{workorder.id}/3'))
+    etags.add(etag := etag_after(f'/api/edit/workorderitem/{item.id}', json=dict(column='nb', value=2)))
+    etags.add(etag := etag_after(f'/api/edit/workorder/{workorder.id}', json=dict(column='invoice_notes', value='Notes')))
+    etags.add(etag := etag_after(f'/api/delete-workorderitem/{item.id}'))
+    assert len(etags) == 5
+
+    rv = client.get(f'/api/items/{workorder.id}')
+    assert [item['id'] for item in rv.json] == [item.id for item in workorder.items.order_by(WorkorderItem.id)]
+    assert client.get('/api/items/0').status_code == 404
+
+def test_batch_items(client, login):
+    from models import Workorder, WorkorderItem, TaxClass
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    first_item = workorder.items.get()
+
+    def batch(*operations):
+        return client.post(f'/api/workorder-items/{workorder.id}', json=dict(operations=operations))
+
+    # A package of parts in a single request
+    rv = batch({'op': 'add', 'inventory_item_id': 3},
+               {'op': 'add', 'inventory_item_id': 6, 'nb': 2},
+               {'op': 'add', 'inventory_item_id': 13},
+               {'op': 'edit', 'id': first_item.id, 'column': 'price', 'value': '40.00'},
+               {'op': 'edit', 'id': first_item.id, 'column': 'nb', 'value': 3})
+    assert rv.status_code == 200
+
+    items = list(workorder.items.order_by(WorkorderItem.id))
+    assert [item.inventory_item_id for item in items] == [2, 3, 6, 13]
+    assert (items[0].nb, items[0].price) == (3, Decimal('40.00'))
+    assert items[2].nb == 2
+    assert [item['id'] for item in rv.json['items']] == [item.id for item in items]
+    assert Decimal(rv.json['total']['total']) == Workorder.get(workorder.id).total()
+
+    rv = batch({'op': 'remove', 'id': items[1].id}, {'op': 'remove', 'id': items[3].id})
+    assert [item['id'] for item in rv.json['items']] == [items[0].id, items[2].id]
+    assert rv.json['total']['nb_items'] == 2
+
+    # Nothing is written when an operation is invalid
+    assert batch({'op': 'add', 'inventory_item_id': 3}, {'op': 'remove', 'id': 0}).status_code == 404
+    assert batch({'op': 'add', 'inventory_item_id': 3}, {'op': 'edit', 'id': items[0].id,
+                                                        'column': 'orig_price', 'value': 0}).status_code == 403
+    assert batch({'op': 'add', 'inventory_item_id': 3}, {'op': 'nope'}).status_code == 400
+    assert batch({'op': 'add', 'inventory_item_id': 3}, {'op': 'edit', 'id': items[0].id,
+                                                        'column': 'price', 'value': 'abc'}).status_code == 400
+    assert batch({'op': 'add', 'inventory_item_id': 3, 'nb': 'two'}).status_code == 400
+    assert batch({'op': 'edit', 'id': items[0].id, 'column': 'taxable', 'value': 'yes'}).status_code == 400
+    assert batch({'op': 'edit', 'id': items[0].id, 'column': 'tax_class', 'value': 999}).status_code == 400
+    assert workorder.items.count() == 2
+
+    rv = batch({'op': 'edit', 'id': items[0].id, 'column': 'tax_class', 'value': TaxClass.EXEMPT},
+               {'op': 'edit', 'id': items[0].id, 'column': 'taxable', 'value': 0})
+    assert rv.status_code == 200
+    assert WorkorderItem.get_by_id(items[0].id).tax_class_id == TaxClass.EXEMPT
+    assert WorkorderItem.get_by_id(items[0].id).taxable is False
+
+    # Items of other workorders can't be touched
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    other = most_recent_workorder()
+    rv = client.post(f'/api/workorder-items/{other.id}', json=dict(operations=[{'op': 'remove', 'id': items[0].id}]))
+    assert rv.status_code == 404
+
+    # The last operation would break a foreign key (a refund of the
+    # line) : refused before the first write
+    refund = WorkorderItem.create(workorder=other, name='Refund', nb=-1, price=items[2].price,
+                                  orig_price=items[2].orig_price, refund_item=items[2])
+    rv = batch({'op': 'add', 'inventory_item_id': 3},
+               {'op': 'edit', 'id': items[0].id, 'column': 'nb', 'value': 5},
+               {'op': 'remove', 'id': items[2].id})
+    assert rv.status_code == 403
+    assert [(item.id, item.nb) for item in workorder.items.order_by(WorkorderItem.id)] == \
+           [(items[0].id, 3), (items[2].id, 2)]
+    refund.delete_instance()
+
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+    assert batch({'op': 'add', 'inventory_item_id': 3}).status_code == 403
+
+def test_edit_models(client, login):
+    from models import Client, Workorder, WorkorderItem
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    rv = client.get(f'/api/add-item/{workorder.id}/3', follow_redirects=True)
+    item, other_item = workorder.items.order_by(WorkorderItem.id)
+    first_client = Client.select().order_by(Client.id).first()
+
+    def edit(*changes):
+        return client.post('/api/edit/', json=dict(changes=[dict(zip(['model', 'id', 'column', 'value'], change))
+                                                           for change in changes]))
+
+    # One UPDATE per model
+    with count_queries() as queries:
+        rv = edit(('workorderitem', item.id, 'name', 'Tuneup'),
+                  ('workorderitem', item.id, 'nb', 2),
+                  ('workorderitem', item.id, 'nb', 3),
+                  ('workorderitem', other_item.id, 'price', '1.50'),
+                  ('workorder', workorder.id, 'invoice_notes', 'Notes'),
+                  ('workorder', workorder.id, 'calendar_date', '2022-01-02T10:00:00'),
+                  ('client', first_client.id, 'phone', '514 000 0000'),
+                  ('client', first_client.id, 'year_of_birth', '1984'))
+
+    assert rv.status_code == 200
+    assert sum(str(query.msg).startswith("('UPDATE") for query in queries) == 3
+
+    item, other_item = WorkorderItem.get_by_id(item.id), WorkorderItem.get_by_id(other_item.id)
+    assert (item.name, item.nb) == ('Tuneup', 3)
+    assert other_item.name != 'Tuneup'
+    assert (other_item.nb, other_item.price) == (1, Decimal('1.50'))
+    assert Client.get_by_id(first_client.id).year_of_birth == 1984
+    assert Workorder.get_by_id(workorder.id).calendar_date.day == 2
+    assert Client.get_by_id(first_client.id).phone == '514 000 0000'
+
+    # Nothing is written when a change is invalid
+    assert edit(('workorderitem', item.id, 'nb', 4), ('workorder', workorder.id, 'paid_total', 0)).status_code == 403
+    assert edit(('workorderitem', item.id, 'nb', 4), ('client', 0, 'phone', '')).status_code == 404
+    assert edit(('workorderitem', item.id, 'nb', 4), ('nope', 1, 'name', '')).status_code == 404
+    assert client.post('/api/edit/', json=dict(changes=[{'model': 'client'}])).status_code == 400
+
+    # Bad values are refused before anything is written, even the last one
+    for change in [('workorder', workorder.id, 'status', 999), ('client', first_client.id, 'year_of_birth', 'old'),
+                   ('client', first_client.id, 'first_name', None), ('workorderitem', other_item.id, 'price', 'x')]:
+        assert edit(('workorderitem', item.id, 'nb', 4), ('client', first_client.id, 'phone', ''), change).status_code == 400
+
+    assert WorkorderItem.get_by_id(item.id).nb == 3
+    assert Client.get_by_id(first_client.id).phone == '514 000 0000'
+
+    # The pages queue their edits for /api/edit/ (see static/js/edits.js)
+    for path in [f'/workorder/{workorder.id}', f'/client/{first_client.id}']:
+        rv = client.get(path)
+        assert b'/static/js/edits.js' in rv.data and b'queue_edit(' in rv.data and b"'/api/edit/" not in rv.data
+
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+    assert edit(('workorder', workorder.id, 'invoice_notes', ''), ('workorderitem', item.id, 'nb', 4)).status_code == 403
+    assert Workorder.get_by_id(workorder.id).invoice_notes == 'Notes'
+
+def test_serialize_many(client, login):
+    from models import Workorder, WorkorderItem
+
+    nb_queries = []
+
+    for nb_items in [2, 30]:
+        rv = client.get('/workorder/new/direct', follow_redirects=True)
+        workorder = most_recent_workorder()
+
+        for i in range(nb_items):
+            rv = client.get(f'/api/add-item/{workorder.id}/{i % 3 + 1}', follow_redirects=True)
+
+        rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+        first_item = workorder.items.order_by(WorkorderItem.id).first()
+        data = {'refunded_items_id': [first_item.id], 'workorder_id': workorder.id}
+        rv = client.post('/api/refund/', data=dict(items=json.dumps(data)), follow_redirects=True)
+        refund = most_recent_workorder()
+
+        with count_queries() as queries:
+            items = WorkorderItem.serialize_many(workorder.items)
+
+        nb_queries.append(len(queries))
+
+        assert len(items) == nb_items
+        assert items[0] == {'id': first_item.id, 'name': first_item.name, 'nb': 1, 'taxable': True,
+                            'price': str(round(first_item.price, 2)), 'orig_price': str(round(first_item.orig_price, 2)),
+                            'type': first_item.inventory_item.type,
+                            'refund_workorder_id': False, 'refunded_in_workorder_id': refund.id}
+        assert [item['refunded_in_workorder_id'] for item in items[1:]] == [False] * (nb_items - 1)
+
+        refund_item, = WorkorderItem.serialize_many(refund.items)
+        assert refund_item['refund_workorder_id'] == workorder.id
+
+        for path in [f'/workorder/{workorder.id}', f'/workorder/refund/{workorder.id}']:
+            with count_queries() as queries:
+                rv = client.get(path)
+
+            assert rv.status_code == 200
+            nb_queries.append(len(queries))
+
+    # Same number of queries for 2 and 30 items
+    assert nb_queries[:3] == nb_queries[3:]
+
+def test_money_same_as_decimal():
+    from models import WorkorderTotals, WorkorderItem, TaxClass, TAX_RATES
+    import random
+
+    rand = random.Random(42)
+
+    tax_classes = {
+        TaxClass.STANDARD: TaxClass(id=TaxClass.STANDARD, tax1_rate=None, tax2_rate=Decimal('0.15')),
+        TaxClass.EXEMPT: TaxClass(id=TaxClass.EXEMPT, tax1_rate=0, tax2_rate=0),
+    }
+
+    for _ in range(500):
+        items = [WorkorderItem(nb=Decimal(rand.randint(-300, 300)) / 100,
+                               price=Decimal(rand.randint(0, 100000)) / 1000,
+                               orig_price=Decimal(rand.randint(0, 10000)) / 100,
+                               taxable=rand.random() < 0.7)
+                 for _ in range(rand.randint(1, 6))]
+
+        totals = WorkorderTotals(items, tax_classes)
+
+        # Version 1, see Workorder._calc_taxes()
+        taxable = sum((item.nb * item.price for item in items if item.taxable), Decimal('0.00'))
+        discounts = sum(((item.orig_price - item.price) * item.nb for item in items if item.price < item.orig_price), Decimal(0))
+
+        assert totals.subtotal == sum((item.nb * item.price for item in items), Decimal('0.00'))
+        assert totals.total_discounts == round(discounts, 2)
+        assert totals.taxes(0) == round(taxable * TAX_RATES[0], 2)
+        assert totals.taxes(1) == round(taxable * Decimal('0.15'), 2)
+
+def test_tax_classes(client, login):
+    from models import Workorder, WorkorderItem, InventoryItem, TaxClass
+    import datetime
+    import peewee
+
+    zero_rated = TaxClass.create(name='Zero-rated', tax1_rate=0, tax2_rate=0)
+    federal_only = TaxClass.create(name='Federal only', tax1_rate=None, tax2_rate=0)
+    InventoryItem.update(tax_class=zero_rated).where(InventoryItem.id == 6).execute()
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+
+    for inventory_item_id in [2, 3, 6, 13]:
+        rv = client.get(f'/api/add-item/{workorder.id}/{inventory_item_id}', follow_redirects=True)
+
+    items = list(workorder.items.order_by(WorkorderItem.id))
+    assert items[2].tax_class_id == zero_rated.id
+    WorkorderItem.update(tax_class=federal_only).where(WorkorderItem.id == items[1].id).execute()
+    workorder.invalidate_totals()
+
+    # The classes are loaded once, not once per item
+    items = list(workorder.items.order_by(WorkorderItem.id))
+
+    with count_queries() as queries:
+        [item.taxes1() + item.taxes2() for item in items]
+
+    assert len(queries) <= 1
+
+    breakdown = {tax_class.id: amounts for tax_class, amounts in TaxClass.breakdown(Workorder.id == workorder.id).items()}
+    standard, exempt = breakdown[TaxClass.STANDARD], breakdown[TaxClass.EXEMPT]
+
+    assert breakdown[zero_rated.id]['taxes1'] == breakdown[zero_rated.id]['taxes2'] == 0
+    assert breakdown[federal_only.id]['taxes1'] > 0 and breakdown[federal_only.id]['taxes2'] == 0
+    assert exempt == {'nb_items': 1, 'subtotal': items[3].price, 'taxes1': 0, 'taxes2': 0}
+    assert standard['subtotal'] == items[0].price
+    assert standard['taxes1'] == round(items[0].price * Decimal('0.05'), 2)
+
+    # Same amounts as the workorder
+    assert sum(amounts['subtotal'] for amounts in breakdown.values()) == workorder.subtotal()
+    assert sum(amounts['taxes1'] for amounts in breakdown.values()) == workorder.taxes1()
+    assert sum(amounts['taxes2'] for amounts in breakdown.values()) == workorder.taxes2()
+
+    # The paid breakdown uses the archived amounts
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+    today = datetime.date.today()
+    stats = Workorder.paid_stats(today, today)
+    breakdown = TaxClass.paid_breakdown(today, today)
+
+    for col in ['subtotal', 'taxes1', 'taxes2']:
+        assert sum(amounts[col] for amounts in breakdown.values()) == stats[col]
+
+    # The rates of the classes with paid items are locked
+    with pytest.raises(peewee.IntegrityError):
+        TaxClass.update(tax2_rate=Decimal('0.01')).where(TaxClass.id == federal_only.id).execute()
+
+    TaxClass.update(name='Federal').where(TaxClass.id == federal_only.id).execute()
+    assert TaxClass.paid_breakdown(today, today) == breakdown
+
+    rv = client.post(f'/admin/taxclass/edit/?id={zero_rated.id}',
+                     data=dict(name='Zero-rated', tax1_rate='0.01', tax2_rate='0'), follow_redirects=True)
+    assert b'Create a new class' in rv.data
+    assert TaxClass.get_by_id(zero_rated.id).tax1_rate == 0
+
+    unused = TaxClass.create(name='Unused', tax1_rate=0, tax2_rate=0)
+    rv = client.post(f'/admin/taxclass/edit/?id={unused.id}',
+                     data=dict(name='Unused', tax1_rate='0.01', tax2_rate='0'), follow_redirects=True)
+    assert TaxClass.get_by_id(unused.id).tax1_rate == Decimal('0.01')
+    assert TaxClass.by_id()[unused.id].rate(0) == Decimal('0.01')
+
+    # The classes of the items without a class and the classes in use
+    # can't be deleted
+    for tax_class_id in [TaxClass.STANDARD, TaxClass.EXEMPT, zero_rated.id]:
+        rv = client.post('/admin/taxclass/delete/', data=dict(id=tax_class_id), follow_redirects=True)
+        assert b'can not be deleted' in rv.data
+
+    rv = client.post('/admin/taxclass/action/', data=dict(action='delete', rowid=[TaxClass.EXEMPT, unused.id]),
+                     follow_redirects=True)
+    assert TaxClass.get_or_none(id=TaxClass.EXEMPT) is not None
+
+    rv = client.post('/admin/taxclass/delete/', data=dict(id=unused.id), follow_redirects=True)
+    assert TaxClass.get_or_none(id=unused.id) is None
+    assert WorkorderItem.get_by_id(items[2].id).tax_class_id == zero_rated.id
+
+    InventoryItem.update(tax_class=None).where(InventoryItem.id == 6).execute()
+
+def test_cash_register(client, login):
+    from models import Transaction
+    import re
+
+    def visa_total():
+        rv = client.get('/cash-register/')
+        assert rv.status_code == 200
+        return Decimal(re.search(r'Visa : \$([-0-9.,]+)', rv.data.decode()).group(1).replace(',', ''))
+
+    total = visa_total()
+
+    Transaction.create(amount=Decimal('0.10'), payment_method='visa', comment='')
+    Transaction.create(amount=Decimal('0.20'), payment_method='visa', comment='')
+
+    assert visa_total() == total + Decimal('0.30')
+
+def test_reports_stats(client, login):
+    from models import Workorder, InventoryItem
+    import datetime
+
+    # Discounted items, rounded per workorder
+    for price in ['1.005', '2.675']:
+        rv = client.get('/workorder/new/direct', follow_redirects=True)
+        workorder = most_recent_workorder()
+
+        inventory_item = InventoryItem.select().order_by(InventoryItem.id.asc()).where(InventoryItem.taxable).get()
+        rv = client.get(f'/api/add-item/{workorder.id}/{inventory_item.id}', follow_redirects=True)
+        item = workorder.items.get()
+
+        rv = client.post(f'/api/edit/workorderitem/{item.id}', json=dict(column='price', value=price))
+        rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+    date_start = datetime.date.today() - datetime.timedelta(days=365)
+    date_end = datetime.date.today()
+
+    expected = dict.fromkeys(['subtotal', 'total', 'taxes1', 'taxes2', 'taxes', 'total_discounts'], Decimal(0))
+
+    paid_workorders = Workorder.select().where(Workorder.paid)
+    paid_workorders = [w for w in paid_workorders if date_start <= w.paid_date.date() <= date_end]
+
+    for workorder in paid_workorders:
+        for k in expected:
+            expected[k] += getattr(workorder, k)()
+
+    assert expected['total_discounts'] > 0
+    assert Workorder.paid_stats(date_start, date_end) == expected
+
+    # Nothing paid in this range
+    assert set(Workorder.paid_stats(date_end + datetime.timedelta(days=1), date_end).values()) == {Decimal(0)}
+
+    rv = client.get('/reports/')
+    assert rv.status_code == 200
+
+def test_report_jobs(client, login, monkeypatch):
+    from models import Workorder, ReportJob
+    import jobs
+    import threading
+    import datetime
+
+    rv = client.get('/reports/')
+    assert rv.status_code == 200 and b'Taxes per tax class' in rv.data
+
+    # Keep the jobs in flight until released
+    release = threading.Event()
+    compute_report = jobs.compute_report
+
+    def blocked_compute_report(*args):
+        assert release.wait(10)
+        return compute_report(*args)
+
+    monkeypatch.setattr(jobs, 'compute_report', blocked_compute_report)
+    monkeypatch.setattr('views.REPORT_WAIT', 0)
+
+    date_start = datetime.date(2021, 1, 1)
+    date_end = datetime.date.today()
+    path = f'/reports/?date_start={date_start}&date_end={date_end}'
+
+    rv = client.get(path)
+    assert rv.status_code == 200 and b'is being computed' in rv.data
+    job = ReportJob.select().order_by(ReportJob.id.desc()).get()
+
+    # Same range : same job
+    rv = client.get(path)
+    assert ReportJob.select().order_by(ReportJob.id.desc()).get().id == job.id
+    assert jobs.submit_report(date_start, date_end).id == job.id
+    assert jobs.submit_report(date_start, date_end - datetime.timedelta(days=1)).id != job.id
+
+    rv = client.get(f'/reports/jobs/{job.id}')
+    assert rv.json['status'] in ('pending', 'running') and rv.json['date_start'] == '2021-01-01'
+
+    release.set()
+    assert jobs.wait(job.id, timeout=10).status == 'done'
+
+    rv = client.get(f'/reports/jobs/{job.id}')
+    assert rv.json['status'] == 'done' and rv.json['progress'] == 100
+
+    rv = client.get(f'/reports/jobs/{job.id}/result')
+    stats = Workorder.paid_stats(date_start, date_end)
+    assert rv.status_code == 200 and ('$' + format(stats['total'], ',.2f')).encode() in rv.data
+
+    # Done jobs are not reused
+    new_job = jobs.submit_report(date_start, date_end)
+    assert new_job.id != job.id
+    assert jobs.wait(new_job.id, timeout=10).status == 'done'
+    assert client.get('/reports/jobs/0').status_code == 404
+
+    # Failures are stored
+    monkeypatch.setattr(jobs, 'compute_report', lambda *args: 1 / 0)
+    job = jobs.wait(jobs.submit_report(date_start, date_start).id, timeout=10)
+    assert job.status == 'failed' and 'ZeroDivisionError' in job.error
+
+    # Not while a SELECT is open : the jobs couldn't write their result
+    for other in list(ReportJob.select()):
+        jobs.wait(other.id, timeout=10)
+
+    # Left running by a previous process, finished long ago
+    long_ago = jobs.STARTED - jobs.JOB_TTL - datetime.timedelta(hours=1)
+    stale = ReportJob.create(date_start=date_start, date_end=date_end, status='running', created=long_ago)
+    ReportJob.create(date_start=date_start, date_end=date_end, status='done', created=long_ago, finished=long_ago)
+
+    jobs.recover_jobs()
+    rv = client.get(f'/reports/jobs/{stale.id}')
+    assert rv.json['status'] == 'failed' and 'restart' in rv.json['error']
+    # The jobs of this process are left alone
+    assert ReportJob.select().where((ReportJob.created > jobs.STARTED) & (ReportJob.status == 'failed')).count() == 1
+
+    # The ids of the deleted jobs can be reused
+    jobs.submit_report(date_start, date_end)
+    assert [j.id for j in ReportJob.select().where(ReportJob.created == long_ago)] == [stale.id]
+
+    for other in list(ReportJob.select()):
+        jobs.wait(other.id, timeout=10)
+
+def test_sales_ledger(client, login):
+    from models import Workorder, SalesLedger
+    from create_db import rebuild_sales_ledger
+    import datetime
+
+    def ledger_rows():
+        # Without the ids
+        return sorted(row[1:] for row in SalesLedger.select().tuples())
+
+    # Taxable and non-taxable items, then a refund of one of them
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+
+    for inventory_item_id in [2, 6, 13]:
+        rv = client.get(f'/api/add-item/{workorder.id}/{inventory_item_id}', follow_redirects=True)
+
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='visa'), follow_redirects=True)
+
+    data = {'refunded_items_id': [workorder.items[0].id], 'workorder_id': workorder.id}
+    rv = client.post('/api/refund/', data=dict(items=json.dumps(data)), follow_redirects=True)
+    refund = most_recent_workorder()
+    rv = client.post(f'/workorder/pay/{refund.id}', data=dict(payment_method='visa'), follow_redirects=True)
+    assert Workorder.get(refund.id).paid_total < 0
+
+    # A paid workorder without items (can be imported) is counted too
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    empty = most_recent_workorder()
+    empty.set_paid()
+    empty.save()
+
+    # The report stats and the series read the ledger
+    today = datetime.date.today()
+    paid = [w for w in Workorder.select().where(Workorder.paid) if w.paid_date.date() == today]
+    stats = Workorder.paid_stats(today, today)
+    rows = SalesLedger.select().where(SalesLedger.day == today)
+
+    for col in ['subtotal', 'taxes1', 'taxes2']:
+        assert stats[col] == sum(getattr(row, col) for row in rows) == sum(getattr(w, 'paid_' + col) for w in paid)
+
+    assert stats['total_discounts'] == sum(w.total_discounts() for w in paid)
+    assert sum(row.nb_workorders for row in rows) == len(paid)
+    assert sum(row.total for row in rows) == sum(w.paid_total for w in paid)
+    assert {(row.payment_method, row.taxable) for row in rows} >= {('visa', True), ('visa', False)}
+
+    # Same rows when rebuilt from scratch
+    rows = ledger_rows()
+    rebuild_sales_ledger()
+    assert ledger_rows() == rows
+
+def test_postal_code_stats(client, login):
+    from models import Client, postal_codes
+    import collections
+
+    for postal_code in ['h2r 2a1', ' H2S 1B1', 'H2S1B2', 'J0B 1A1', '', 'X']:
+        Client.create(first_name='Postal', last_name='Code', postal_code=postal_code)
+
+    client_row = Client.get(Client.postal_code == 'X')
+    client_row.postal_code = 'h3z 2y7'
+    client_row.save()
+    assert Client.get_by_id(client_row.id).postal_fsa == 'H3Z'
+
+    counts = collections.Counter(c.postal_code.strip().upper()[:3] for c in Client.select())
+    unknown = counts.pop('')
+    top = sorted(counts.items(), key=lambda fsa_nb: (-fsa_nb[1], fsa_nb[0]))[:2]
+
+    with count_queries() as queries:
+        stats = Client.postal_code_stats(top=2)
+
+    assert len(queries) == 1
+    assert stats == {
+        'top': [{'fsa': fsa, 'region': postal_codes.get(fsa, ''), 'nb': nb} for fsa, nb in top],
+        'others': sum(counts.values()) - sum(nb for _, nb in top),
+        'unknown': unknown,
+    }
+
+    rv = client.get('/reports/')
+    assert rv.status_code == 200
+
+def test_export_sales(client, login):
+    from models import Workorder, WorkorderItem, Transaction
+    import export
+    import csv
+    import datetime
+
+    # Opened before the export, paid after it
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    late = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{late.id}/2', follow_redirects=True)
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+    paid = Workorder.select().where(Workorder.paid).order_by(Workorder.paid_date, Workorder.id)
+
+    # Same records whatever the chunk size
+    records = list(export.export_records())
+    assert records == list(export.export_records(chunk_size=1))
+
+    assert [row['id'] for kind, row in records if kind == 'workorder'] == [w.id for w in paid]
+    assert len([kind for kind, row in records if kind == 'item']) == \
+        WorkorderItem.select().join(Workorder).where(Workorder.paid).count()
+    assert len([kind for kind, row in records if kind == 'transaction']) == \
+        Transaction.select().join(Workorder).where(Workorder.paid).count()
+
+    # Children right after their workorder
+    workorder_id = None
+
+    for kind, row in records:
+        if kind == 'workorder':
+            workorder_id = row['id']
+        else:
+            assert row.get('workorder', row.get('workorder_id')) == workorder_id
+
+    # Incremental and date range pulls
+    since = (paid[0].paid_date, paid[0].id)
+    assert [row['id'] for kind, row in export.export_records(since=since) if kind == 'workorder'] == \
+        [w.id for w in paid[1:]]
+
+    today = datetime.date.today()
+    assert {row['paid_date'].date() for kind, row in export.export_records(today) if kind == 'workorder'} == {today}
+
+    rv = client.get('/reports/export?format=csv')
+    assert rv.status_code == 200 and rv.mimetype == 'text/csv'
+    rows = list(csv.DictReader(rv.data.decode().splitlines()))
+    assert [row['record'] for row in rows] == [kind for kind, _ in records]
+    assert rows[0]['paid_total'] == str(paid[0].paid_total)
+
+    cursor = rv.headers['X-Export-Cursor']
+    assert export.parse_cursor(cursor) == (paid[-1].paid_date, paid[-1].id)
+
+    # The older workorder is in the next incremental export
+    rv = client.post(f'/workorder/pay/{late.id}', data=dict(payment_method='cash'), follow_redirects=True)
+    assert late.id < paid[-1].id
+
+    rv = client.get(f'/reports/export?format=jsonl&date_start={today}&since={cursor}')
+    lines = [json.loads(line) for line in rv.data.decode().splitlines()]
+    assert [line['id'] for line in lines if line['record'] == 'workorder'] == [late.id]
+    assert all(line['workorder_id'] == late.id for line in lines if line['record'] != 'workorder')
+    assert export.parse_cursor(rv.headers['X-Export-Cursor'])[1] == late.id
+
+    # Nothing new
+    rv = client.get(f"/reports/export?format=jsonl&since={rv.headers['X-Export-Cursor']}")
+    assert rv.data == b''
+
+    assert client.get('/reports/export?format=xlsx').status_code == 400
+    assert client.get('/reports/export?date_start=yesterday').status_code == 400
+    assert client.get('/reports/export?since=1234').status_code == 400
+
+def test_sales_series(client, login):
+    from models import Workorder
+    import series
+    import datetime
+
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+    today = datetime.date.today()
+    paid = [w for w in Workorder.select().where(Workorder.paid)]
+
+    for granularity in series.GRANULARITIES:
+        sales = series.sales_series(granularity, datetime.date(2021, 1, 1), today)
+        assert len({len(values) for key, values in sales.items() if key != 'granularity'}) == 1
+
+        # Every paid workorder is in the bucket that contains its date
+        buckets = [datetime.date.fromisoformat(bucket) for bucket in sales['bucket']]
+        expected = [0] * len(buckets)
+
+        for w in paid:
+            i = max(i for i, bucket in enumerate(buckets) if bucket <= w.paid_date.date())
+            expected[i] += w.paid_total
+
+        assert sales['total'] == [float(total) for total in expected]
+        assert sum(sales['nb_workorders']) == len(paid)
+        assert sales['bucket'][0] <= '2021-01-01' and sales['bucket'][-1] <= today.isoformat()
+
+    # Closed periods come from the cache, the current one is recomputed
+    with count_queries() as queries:
+        closed = series.sales_series('month', datetime.date(2021, 1, 1), datetime.date(2021, 12, 31))
+
+    assert len(queries) == 1 and 'salesledgerversion' in str(queries[0].msg)
+
+    # Until the ledger of a closed day changes, even from another
+    # process (flask rebuild-sales-ledger)
+    from create_db import rebuild_sales_ledger
+
+    backdated = paid[-1]
+    Workorder.update(paid_date=datetime.datetime(2021, 3, 5, 12)).where(Workorder.id == backdated.id).execute()
+    rebuild_sales_ledger()
+
+    sales = series.sales_series('month', datetime.date(2021, 1, 1), datetime.date(2021, 12, 31))
+    assert sales['total'][2] == closed['total'][2] + float(backdated.paid_total)
+
+    Workorder.update(paid_date=backdated.paid_date).where(Workorder.id == backdated.id).execute()
+    rebuild_sales_ledger()
+    assert series.sales_series('month', datetime.date(2021, 1, 1), datetime.date(2021, 12, 31)) == closed
+
+    with count_queries() as queries:
+        sales = series.sales_series('day', today, today)
+
+    # The version and the current bucket
+    assert len(queries) == 2
+    assert sales['total'] == [float(sum(w.paid_total for w in paid if w.paid_date.date() == today))]
+
+    rv = client.get('/api/reports/sales-series?granularity=week')
+    assert rv.status_code == 200 and rv.json['granularity'] == 'week'
+    assert client.get('/api/reports/sales-series?granularity=year').status_code == 400
+
+def test_sales_snapshot(client, login):
+    from models import Workorder, InventoryItem
+    from analytics import SalesSnapshot
+    import datetime
+
+    def same_items_sold(snapshot):
+        # The SQL sum is a REAL
+        sql = sorted((round(item['total_sold'], 2), item['name']) for item in InventoryItem.items_sold(start, end))
+        return sorted((float(item['total_sold']), item['name']) for item in snapshot.items_sold(start, end)) == sql
+
+    start, end = datetime.date(2000, 1, 1), datetime.date.today()
+
+    snapshot = SalesSnapshot()
+    snapshot.refresh()
+
+    assert snapshot.paid_stats(start, end) == Workorder.paid_stats(start, end)
+    assert same_items_sold(snapshot)
+
+    # Only the new payments are loaded
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    rv = client.get(f'/api/add-item/{workorder.id}/2', follow_redirects=True)
+    rv = client.post(f'/workorder/pay/{workorder.id}', data=dict(payment_method='cash'), follow_redirects=True)
+
+    nb_lines = len(snapshot)
+    snapshot.refresh()
+
+    assert len(snapshot) == nb_lines + 2
+    assert snapshot.paid_stats(start, end) == Workorder.paid_stats(start, end)
+    assert snapshot.paid_stats(end, end) == Workorder.paid_stats(end, end)
+    assert same_items_sold(snapshot)
+
+    with count_queries() as queries:
+        snapshot.refresh()
+
+    assert len(queries) == 1 and len(snapshot) == nb_lines + 2
+
+    assert sum(snapshot.sum_by('type', 'nb').values()) == sum(snapshot.sum_by('month', 'nb').values())
+
+def test_search_inventory_items(client, login):
+    from models import InventoryItem
+
+    rv = client.get('/api/search/inventory_items/?query=chambre')
+    names = [item['name'] for item in rv.json['results']]
+    assert rv.json['total_count'] == 2
+    assert set(names) == {'Chambre à air', 'Chambre à air + Installation'}
+
+    # Typos are tolerated
+    rv = client.get('/api/search/inventory_items/?query=chanbre')
+    assert 'Chambre à air' in [item['name'] for item in rv.json['results']]
+
+    # Keywords are searched too
+    rv = client.get('/api/search/inventory_items/?query=crevaison')
+    assert rv.json['total_count'] == 2
+
+    # The index follows the changes made to the items
+    item = InventoryItem.create(name='Pédale plateforme', keywords='pedal',
+                                sku_code='PD-1234', price=20, cost=10, msrp=25)
+
+    rv = client.get('/api/search/inventory_items/?query=pd-1234')
+    assert [i['id'] for i in rv.json['results']] == [item.id]
+
+    item.archived = True
+    item.save()
+
+    rv = client.get('/api/search/inventory_items/?query=pd-1234')
+    assert rv.json['total_count'] == 0
+
+    rv = client.get('/api/search/inventory_items/?query=a')
+    assert rv.json['results'] == []
+
+    # Accents, case and inches are folded
+    item = InventoryItem.create(name='Pneu 26\'\' ÉCONO', sku_code='PN-26', price=20, cost=10, msrp=25)
+    assert InventoryItem.get_by_id(item.id).search_name == 'pneu 26" econo'
+
+    rv = client.get('/api/search/inventory_items/?query=26" econo')
+    assert [i['id'] for i in rv.json['results']] == [item.id]
+    assert 'search_name' not in rv.json['results'][0]
+
+    rv = client.get('/api/search/inventory_items/?query=avancee')
+    assert rv.json['results'][0]['name'] == 'Mise au point avancée'
+
+    # Admin search uses the full-text index too
+    rv = client.get('/admin/inventoryitem/?search=mise+hiv')
+    assert rv.status_code == 200
+    assert b'Mise au point hiver standard' in rv.data
+    assert b'Mise au point standard' not in rv.data
+
+def test_sql_functions_outside_app(client):
+    import sqlite3
+    import config
+    from models import InventoryItem
+    from setup_app import register_sql_functions
+
+    item = InventoryItem.select().order_by(InventoryItem.id).first()
+    update = f"UPDATE inventoryitem SET name = 'Chaîne' WHERE id = {item.id}"
+
+    # The search triggers call search_key()
+    conn = sqlite3.connect(config.DATABASE['name'])
+
+    with pytest.raises(sqlite3.OperationalError, match='no such function: search_key'):
+        conn.execute(update)
+
+    register_sql_functions(conn)
+    conn.execute(update)
+    conn.commit()
+    conn.close()
+
+    assert InventoryItem.get_by_id(item.id).search_name == 'chaine'
+
+    # Back to its name
+    item.save()
+
+    # The client key triggers call phone_key(), email_key() and name_key()
+    from models import Client, ClientKey
+
+    first, second = Client.select().order_by(Client.id)[:2]
+    update = f"UPDATE client SET phone = '(514) 555-0199' WHERE id IN ({first.id}, {second.id})"
+
+    conn = sqlite3.connect(config.DATABASE['name'])
+
+    with pytest.raises(sqlite3.OperationalError, match='no such function'):
+        conn.execute(update)
+
+    register_sql_functions(conn)
+    conn.execute(update)
+    conn.commit()
+    conn.close()
+
+    keys = ClientKey.select().where((ClientKey.kind == 'phone') & ClientKey.client.in_([first.id, second.id]))
+    assert [key.duplicate for key in keys] == [True, True]
+
+    for row in (first, second):
+        row.save()
+
+def test_scan(client, login):
+    from models import InventoryItem, WorkorderItem
+    import peewee
+
+    item = InventoryItem.create(name='Tube 700c', ean_code='0012345678905', sku_code='TB-700',
+                                price=8, cost=4, msrp=10)
+
+    # UPC-A, EAN-13, without the check digit, or by SKU
+    for code in ['012345678905', '0012345678905', '01234567890', ' TB-700 ']:
+        rv = client.get(f'/api/scan/{code}')
+        assert rv.json['id'] == item.id
+
+    assert client.get('/api/scan/012345678900').status_code == 404
+    assert client.get('/api/scan/TB-7').status_code == 404
+
+    # Scanned items are added to the workorder
+    rv = client.get('/workorder/new/direct', follow_redirects=True)
+    workorder = most_recent_workorder()
+
+    rv = client.get(f'/api/scan/{workorder.id}/012345678905')
+    assert rv.status_code == 200
+    assert WorkorderItem.get_by_id(rv.json['id']).inventory_item_id == item.id
+    assert workorder.items.count() == 1
+
+    # Codes are unique among the active items
+    with pytest.raises(peewee.IntegrityError):
+        InventoryItem.create(name='Tube 700c (copy)', sku_code='TB-700', price=8, cost=4, msrp=10)
+
+    item.archived = True
+    item.save()
+
+    assert client.get('/api/scan/TB-700').status_code == 404
+
+    copy = InventoryItem.create(name='Tube 700c (new)', sku_code='TB-700', price=8, cost=4, msrp=10)
+    assert client.get('/api/scan/TB-700').json['id'] == copy.id
+
+def test_search_clients(client, login):
+    from models import Client
+
+    rv = client.get('/api/search/clients/?query=whoo')
+    assert {c['first_name'] for c in rv.json} == {'Jimmy', 'Alice'}
+
+    rv = client.get('/api/search/clients/?query=alice+whooper')
+    assert rv.json[0]['first_name'] == 'Alice'
+
+    # Typos are tolerated
+    rv = client.get('/api/search/clients/?query=hortn')
+    assert [c['last_name'] for c in rv.json] == ['Horton']
+
+    rv = client.get('/clients/?query=hortn')
+    assert b'Theresa' in rv.data
+    assert b'Jimmy' not in rv.data
+
+    # Edits are searchable right away
+    louise = Client.get(Client.first_name == 'Louise')
+    rv = client.post(f'/api/edit/client/{louise.id}', json={'column': 'last_name', 'value': 'Zimmerman'})
+    assert rv.status_code == 200
+
+    rv = client.get('/api/search/clients/?query=zimm')
+    assert [c['id'] for c in rv.json] == [louise.id]
+
+    rv = client.get('/api/search/clients/?query=zimerman')
+    assert [c['id'] for c in rv.json] == [louise.id]
+
+def test_search_full_results_pages(client, login):
+    from models import InventoryItem
+
+    ids = {InventoryItem.create(name=f'Rayon {i}mm' + ' rayon' * (i % 3), price=1, cost=0, msrp=0).id
+           for i in range(230)}
+
+    # "rayonn" has a typo : found by the in-memory index instead of FTS
+    for query in ['rayon', 'rayonn']:
+        rv = client.get(f'/api/search/inventory_items/?full=1&query={query}')
+        assert rv.json['total_count'] == 230
+
+        pages = [rv.json['results']]
+
+        while rv.json['next']:
+            rv = client.get(f'/api/search/inventory_items/?full=1&query={query}&cursor={rv.json["next"]}')
+            assert rv.json['total_count'] is None
+            pages.append(rv.json['results'])
+
+        assert [len(page) for page in pages] == [100, 100, 30]
+
+        results = [item['id'] for page in pages for item in page]
+        assert set(results) == ids and len(results) == len(ids)
+
+    assert client.get('/api/search/inventory_items/?full=1&query=rayon&cursor=nope').status_code == 400
+
+    for item_id in ids:
+        InventoryItem.get_by_id(item_id).delete_instance()
+
+def test_search_cache(client, login):
+    from models import InventoryItem
+
+    stats = client.get('/api/search/stats').json['inventory_items']
+
+    rv = client.get('/api/search/inventory_items/?query=Pneu+USAGE')
+    total_count = rv.json['total_count']
+
+    rv = client.get('/api/search/inventory_items/?query=pneu++usagé')
+    assert rv.json['total_count'] == total_count
+
+    new_stats = client.get('/api/search/stats').json['inventory_items']
+    assert new_stats['misses'] == stats['misses'] + 1
+    assert new_stats['hits'] == stats['hits'] + 1
+
+    # Saved items invalidate the cache
+    item = InventoryItem.create(name='Pneu usagé 20"', price=10, cost=0, msrp=0)
+
+    rv = client.get('/api/search/inventory_items/?query=pneu+usage')
+    assert rv.json['total_count'] == total_count + 1
+
+    item.delete_instance()
+
+    rv = client.get('/api/search/inventory_items/?query=pneu+usage')
+    assert rv.json['total_count'] == total_count
+
+def test_duplicates(client, login):
+    from models import Client
+
+    rv = client.get('/duplicates/')
+    assert rv.status_code == 200
+
+    rv = client.post('/client/new/', data=dict(first_name='Caroline', last_name='Degrafenreid',
+                                                phone='1 (438) 555-1234', email=' Carolyn@Example.com'),
+                     follow_redirects=True)
+    assert b'Possible duplicate of Carolyn Degraffenreid (same email and name)' in rv.data
+
+    caroline = Client.select().order_by(Client.id.desc()).get()
+    carolyn = Client.get(Client.first_name == 'Carolyn')
+    assert [(c.id, kinds) for c, kinds in caroline.possible_duplicates()] == [(carolyn.id, ['email', 'name'])]
+
+    # Keys follow the edits
+    rv = client.post(f'/api/edit/client/{carolyn.id}', json={'column': 'phone', 'value': '438.555.1234'})
+    rv = client.post(f'/api/edit/client/{carolyn.id}', json={'column': 'email', 'value': 'carolyn@example.org'})
+    assert [(c.id, kinds) for c, kinds in caroline.possible_duplicates()] == [(carolyn.id, ['name', 'phone'])]
+
+    rv = client.get(f'/client/{caroline.id}')
+    assert b'Possible duplicates' in rv.data
+
+    rv = client.get('/duplicates/')
+    assert rv.data.count(b'Caroline') == 2 # Same phone, similar name
+
+    # Deleted clients aren't duplicates anymore
+    copy = Client.create(first_name='Carolyn', last_name='Degraffenreid', email='carolyn@example.org')
+    assert {c.id for c, kinds in carolyn.possible_duplicates()} == {caroline.id, copy.id}
+
+    copy.delete_instance()
+    assert {c.id for c, kinds in carolyn.possible_duplicates()} == {caroline.id}
+
+def test_matcher_same_scores_as_does_match():
+    from scoring import does_match, Matcher
+
+    haystacks = ['Mise au point avancée', 'Chambre à air + Installation', 'flat crevaison pneu crevé',
+                 'Pneu usagé (hiver)', 'used tire winter', 'Patins de freins neufs', '',
+                 'Alice Whooper', 'Carolyn Degraffenreid', 'İstanbul', 'aaaa bbbb aaab']
+
+    needles = ['mise', 'mise au point', 'Chambre', 'chanbre', 'air', 'a', 'pn', 'pneu usage',
+               'hiver', 'crevé', 'whoop', 'degrafenreid', 'İst', 'aaab', 'abab', 'ba']
+
+    for needle in needles:
+        matcher = Matcher(needle)
+
+        for haystack in haystacks:
+            assert matcher.score(haystack) == does_match(needle, haystack), (needle, haystack)
+
+def test_import_duplicate_scan_codes(client, tmp_path):
+    """Inventory items that share a manufacturer SKU are imported, the
+    first one keeps the code"""
+    import sys
+    import pickle
+    import sqlite3
+    import subprocess
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    db_path = str(tmp_path / 'import.db')
+
+    def item(item_id, custom_sku, manufacturer_sku, archived=False):
+        return {'itemID': item_id, 'defaultCost': '1', 'archived': 'true' if archived else 'false',
+                'description': f'Item {item_id}', 'upc': '', 'ean': '',
+                'customSku': custom_sku, 'manufacturerSku': manufacturer_sku,
+                'Prices': {'ItemPrice': [{'useType': 'MSRP', 'amount': '10'}, {'useType': 'Default', 'amount': '10'}]},
+                'tax': 'true', 'categoryID': '0', 'discountable': 'true', 'taxClassID': '1'}
+
+    os.mkdir(tmp_path / 'migration')
+
+    with open(tmp_path / 'migration' / 'dump-Category.pickle', 'wb') as f:
+        pickle.dump([], f)
+
+    with open(tmp_path / 'migration' / 'dump-Item.pickle', 'wb') as f:
+        pickle.dump([item('9001', '', 'SHIMANO-1'), item('9002', '', 'SHIMANO-1'),
+                     item('9003', 'MY-1', 'SHIMANO-1'), item('9004', '', 'SHIMANO-1', archived=True)], f)
+
+    # In its own process, on a new database, from the directory of the dumps
+    script = '\n'.join([
+        'import sys',
+        'sys.path.insert(0, sys.argv[2])',
+        'import config',
+        'config.DATABASE["name"] = sys.argv[1]',
+        'config.DATABASE["engine"] = "peewee.SqliteDatabase"',
+        'from app import app',
+        'from create_db import create_db',
+        'from import_db import import_inventory_items',
+        'create_db()',
+        'import_inventory_items()',
+    ])
+    result = subprocess.run([sys.executable, '-c', script, db_path, root], cwd=tmp_path,
+                            check=True, capture_output=True, text=True)
+
+    conn = sqlite3.connect(db_path)
+    codes = conn.execute('SELECT id, sku_code FROM inventoryitem WHERE id BETWEEN 9001 AND 9004 ORDER BY id').fetchall()
+    conn.close()
+
+    assert codes == [(9001, 'SHIMANO-1'), (9002, ''), (9003, 'MY-1'), (9004, 'SHIMANO-1')]
+    assert 'WARNING: Active inventory items share the same sku_code' in result.stdout
+    assert '#9002 (SHIMANO-1, kept on #9001)' in result.stdout
+
+def test_migrate_db(client, tmp_path):
+    """A database created before the first migration is upgraded to the
+    schema of create_db()"""
+    import sys
+    import sqlite3
+    import subprocess
+    import config
+    from migrate_db import MIGRATIONS
+
+    root = os.path.dirname(os.path.abspath(__file__))
+    db_path = str(tmp_path / 'v0.db')
+
+    with open(os.path.join(root, 'data', 'schema-v0.sql')) as f:
+        conn = sqlite3.connect(db_path)
+        conn.executescript(f.read())
+        conn.close()
+
+    # In its own process, the app of the tests stays on its database
+    script = '\n'.join([
+        'import sys, config',
+        'config.DATABASE["name"] = sys.argv[1]',
+        'config.DATABASE["engine"] = "peewee.SqliteDatabase"',
+        'from app import app',
+        'from migrate_db import migrate_db',
+        'migrate_db()',
+    ])
+    subprocess.run([sys.executable, '-c', script, db_path], cwd=root, check=True)
+
+    def schema(path):
+        conn = sqlite3.connect(path)
+        objects = {(type, name) for type, name in conn.execute(
+            "SELECT type, name FROM sqlite_master WHERE name NOT LIKE 'sqlite_%'")}
+        columns = {(name, column[1]) for type, name in objects if type == 'table'
+                   for column in conn.execute(f'PRAGMA table_info("{name}")')}
+        version = conn.execute('PRAGMA user_version').fetchone()[0]
+        integrity = conn.execute('PRAGMA integrity_check').fetchall()
+        conn.close()
+        return objects, columns, version, integrity
+
+    migrated = schema(db_path)
+    created = schema(config.DATABASE['name'])
+
+    assert migrated[2] == created[2] == len(MIGRATIONS)
+    assert migrated[3] == [('ok',)]
+
+    # Same tables, indexes, triggers and columns
+    assert migrated[0] == created[0]
+    assert migrated[1] == created[1]
+
 
 """
 TODO :
@@ -359,5 +1547,4 @@ TODO :
 - Any action done to the "Transaction" table should not affect Sales
   shown in /reports/
 
-- Add tests for the auto-complete searches
 """
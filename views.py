@@ -1,14 +1,20 @@
-from setup_app import app, db, mail
+from setup_app import app, db, mail, atomic
 import config
 from models import *
+import money
+import export
+import series
+import jobs
 
 from flask import render_template, request, redirect, url_for, \
-    session, abort, jsonify, g, send_from_directory, flash
+    session, abort, jsonify, g, send_from_directory, flash, \
+    Response, stream_with_context
 from flask_mail import Message
 
 import os
 import re
 import json
+import decimal
 import datetime
 from math import ceil
 from functools import reduce
@@ -19,6 +25,8 @@ from peewee import fn
 from playhouse.flask_utils import get_object_or_404, PaginatedQuery
 
 from security import public_route
+from search import inventory_index, client_index, inventory_cache, client_cache, fts_query
+from scoring import Matcher, extract_terms, search_key
 
 # ---------- Basic profiling ----------
 import time
@@ -103,6 +111,10 @@ def index():
                            today=datetime.date.today())
 
 # ---------- Clients ----------
+
+# Maximum number of clients listed by a typo-tolerant search
+FUZZY_CLIENTS_LIMIT = 100
+
 @app.route('/clients/')
 def list_clients():
 
@@ -113,19 +125,18 @@ def list_clients():
     if 'query' in request.args:
         query = ' '.join(request.args['query'].split())
         terms = extract_terms(query)
+        match = fts_query(terms)
 
-        conditions = []
+        if match is not None:
+            starts_with = clients.join(ClientIndex, on=(ClientIndex.rowid == Client.id)) \
+                                 .where(ClientIndex.match(match))
 
-        for t in terms:
-            if config.use_spellfix:
-                conditions.append(fn.editdist3(fn.lower(Client.first_name), t) <= 300)
-                conditions.append(fn.editdist3(fn.lower(Client.last_name), t) <= 300)
+            if starts_with.exists():
+                clients = starts_with
             else:
-                conditions.append(Client.first_name.contains(t))
-                conditions.append(Client.last_name.contains(t))
-
-        if conditions:
-            clients = clients.where(or_where_conds(conditions))
+                # Typo-tolerant search, ex.: Josca -> Joska
+                total_count, matches = client_index.search(terms, limit=FUZZY_CLIENTS_LIMIT)
+                clients = clients.where(Client.id.in_([client_id for client_id, score in matches]))
 
     print(clients)
     clients = PaginatedQuery(clients, 25)
@@ -140,36 +151,17 @@ def list_clients():
 def duplicates_clients():
     from itertools import groupby
 
-    def find_duplicates_query(field):
-        """Returns clients with a duplicate field, ordered by that field"""
-        return Client.select() \
-                     .where(field.in_( \
-                        Client.select(field) \
-                        .where(fn.LENGTH(field) > 0) \
-                        .group_by(field) \
-                        .having(fn.COUNT(field) > 1))) \
-                     .order_by(field)
-
-    # Requests all clients who have duplicate information
-
-    # TODO : add ICU SQLite extension to use regex_replace() to keep only numbers
-    client_dup_phone = find_duplicates_query(Client.phone)
-
-    client_dup_email = find_duplicates_query(Client.email)
-
-    full_name = Client.first_name + Client.last_name
-    client_dup_name = Client.select() \
-                            .where(full_name.in_( \
-                               Client.select(full_name) \
-                               .where((fn.LENGTH(Client.first_name) > 0) & (fn.LENGTH(Client.last_name) > 0)) \
-                               .group_by(full_name) \
-                               .having(fn.COUNT(full_name) > 1))) \
-                            .order_by(full_name)
-
-    # Groups together clients who have the same information
-    phone_list = groupby(client_dup_phone, lambda x: x.phone)
-    email_list = groupby(client_dup_email, lambda x: x.email)
-    name_list = groupby(client_dup_name, lambda x: x.name())
+    # Clients sharing a blocking key, maintained by triggers (see dedup.py)
+    keys = ClientKey.select(ClientKey, Client) \
+                    .join(Client) \
+                    .where(ClientKey.duplicate == True) \
+                    .order_by(ClientKey.kind, ClientKey.key, Client.id)
+
+    # Groups together clients who have the same key
+    groups = {kind: [] for kind in ClientKey.kinds}
+
+    for (kind, key), rows in groupby(keys, lambda x: (x.kind, x.key)):
+        groups[kind].append((key, [row.client for row in rows]))
 
     # Requests and section of erroneous info
     current_date = datetime.datetime.now()
@@ -180,9 +172,9 @@ def duplicates_clients():
     wrong_character = Client.select().where(db_column.contains("@"))
 
     return render_template('duplicates.html',
-                           client_dup_phone=phone_list,
-                           client_dup_email=email_list,
-                           client_dup_name=name_list,
+                           client_dup_phone=groups['phone'],
+                           client_dup_email=groups['email'],
+                           client_dup_name=groups['name'],
                            missing_names=missing_names,
                            suspicious_date=suspicious_date,
                            wrong_character=wrong_character)
@@ -210,6 +202,13 @@ def new_client(workorder_id=None):
                     client.__setattr__(col, request.form[col])
             client.save()
 
+            # The keys are computed by triggers on insert
+            duplicates = client.possible_duplicates()
+
+            if duplicates:
+                names = ', '.join(f'{other.name()} (same {" and ".join(kinds)})' for other, kinds in duplicates[:5])
+                flash(f'Possible duplicate of {names}', 'warning')
+
             if workorder_id is None:
                 return redirect('/workorder/new/' + str(client.id))
             else:
@@ -233,6 +232,7 @@ def get_client(id):
 
     return render_template('client.html',
                            client=client, new=False,
+                           duplicates=client.possible_duplicates(),
                            workorders=client.workorders.order_by(Workorder.created.desc()))
 
 
@@ -286,19 +286,13 @@ def refund_workorder(id):
 
     workorder = get_object_or_404(Workorder, (Workorder.id==id))
 
-    # Checks if all items are either refunded or refunds of other items
-    total_workorder_items = workorder.items.count()
-    refund_items = workorder.items.where(WorkorderItem.refund_item_id.is_null(False)).count()
-    refunded_items = workorder.items.where(WorkorderItem.id << WorkorderItem.select(WorkorderItem.refund_item_id).where(WorkorderItem.refund_item_id.is_null(False))).count()
-    refunded = (refund_items + refunded_items) == total_workorder_items
-
-    if refunded or not workorder.paid:
+    # All items are either refunded or refunds of other items
+    if workorder.refunded or not workorder.paid:
         return redirect('/workorder/' + str(workorder.id))
 
     items = []
 
-    for i in workorder.items.where(WorkorderItem.refund_item_id.is_null(True)):
-        item = i.serialized()
+    for item in WorkorderItem.serialize_many(workorder.items.where(WorkorderItem.refund_item_id.is_null(True))):
         # if not item['refunded_in_workorder_id']:
         items.append(item)
 
@@ -328,21 +322,7 @@ def get_workorder(id):
             last_bike['bike_description'] = last_workorder.bike_description
             last_bike['bike_serial_number'] = last_workorder.bike_serial_number
 
-    items = []
-
-    for i in workorder.items:
-        items.append(i.serialized())
-
-    # Checks if all items are either refunded or refunds of other items
-    total_workorder_items = workorder.items.count()
-    refund_items = workorder.items.where(WorkorderItem.refund_item_id.is_null(False)).count()
-    refunded_items = workorder.items \
-                              .where(
-                                  WorkorderItem.id.in_(
-                                      WorkorderItem.select(WorkorderItem.refund_item_id) \
-                                                   .where(WorkorderItem.refund_item_id.is_null(False)))
-                              ).count()
-    refunded = (refund_items + refunded_items) == total_workorder_items
+    items = WorkorderItem.serialize_many(workorder.items)
 
     quick_items = InventoryItem.select().where(InventoryItem.quick_add).dicts()
     statuses = WorkorderStatus.select().where(WorkorderStatus.archived==False).order_by(WorkorderStatus.display_order)
@@ -369,7 +349,7 @@ def get_workorder(id):
                            last_bike=last_bike,
                            items=items,
                            statuses=statuses,
-                           refunded=refunded,
+                           refunded=workorder.refunded,
                            quick_items=quick_items,
                            membership_item=membership_item,
                            propose_membership=propose_membership,
@@ -454,18 +434,32 @@ def pay_workorder(workorder_id):
 
 
     workorder.set_paid()
-    workorder.save()
 
     # Note : 0$ workorders are allowed (as long as there is at least
     # one item), but no transaction should be recorded
     #
     # A "paid" 0$ workorder is a closed free workorder
-    if workorder.paid_total != 0:
-        Transaction.create(
-            amount=workorder.paid_total,
-            payment_method=payment_method,
-            workorder_id=workorder_id,
-        )
+    with atomic():
+        transaction = None
+
+        if workorder.paid_total != 0:
+            transaction = Transaction.create(
+                amount=workorder.paid_total,
+                payment_method=payment_method,
+                workorder_id=workorder_id,
+            )
+
+        # After the transaction : this write also adds the workorder to
+        # the SalesLedger, with its payment method
+        try:
+            workorder.save()
+        except Exception:
+            # No payment without the paid workorder, even without a
+            # database transaction (see `setup_app.atomic()`)
+            if transaction is not None:
+                transaction.delete_instance()
+
+            raise
 
     flash(f'Payment successful : {workorder.paid_total}$ ({payment_method})', 'success')
 
@@ -476,6 +470,75 @@ def pay_workorder(workorder_id):
 def manage():
     return render_template('todo.html', msg='Edit items, edit taxes')
 
+@app.route('/api/reports/sales-series')
+def api_sales_series():
+    """Daily, weekly or monthly sales, see `series.sales_series()`
+
+    Arguments : granularity (day, week or month), date_start, date_end"""
+
+    granularity = request.args.get('granularity', 'day')
+
+    if granularity not in series.GRANULARITIES:
+        abort(400)
+
+    try:
+        date_end = datetime.date.fromisoformat(request.args.get('date_end', datetime.date.today().isoformat()))
+        date_start = datetime.date.fromisoformat(request.args.get('date_start', (date_end - datetime.timedelta(days=365)).isoformat()))
+    except ValueError:
+        abort(400)
+
+    if date_start > date_end:
+        abort(400)
+
+    # No empty buckets before the first sale or in the future (eg.:
+    # "All time" is +/- 100 years)
+    first_paid = Workorder.select(fn.MIN(Workorder.paid_date)).scalar()
+    first_paid = first_paid.date() if first_paid else datetime.date.today()
+
+    date_start = max(date_start, first_paid)
+    date_end = max(date_start, min(date_end, datetime.date.today()))
+
+    return jsonify(series.sales_series(granularity, date_start, date_end))
+
+@app.route('/reports/export')
+def export_sales():
+    """Streamed accounting export of the paid workorders, see `export.py`
+
+    Arguments : format (csv or jsonl), date_start, date_end, since (the
+    X-Export-Cursor of the previous export)"""
+
+    format = request.args.get('format', 'csv')
+
+    if format not in export.FORMATS:
+        abort(400)
+
+    lines, mimetype = export.FORMATS[format]
+
+    try:
+        date_start, date_end = [datetime.date.fromisoformat(request.args[arg]) if arg in request.args else None
+                                for arg in ('date_start', 'date_end')]
+        since = export.parse_cursor(request.args['since']) if 'since' in request.args else None
+    except ValueError:
+        abort(400)
+
+    # Payments during the export are left to the next one
+    until = export.last_cursor(date_start, date_end)
+    records = export.export_records(date_start, date_end, since, until)
+    filename = f"sales-{date_start or 'start'}-{date_end or 'end'}.{format}"
+    headers = {'Content-Disposition': f'attachment; filename={filename}'}
+
+    # Resume token of the next incremental export
+    cursor = max(filter(None, [since, until]), default=None)
+
+    if cursor:
+        headers['X-Export-Cursor'] = export.cursor_token(cursor)
+
+    return Response(stream_with_context(lines(records)), mimetype=mimetype, headers=headers)
+
+# Seconds the reports page waits for the job before showing its
+# progress instead
+REPORT_WAIT = 2
+
 @app.route('/reports/', methods=['POST', 'GET'])
 @timefunc
 def reports():
@@ -488,90 +551,64 @@ def reports():
     if 'date_end' in request.args:
         date_end = datetime.date.fromisoformat(request.args['date_end'])
 
+    # Computed in the background, see `jobs.py`
+    job = jobs.wait(jobs.submit_report(date_start, date_end).id, timeout=REPORT_WAIT)
 
-    postal_code_query =  Client.select(
-        fn.UPPER(fn.SUBSTR(Client.postal_code, 1, 3)).alias('pc'),
-        fn.COUNT(peewee.SQL('*')).alias('nb')
-    ).where(Client.postal_code != '') \
-     .group_by(peewee.SQL('pc')) \
-     .order_by(peewee.SQL('nb').desc())
-
-    # TOP 5
-    postal_codes_stats = list(postal_code_query.limit(5).dicts())
-    postal_codes_keys = [line['pc'] for line in postal_codes_stats]
-    postal_codes_vals = [line['nb'] for line in postal_codes_stats]
-
-    # Others (known)
-    postal_codes_others = Client.select().where(
-        fn.UPPER(fn.SUBSTR(Client.postal_code, 1, 3)).not_in(postal_codes_keys) & (Client.postal_code != '')
-    ).count()
+    return render_report_job(job)
 
-    # Unknown
-    postal_codes_unknown = Client.select().where(Client.postal_code == '').count()
+def render_report_job(job):
+    """The report of a done job, its progress otherwise"""
 
-    if Client.select().count() != sum(postal_codes_vals + [postal_codes_others, postal_codes_unknown]):
-        print('ERROR: ', Client.select().count(), '!=', sum(postal_codes_vals + [postal_codes_others, postal_codes_unknown]))
+    if job.status != 'done':
+        return render_template('report-job.html', job=job)
 
-    for i in range(len(postal_codes_keys)):
-        key = postal_codes_keys[i]
+    result = json.loads(job.result)
 
-        if key in postal_codes:
-            postal_codes_keys[i] = key + ' (' + postal_codes[key] + ')'
-
-    paid_workorders = Workorder.select() \
-                               .where((Workorder.paid) & (fn.DATE(Workorder.paid_date).between(date_start, date_end)))
-
-    items_sold = InventoryItem.select(InventoryItem.name, fn.sum(WorkorderItem.nb).alias("total_sold"))\
-                            .join(WorkorderItem, on=(InventoryItem.id == WorkorderItem.inventory_item_id))\
-                            .join(Workorder, on=(WorkorderItem.workorder_id == Workorder.id))\
-                            .where((InventoryItem.type == "article") & (Workorder.paid) & (fn.DATE(Workorder.paid_date).between(date_start, date_end)))\
-                            .group_by(InventoryItem.id)\
-                            .order_by(fn.sum(WorkorderItem.nb).desc())
-
-    print(items_sold)
-
-    workorder_stats = {
-        'subtotal': Decimal(0),
-        'total': Decimal(0),
-        'taxes1': Decimal(0),
-        'taxes2': Decimal(0),
-        'taxes': Decimal(0),
-        'total_discounts': Decimal(0),
-    }
-    print(paid_workorders.count())
-
-    for workorder in paid_workorders:
-        workorder_stats['subtotal'] += workorder.subtotal()
-        workorder_stats['total'] += workorder.total()
-        workorder_stats['taxes1'] += workorder.taxes1()
-        workorder_stats['taxes2'] += workorder.taxes2()
-        workorder_stats['taxes'] += workorder.taxes()
-        workorder_stats['total_discounts'] += workorder.total_discounts()
-
-    print(workorder_stats)
+    workorder_stats = {k: Decimal(v) for k, v in result['workorder_stats'].items()}
+    tax_breakdown = [{k: v if k == 'name' else Decimal(v) for k, v in line.items()}
+                     for line in result['tax_breakdown']]
 
     return render_template('reports.html',
-                           postal_codes_keys=postal_codes_keys + ['Others', 'Unknown'],
-                           postal_codes_vals=postal_codes_vals + [postal_codes_others, postal_codes_unknown],
-                           date_start=date_start,
-                           date_end=date_end,
+                           postal_codes_keys=result['postal_codes_keys'],
+                           postal_codes_vals=result['postal_codes_vals'],
+                           date_start=job.date_start,
+                           date_end=job.date_end,
                            workorder_stats=workorder_stats,
+                           tax_breakdown=tax_breakdown,
                            tax1_name=config.taxes[0][0],
                            tax2_name=config.taxes[1][0],
                            tax1_rate=Decimal(config.taxes[0][1]),
                            tax2_rate=Decimal(config.taxes[1][1]),
-                           items_sold=items_sold)
+                           items_sold=result['items_sold'])
+
+@app.route('/reports/jobs/<int:job_id>')
+def report_job(job_id):
+    """Progress of a report job, polled by the page"""
+
+    job = get_object_or_404(ReportJob, (ReportJob.id==job_id))
+
+    return jsonify(job.serialized())
+
+@app.route('/reports/jobs/<int:job_id>/result')
+def report_job_result(job_id):
+
+    job = get_object_or_404(ReportJob, (ReportJob.id==job_id))
+
+    return render_report_job(job)
 
 @app.route('/cash-register/', methods=['POST', 'GET'])
 def cash_register():
     payment_methods = {'cash': Decimal(0), 'interac': Decimal(0), 'visa': Decimal(0)}
     last_cash_open = CashRegisterState.select().order_by(CashRegisterState.id.desc()).get()
 
-    for method in payment_methods.keys():
-        transactions = Transaction.select().where((Transaction.payment_method == method) & \
-                                                (Transaction.created > (last_cash_open.state_time)))
-        for t in transactions:
-            payment_methods[method] += t.amount
+    totals = Transaction.select(Transaction.payment_method, fn.SUM(money.sql_cents(Transaction.amount))) \
+                        .where(Transaction.payment_method.in_(list(payment_methods)) & \
+                               (Transaction.created > (last_cash_open.state_time))) \
+                        .group_by(Transaction.payment_method) \
+                        .tuples()
+
+    for method, cents in totals:
+        payment_methods[method] = money.to_decimal(cents)
 
     if request.method == 'POST':
         form = request.form
@@ -618,63 +655,210 @@ def cash_register():
 
 
 # ---------- API ----------
-@app.route('/api/edit/<model>/<int:id>', methods=['POST'])
-def edit_model(model, id):
+# Models editable through the API, by name
+EDITABLE_MODELS = {'client': Client, 'workorderitem': WorkorderItem, 'workorder': Workorder}
 
+def decimal_value(value):
+    """`value` (number or string) as a Decimal that fits the amount
+    columns, aborts otherwise"""
+    try:
+        value = Decimal(str(value))
+    except decimal.InvalidOperation:
+        abort(400)
 
-    authorized_models = {'client': Client, 'workorderitem': WorkorderItem, 'workorder': Workorder}
+    # DECIMAL(15, 3)
+    if not value.is_finite() or abs(value) >= 10**12:
+        abort(400)
 
-    klass = authorized_models[model]
+    return value
 
-    form = request.json
-    column = form['column']
-    value = form['value']
+def edit_value(klass, column, value):
+    """Validated `value` of an edit of `column`, aborts if the column
+    can't be edited"""
 
-    if klass == WorkorderItem:
-        workorderitem = klass.get(id)
-        if workorderitem.workorder.paid:
-            abort(403)
+    if column not in klass.editable_cols():
+        abort(403)
 
     if klass == Workorder and column == 'calendar_date':
         try:
             value = datetime.datetime.fromisoformat(value)
         except:
-            print('ERROR', model, id, column, value)
+            print('ERROR', klass, column, value)
             abort(403)
-    
+    elif klass == Workorder and column == 'status':
+        try:
+            value = int(value)
+        except (TypeError, ValueError):
+            abort(400)
+
+        if not WorkorderStatus.select().where(WorkorderStatus.id == value).exists():
+            abort(400)
+    elif klass == Client and column == 'year_of_birth':
+        # Number inputs send '' when empty
+        if value in ('', None):
+            value = None
+        elif isinstance(value, int) or (isinstance(value, str) and value.isdigit()):
+            value = int(value)
+        else:
+            abort(400)
+    elif klass == Client and column == 'email_consent':
+        if value not in (0, 1):
+            abort(400)
 
-    allowed_columns = klass.editable_cols()
+        value = bool(value)
+    elif klass != WorkorderItem and not isinstance(value, str):
+        abort(400)
 
-    if column not in allowed_columns:
-        abort(403)
+    if klass == WorkorderItem:
+        if column in ('nb', 'price'):
+            value = decimal_value(value)
+        elif column == 'taxable':
+            # Checkboxes send 0 or 1
+            if value not in (0, 1):
+                abort(400)
+
+            value = bool(value)
+        elif column == 'tax_class':
+            if value is not None and not (isinstance(value, int) and
+                                          TaxClass.select().where(TaxClass.id == value).exists()):
+                abort(400)
+        elif not isinstance(value, str):
+            abort(400)
+
+    return value
+
+def apply_edits(changes):
+    """Applies a list of (model name, id, column, value) edits
+
+    Everything is validated before the first write : editable columns,
+    values, existing rows and no item of a paid workorder. The edits of
+    a model are a single UPDATE, the last value of a column wins. Under
+    SqliteQueueDatabase, each UPDATE is applied on its own (see
+    `setup_app.atomic()`)"""
+
+    # model -> {id: {column: value}}
+    rows = {}
+
+    for model, id, column, value in changes:
+        if model not in EDITABLE_MODELS:
+            abort(404)
+
+        klass = EDITABLE_MODELS[model]
+        rows.setdefault(klass, {}).setdefault(id, {})[column] = edit_value(klass, column, value)
+
+    for klass, values in rows.items():
+        if klass.select().where(klass.id.in_(list(values))).count() != len(values):
+            abort(404)
+
+    # Items of a paid workorder can't be modified
+    if WorkorderItem in rows:
+        paid_items = WorkorderItem.select().join(Workorder) \
+                                  .where(WorkorderItem.id.in_(list(rows[WorkorderItem])) & Workorder.paid)
+
+        if paid_items.exists():
+            abort(403)
+
+    with atomic():
+        for klass, values in rows.items():
+            klass.update(update_values(klass, values)).where(klass.id.in_(list(values))).execute()
+
+    # Keep the in-memory indexes and caches up to date
+    for klass, values in rows.items():
+        if change_hooks[klass]:
+            for instance in klass.select().where(klass.id.in_(list(values))):
+                notify_change(instance)
+
+def update_values(klass, values):
+    """{field: value} of a single UPDATE of the rows of `values`
+    ({id: {column: value}}), with a CASE on the id when there are many
+    rows"""
+    columns = {column for row in values.values() for column in row}
+    update = {}
+
+    for column in columns:
+        field = getattr(klass, column)
+        cases = [(id, peewee.Value(row[column], converter=field.db_value))
+                 for id, row in values.items() if column in row]
+
+        if len(values) == 1:
+            update[field] = cases[0][1]
+        else:
+            update[field] = peewee.Case(klass.id, cases, field)
+
+    return update
+
+@app.route('/api/edit/<model>/<int:id>', methods=['POST'])
+def edit_model(model, id):
 
-    klass.update({column: value}).where(klass.id == id).execute()
+    form = request.json
+
+    apply_edits([(model, id, form['column'], form['value'])])
 
     return jsonify(True)
 
-@app.route('/api/total/<int:workorder_id>')
-def get_workorder_total_infos(workorder_id):
+@app.route('/api/edit/', methods=['POST'])
+def edit_models():
+    """Many edits in one request :
+
+        {"changes": [{"model": "client", "id": 1, "column": "phone", "value": "..."},
+                     ...]}
+
+    See `apply_edits()`"""
+
+    try:
+        changes = [(change['model'], int(change['id']), change['column'], change['value'])
+                   for change in request.json['changes']]
+    except (KeyError, TypeError, ValueError):
+        abort(400)
+
+    apply_edits(changes)
+
+    return jsonify(True)
+
+def versioned_json(workorder_id, serialize):
+    """JSON response of `serialize(workorder)` with the version of the
+    workorder as ETag. Answers 304 when the client already has this
+    version, without loading the items"""
 
     workorder = get_object_or_404(Workorder, (Workorder.id==workorder_id))
-    total_workorder_items = workorder.items.count()
+    etag = f'{workorder.id}-{workorder.version}'
 
-    return jsonify({
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(serialize(workorder))
+
+    response.set_etag(etag)
+    # Always revalidated, the version changes with each edit
+    response.cache_control.no_cache = True
+
+    return response
+
+def total_infos(workorder):
+    return {
         'subtotal': round(workorder.subtotal(), 2),
         'discount': round(workorder.total_discounts(), 2),
         'taxes1': round(workorder.taxes1(), 2),
         'taxes2': round(workorder.taxes2(), 2),
         'taxes': round(workorder.taxes(), 2),
         'total': round(workorder.total(), 2),
-        'nb_items': total_workorder_items,
+        'nb_items': workorder.totals().nb_items,
         'workorder_paid': workorder.paid,
-    })
+    }
 
-@app.route('/api/add-item/<int:workorder_id>/<int:inventory_item_id>')
-def add_item(workorder_id, inventory_item_id):
+@app.route('/api/total/<int:workorder_id>')
+def get_workorder_total_infos(workorder_id):
+    return versioned_json(workorder_id, total_infos)
 
+@app.route('/api/items/<int:workorder_id>')
+def get_workorder_items(workorder_id):
+    """serialized() of all the items of a workorder"""
+    return versioned_json(workorder_id, lambda workorder: WorkorderItem.serialize_many(workorder.items))
+
+def add_inventory_item(workorder_id, inventory_item):
+    """Adds a line for `inventory_item` to an unpaid workorder"""
 
     workorder = get_object_or_404(Workorder, (Workorder.id==workorder_id))
-    inventory_item = get_object_or_404(InventoryItem, (InventoryItem.id==inventory_item_id))
 
     # We shouldn't modify an invoice once it's paid
     if workorder.paid:
@@ -685,11 +869,37 @@ def add_item(workorder_id, inventory_item_id):
         price=inventory_item.price,
         orig_price=inventory_item.price,
         taxable=inventory_item.taxable,
-        workorder_id=workorder_id, inventory_item_id=inventory_item_id
+        tax_class_id=inventory_item.tax_class_id,
+        workorder_id=workorder_id, inventory_item_id=inventory_item.id
     )
 
     return jsonify(item.serialized())
 
+@app.route('/api/add-item/<int:workorder_id>/<int:inventory_item_id>')
+def add_item(workorder_id, inventory_item_id):
+
+    inventory_item = get_object_or_404(InventoryItem, (InventoryItem.id==inventory_item_id))
+
+    return add_inventory_item(workorder_id, inventory_item)
+
+SCAN_FIELDS = ['id', 'name', 'price', 'taxable', 'category', 'subcategory', 'ean_code', 'upc_code', 'sku_code']
+
+@app.route('/api/scan/<code>')
+@app.route('/api/scan/<int:workorder_id>/<code>')
+def scan(code, workorder_id=None):
+    """Barcode scanner input : finds the item by EAN, UPC or SKU with
+    an indexed lookup and adds it to the workorder, if any"""
+
+    inventory_item = InventoryItem.get_by_scan_code(code)
+
+    if inventory_item is None:
+        abort(404)
+
+    if workorder_id is None:
+        return jsonify({field: getattr(inventory_item, field) for field in SCAN_FIELDS})
+
+    return add_inventory_item(workorder_id, inventory_item)
+
 @app.route('/api/delete-workorderitem/<int:workorderitem_id>')
 def remove_item(workorderitem_id):
 
@@ -698,127 +908,275 @@ def remove_item(workorderitem_id):
     if workorderitem.workorder.paid:
         abort(403)
 
-    WorkorderItem.delete().where(WorkorderItem.id==workorderitem_id).execute()
+    workorderitem.delete_instance()
 
     return jsonify(True)
 
+@app.route('/api/workorder-items/<int:workorder_id>', methods=['POST'])
+def batch_items(workorder_id):
+    """Applies a list of operations on the items of an unpaid workorder :
+
+        {"operations": [{"op": "add", "inventory_item_id": 3, "nb": 1},
+                        {"op": "edit", "id": 12, "column": "nb", "value": 2},
+                        {"op": "remove", "id": 13}]}
 
-def extract_terms(s):
-    terms = [term.strip() for term in s.split()]
-    terms = set([t.lower() for t in terms if t and len(t) > 1])
-    return set(terms)
+    Everything is validated before anything is written, including the
+    foreign keys, then the writes are grouped : one INSERT for all the
+    new lines, one UPDATE per edited line and one DELETE. Returns the serialized items and
+    the totals, like /api/items/ and /api/total/"""
 
-# https://stackoverflow.com/a/17741165/14639652
-import difflib
+    workorder = get_object_or_404(Workorder, (Workorder.id==workorder_id))
 
-def fuzzy_matches(large_string, query_string, threshold):
-    words = large_string.split()
-    for word in words:
-        s = difflib.SequenceMatcher(None, word, query_string)
-        match = ''.join(word[i:i+n] for i, j, n in s.get_matching_blocks() if n)
+    if workorder.paid:
+        abort(403)
 
-        score = len(match) / float(len(query_string))
+    try:
+        operations = request.json['operations']
+        adds = [(int(op['inventory_item_id']), op.get('nb', 1)) for op in operations if op['op'] == 'add']
+        edits = [(int(op['id']), op['column'], op['value']) for op in operations if op['op'] == 'edit']
+        removes = [int(op['id']) for op in operations if op['op'] == 'remove']
+    except (KeyError, TypeError, ValueError):
+        abort(400)
 
-        if score >= threshold:
-            yield match, len(match)
+    if len(adds) + len(edits) + len(removes) != len(operations):
+        abort(400)
 
-def does_match(needle, haystack):
-    if len(needle) < 2:
-        return 0
-    if len(needle) <= 3:
-        return (needle.lower() in haystack.lower()) * 0.5
-    else:
-        all_matches = list(fuzzy_matches(haystack.lower(), needle.lower(), 0.8))
-        nb = len(all_matches)
+    adds = [(item_id, decimal_value(nb)) for item_id, nb in adds]
+    edits = [(item_id, column, edit_value(WorkorderItem, column, value)) for item_id, column, value in edits]
+
+    inventory_items = InventoryItem.select().where(InventoryItem.id.in_({item_id for item_id, _ in adds}))
+    inventory_items = {item.id: item for item in inventory_items}
+
+    item_ids = {item_id for item_id, _, _ in edits} | set(removes)
+    items = WorkorderItem.select().where(WorkorderItem.id.in_(item_ids) & (WorkorderItem.workorder == workorder))
+    items = {item.id: item for item in items}
+
+    if len(inventory_items) + len(items) != len({item_id for item_id, _ in adds}) + len(item_ids):
+        abort(404)
+
+    # The refunds of a line keep it (RESTRICT)
+    if removes and WorkorderItem.select().where(WorkorderItem.refund_item.in_(removes)).exists():
+        abort(403)
 
-        if not nb:
-            return 0
+    # Last value of each column, per line
+    updates = {}
+
+    for item_id, column, value in edits:
+        updates.setdefault(item_id, {})[column] = value
+
+    # Every value, row and foreign key the writes depend on is checked
+    # above. SqliteQueueDatabase applies the writes one by one, without
+    # a transaction : the checks are what keeps the batch all or
+    # nothing there. The other engines also roll it back on an error
+    with atomic():
+        if adds:
+            WorkorderItem.insert_many([{
+                'name': inventory_items[item_id].name,
+                'nb': nb,
+                'price': inventory_items[item_id].price,
+                'orig_price': inventory_items[item_id].price,
+                'taxable': inventory_items[item_id].taxable,
+                'tax_class': inventory_items[item_id].tax_class_id,
+                'workorder': workorder.id,
+                'inventory_item': item_id,
+            } for item_id, nb in adds]).execute()
+
+        for item_id, values in updates.items():
+            if item_id not in removes:
+                WorkorderItem.update(values).where(WorkorderItem.id == item_id).execute()
+
+        if removes:
+            WorkorderItem.delete().where(WorkorderItem.id.in_(removes)).execute()
+
+    # Bulk queries skip the change hooks
+    if change_hooks[WorkorderItem]:
+        for item in items.values():
+            notify_change(item, deleted=item.id in removes)
+
+    workorder.invalidate_totals()
 
-        return sum([x[1] for x in all_matches])
+    return jsonify({
+        'items': WorkorderItem.serialize_many(workorder.items),
+        'total': total_infos(workorder),
+    })
+
+
+def select_in_order(query, ids):
+    """Rows of `query` (as dicts) whose id is in `ids`, in the same
+    order as `ids`"""
+    model = query.model
+    rows = {}
+
+    for batch in peewee.chunked(ids, 500):
+        for row in query.where(model.id.in_(batch)).dicts():
+            rows[row['id']] = row
+
+    return [rows[row_id] for row_id in ids if row_id in rows]
+
+
+
+# Page size of the full results (`full` argument)
+FULL_RESULTS_PAGE_SIZE = 100
+
+def parse_cursor(cursor):
+    """Continuation token of the full inventory search results :
+    <source>:<score bucket>:<last id>"""
+    try:
+        source, bucket, last_id = cursor.split(':')
+
+        if source == 'fts':
+            return source, int(bucket), int(last_id)
+        elif source == 'fuzzy':
+            return source, float(bucket), int(last_id)
+    except ValueError:
+        pass
 
+    abort(400)
 
 @app.route('/api/search/inventory_items/', methods=['GET'])
 @timefunc
 def api_get_inventory_items():
+    """Typeahead : the TYPEAHEAD_LIMIT best items, sorted by score
+
+    With the `full` argument : all the results, by pages of
+    FULL_RESULTS_PAGE_SIZE, in a stable order (score bucket, then id).
+    `next` is the `cursor` argument to get the next page"""
 
     query = ' '.join(request.args['query'].split())
 
     # XXX DUPLICATED IN TEMPLATES
     TYPEAHEAD_LIMIT = 20
 
-    # TODO : Normalize accents
-    # " is stored as '' in the actual data
-    # . and , should mean the same thing for numbers
-
+    # Accents, case, inches and decimal separators are normalized by
+    # search_key(), the items have normalized copies of their name
+    # and keywords
     terms = list(extract_terms(query))[:3]
 
     if not terms:
          return jsonify({
              'results': [],
              'total_count': 0,
+             'next': None,
          })
 
-    # TODO : Select only relevant data
-    q = InventoryItem.select()
+    # Les mots sont cherchés un peu fuzzy, les chiffres et
+    # caractères correspondent à des codes/contraintes
+    hard_constraints = [t for t in terms if re.search('[^a-zA-Z]{2,}', t) or len(t) < 2]
+    words = [t for t in terms if t not in hard_constraints]
+
+    full = 'full' in request.args
+    limit = FULL_RESULTS_PAGE_SIZE if full else TYPEAHEAD_LIMIT
+    cursor = parse_cursor(request.args['cursor']) if full and 'cursor' in request.args else None
+
+    # The results only depend on the normalized query
+    cache_key = (search_key(query), full, cursor)
+    generation = inventory_cache.generation
+    cached = inventory_cache.get(cache_key)
+
+    if cached is not None:
+        return jsonify(cached)
+
+    # Only counted for the first page
+    total_count = 0 if cursor is None else None
+    next_cursor = None
+    q = []
+    match = fts_query(words, hard_constraints)
+    source = cursor[0] if cursor else 'fts'
+
+    if source == 'fts' and match is not None:
+        bm25 = InventoryItemIndex.bm25(*InventoryItemIndex.weights)
+
+        q = InventoryItem.select() \
+                         .join(InventoryItemIndex, on=(InventoryItemIndex.rowid == InventoryItem.id)) \
+                         .where(InventoryItemIndex.match(match) & (InventoryItem.archived == False))
+
+        # The full-text index ignores punctuation, codes and
+        # measurements must still appear as typed (ex.: 26'' or 1,5)
+        for t in hard_constraints:
+            q = q.where(InventoryItem.search_name.contains(t) | InventoryItem.sku_code.contains(t) |
+                        InventoryItem.search_keywords.contains(t))
+
+        if cursor is None:
+            total_count = q.count()
+
+        if full:
+            # Tenths of bm25. Within a bucket, items are sorted by id to
+            # resume right after the last item of the previous page
+            bucket = peewee.Cast(bm25 * -10, 'INTEGER')
+            q = q.select_extend(bucket.alias('bucket')).order_by(bucket.desc(), InventoryItem.id)
+
+            if cursor is not None:
+                source, last_bucket, last_id = cursor
+                q = q.where((bucket < last_bucket) | ((bucket == last_bucket) & (InventoryItem.id > last_id)))
+        else:
+            q = q.order_by(bm25, InventoryItem.id)
 
-    hard_constraints = None
-    or_where = None
+        q = list(q.limit(limit).dicts())
 
-    for t in terms:
-        # Les mots sont cherchés un peu fuzzy, les chiffres et
-        # caractères correspondent à des codes/contraintes
-        if re.search('[^a-zA-Z]{2,}', t) or len(t) < 2:
-            cond = (InventoryItem.name.contains(t) | InventoryItem.sku_code.contains(t))
-            hard_constraints = cond if hard_constraints is None else hard_constraints & cond
-        else:
-            cond = InventoryItem.name.contains(t)
-            or_where = cond if or_where is None else or_where | cond
+        if full and len(q) == limit:
+            next_cursor = f"fts:{q[-1]['bucket']}:{q[-1]['id']}"
 
-    if hard_constraints is not None and or_where is not None:
-        q = q.where(hard_constraints & or_where)
-    elif hard_constraints is not None:
-        q = q.where(hard_constraints)
-    elif or_where is not None:
-        q = q.where(or_where)
+    if cursor is None and not total_count and words:
+        # Nothing starts with the query, there might be a typo
+        source = 'fuzzy'
 
-    q = q.where(InventoryItem.archived==False)
+    if source == 'fuzzy':
+        after = cursor[1:] if cursor is not None else None
+        count, matches = inventory_index.search(words, required_terms=hard_constraints, limit=limit, after=after)
 
-    total_count = q.count()
+        if cursor is None:
+            total_count = count
 
-    if 'full' not in request.args:
-        q = q.limit(TYPEAHEAD_LIMIT)
+        if full and len(matches) == limit:
+            last_id, score = matches[-1]
+            next_cursor = f'fuzzy:{score!r}:{last_id}'
 
-    q = q.dicts()
+        # Keep the index order for items that end up with the same score
+        q = select_in_order(InventoryItem.select(), [item_id for item_id, score in matches])
 
     results = []
 
+    query_matcher = Matcher(search_key(query))
+    term_matchers = [Matcher(t) for t in terms]
+
     for item in q:
         score = 0
 
-        score_name = does_match(query, item['name'])
-        score_keywords = does_match(query, item['keywords'])
+        name = item.pop('search_name')
+        keywords = item.pop('search_keywords')
+        item.pop('bucket', None)
+
+        score_name = query_matcher.score(name, folded=True)
+        score_keywords = query_matcher.score(keywords, folded=True)
 
         score += score_name * 2 + score_keywords * 2 * 0.5
 
-        for t in terms:
-            score_name = does_match(t, item['name'])
-            score_keywords = does_match(t, item['keywords'])
+        for matcher in term_matchers:
+            score_name = matcher.score(name, folded=True)
+            score_keywords = matcher.score(keywords, folded=True)
 
             score += score_name + 0.5 * score_keywords
 
         item['score'] = score
         results.append((item, score))
 
-    sorted_results = [
-        item
-        for item, score in sorted(results, key=lambda x: x[1], reverse=True)
-    ]
+    # Pages of the full results keep their order
+    if not full:
+        results = sorted(results, key=lambda x: x[1], reverse=True)
 
-    return jsonify({
-        'results': sorted_results,
+    response = {
+        'results': [item for item, score in results],
         'total_count': total_count,
-    })
+        'next': next_cursor,
+    }
 
+    inventory_cache.set(cache_key, response, generation)
+
+    return jsonify(response)
+
+
+# Number of clients scored by the typeahead, the best ones are shown
+CLIENTS_CANDIDATES_LIMIT = 50
 
 @app.route('/api/search/clients/', methods=['GET'])
 @timefunc
@@ -829,39 +1187,65 @@ def api_get_clients():
     if not terms:
         return jsonify([])
 
-    q = Client.select(Client.id, Client.first_name, Client.last_name, Client.phone)
+    cache_key = search_key(query)
+    generation = client_cache.generation
+    cached = client_cache.get(cache_key)
+
+    if cached is not None:
+        return jsonify(cached)
+
+    q = Client.select(Client.id, Client.first_name, Client.last_name, Client.phone,
+                      Client.search_first_name, Client.search_last_name)
 
-    conditions = []
+    # Candidates : names starting with one of the terms, the most
+    # relevant first
+    match = fts_query(terms)
+    candidates = []
 
-    for t in terms:
-        conditions.append(Client.first_name.startswith(t))
-        conditions.append(Client.last_name.startswith(t))
+    if match is not None:
+        starts_with = ClientIndex.select(ClientIndex.rowid).where(ClientIndex.match(match))
 
-    conditions = or_where_conds(conditions)
+        # Ranking all the names that start with one or two letters is
+        # slow and useless, the scoring below sorts the candidates
+        if max(len(t) for t in terms) > 2:
+            starts_with = starts_with.order_by(ClientIndex.bm25())
 
-    q = q.where(conditions)
+        ids = [row[0] for row in starts_with.limit(CLIENTS_CANDIDATES_LIMIT).tuples()]
+        candidates = select_in_order(q, ids)
 
-    print(q)
-    q = q.dicts()
+    if not candidates:
+        # Typo-tolerant search, ex.: Josca -> Joska
+        total_count, matches = client_index.search(terms, limit=CLIENTS_CANDIDATES_LIMIT)
+        candidates = select_in_order(q, [client_id for client_id, score in matches])
+
+    q = candidates
 
     results = []
 
+    query = search_key(query)
+    query_matcher = Matcher(query)
+    term_matchers = [Matcher(t) for t in terms]
+
     for item in q:
 
         score = 0
 
-        full_match = query in item['first_name'] + ' ' + item['last_name']
+        first_name = item.pop('search_first_name')
+        last_name = item.pop('search_last_name')
+        full_name = first_name + ' ' + last_name
+
+        full_match = query in full_name
 
-        score_fullname = does_match(query, item['first_name'] + ' ' + item['last_name'])
-        score_firstname = does_match(query, item['first_name'])
-        score_lastname = does_match(query, item['last_name'])
+        score_fullname = query_matcher.score(full_name, folded=True)
+        score_firstname = query_matcher.score(first_name, folded=True)
+        score_lastname = query_matcher.score(last_name, folded=True)
 
         score += (3 * score_fullname + score_firstname + score_lastname) * 3 + 10 if full_match else 0
 
-        for t in terms:
-            score_fullname = does_match(t, item['first_name'] + ' ' + item['last_name'])
-            score_firstname = does_match(t, item['first_name'])
-            score_lastname = does_match(t, item['last_name'])
+        for matcher in term_matchers:
+            score_fullname = matcher.score(full_name, folded=True)
+            score_firstname = matcher.score(first_name, folded=True)
+            score_lastname = matcher.score(last_name, folded=True)
 
             score += 3 * score_fullname + score_firstname + score_lastname
 
@@ -873,8 +1257,18 @@ def api_get_clients():
         for item, score in sorted(results, key=lambda x: x[1], reverse=True)
     ]
 
+    client_cache.set(cache_key, sorted_results, generation)
+
     return jsonify(sorted_results)
 
+@app.route('/api/search/stats', methods=['GET'])
+def api_search_stats():
+    """Hit rates of the typeahead caches, to size them"""
+    return jsonify({
+        'inventory_items': inventory_cache.stats(),
+        'clients': client_cache.stats(),
+    })
+
 @app.route('/api/refund/', methods=['POST'])
 def api_refund():
 
@@ -884,12 +1278,20 @@ def api_refund():
     old_workorder_id = data['workorder_id']
     old_workorder = get_object_or_404(Workorder, (Workorder.id==old_workorder_id))
 
+    # In the same order, without duplicates
+    refunded_items_id = list(dict.fromkeys(int(item_id) for item_id in refunded_items_id))
+    items = {item.id: item for item in WorkorderItem.select().where(WorkorderItem.id.in_(refunded_items_id))}
+
+    if len(items) != len(refunded_items_id):
+        abort(404)
+
     # Checks if the items have already been refuned
-    workorder_items = []
-    for item_id in refunded_items_id:
-        workorder_item = get_object_or_404(WorkorderItem, (WorkorderItem.id==item_id))
-        if not workorder_item.serialized()['refunded_in_workorder_id'] and workorder_item.refund_item_id is None:
-            workorder_items.append(workorder_item)
+    already_refunded = {item_id for item_id, in WorkorderItem.select(WorkorderItem.refund_item_id)
+                                                            .where(WorkorderItem.refund_item_id.in_(refunded_items_id))
+                                                            .tuples()}
+
+    workorder_items = [items[item_id] for item_id in refunded_items_id
+                       if item_id not in already_refunded and items[item_id].refund_item_id is None]
 
     if len(workorder_items) == 0 or not old_workorder.paid:
         return '/' # current_workorder
@@ -910,6 +1312,7 @@ def api_refund():
                     price= item.price,
                     orig_price= item.price,
                     taxable=item.taxable,
+                    tax_class_id=item.tax_class_id,
                     refund_item_id=item.id,
                     workorder_id=new_workorder.id, inventory_item_id=item.inventory_item_id
                 )